@@ -0,0 +1,462 @@
+import io
+import os
+import sys
+import json
+import shutil
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import importlib
+import runpy
+import subprocess
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime
+
+import synthetic
+import fakes
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+
+# Source shape, flow module, MinIO bucket (None: local file) and engines
+datasets = {
+    "owid": (
+        "owid",
+        "insert_owid",
+        "contamination-owid",
+        ("row", "columnar", "parallel", "parquet"),
+    ),
+    "ecdc": (
+        "ecdc",
+        "parse_insert",
+        "vaccination",
+        ("row", "columnar", "parallel", "parquet"),
+    ),
+    "opencovid19": ("opencovid19", "insert_france", None, ("row", "columnar")),
+}
+
+
+def percentile(values: list, ratio: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))] if values else 0
+
+
+def bulk_summary(requests: list) -> dict:
+    latencies = [request["seconds"] * 1000 for request in requests]
+    return {
+        "requests": len(requests),
+        "documents": sum(request["documents"] for request in requests),
+        "bytes": sum(request["bytes"] for request in requests),
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "max": max(latencies, default=0),
+        },
+    }
+
+
+class Timings:
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        with redirect_stdout(io.StringIO()):  # clevercsv's verbose sniffing
+            yield
+        self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - started
+
+    def report(self, nb_rows: int, nb_bytes: int) -> dict:
+        return {
+            name: {
+                "seconds": seconds,
+                "rows_per_second": nb_rows / seconds if seconds else None,
+                "mb_per_second": nb_bytes / 1e6 / seconds if seconds else None,
+            }
+            for name, seconds in self.seconds.items()
+        }
+
+
+class Adapter:
+    """What differs from one flow module to another"""
+
+    def __init__(self, name: str, module, bucket_name: str, lookup_table):
+        self.name = name
+        self.module = module
+        self.bucket_name = bucket_name
+        self.lookup_table = lookup_table
+
+    def location_names(self, rows, headers):
+        if self.name == "opencovid19":  # not geocoded
+            return None
+        column = self.module.columns_allowed["location"]
+        indexes = [headers.index(name) for name in column if name in headers]
+        return [row[indexes[0]] for row in rows if indexes]
+
+    def geocode(self, names):
+        if self.name == "owid":
+            self.module.prepare_locations(self.lookup_table, names)
+        elif self.name == "ecdc":
+            self.module.prepare_locations(names)
+
+    def format(self, rows, headers, object_name, size: int) -> list:
+        """Formatted rows, or batches for flows formatting them by batches"""
+        module, lookup_table = self.module, self.lookup_table
+        if self.name == "ecdc":
+            plan = module.IngestPlan.compile(headers, object_name, self.bucket_name)
+            return [
+                module.format_block(rows[i : i + size], plan)
+                for i in range(0, len(rows), size)
+            ]
+        indexes = {header: i for i, header in enumerate(headers)}
+        if self.name == "opencovid19":
+            format_row = lambda row: (
+                module.format_row(lookup_table, row, indexes, object_name)
+                if row[1] == "departement"
+                else None
+            )
+        else:
+            format_row = lambda row: module.format_row(
+                lookup_table, row, indexes, object_name
+            )
+        return [row for row in map(format_row, rows) if row is not None]
+
+    def run(self, engine: str, index_name: str, object_name: str, file_path: str):
+        """The flow's own processing of a file, end to end"""
+        self.module.INGEST_ENGINE = engine
+        if self.name == "owid":
+            self.module.process_file(
+                self.lookup_table, index_name, self.bucket_name, object_name
+            )
+        elif self.name == "ecdc":
+            self.module.ParseFiles().run(self.bucket_name, index_name)
+        else:
+            with open(file_path, "r", newline="") as fp:
+                sample = fp.read(self.module.SNIFF_SAMPLE_BYTES)
+                fp.seek(0)
+                self.module.process_file(
+                    self.lookup_table, index_name, sample, fp, object_name
+                )
+
+
+def batches(formatted: list, size: int, batch_type):
+    if len(formatted) and isinstance(formatted[0], batch_type):
+        yield from formatted  # formatted by batches already
+        return
+    for i in range(0, len(formatted), size):
+        yield batch_type.from_rows(formatted[i : i + size])
+
+
+def bench_dataset(name, file_path, endpoint, minio, engines, modules):
+    kind, module_name, bucket_name, supported_engines = datasets[name]
+    module = modules[module_name]
+    object_name = os.path.basename(file_path)
+    index_name = f"bench_{name}"
+    adapter = Adapter(
+        name, module, bucket_name, modules["lookup_table"].get_lookup_table()
+    )
+    minio_source, documents, es_client, dialects = (
+        modules["minio_source"],
+        modules["documents"],
+        modules["es_client"],
+        modules["dialects"],
+    )
+    import clevercsv
+
+    nb_bytes = os.path.getsize(file_path)
+    timings = Timings()
+    sample_size = getattr(module, "SNIFF_SAMPLE_BYTES", 10000)
+    with timings.stage("read"):
+        with minio_source.open_object(minio, bucket_name, object_name, sample_size) as (
+            sample,
+            fp,
+        ):
+            text = fp.read()
+    with timings.stage("sniff"):
+        dialect = clevercsv.Sniffer().sniff(sample, verbose=True)
+    source = f"{bucket_name}/{object_name}"
+    dialects.resolve(source, sample)  # detected once, the flows use the cache
+    with timings.stage("sniff_cached"):
+        dialect, fast = dialects.resolve(source, sample)
+    with timings.stage("parse"):
+        rows = list(clevercsv.reader(io.StringIO(text, newline=""), dialect))
+    if fast:
+        with timings.stage("parse_fast"):
+            fast_rows = list(dialects.reader(io.StringIO(text, newline=""), dialect))
+        assert fast_rows == rows, "the C reader and clevercsv disagree"
+        del fast_rows
+    headers, rows = rows[0], rows[1:]
+    del text
+    names = adapter.location_names(rows, headers)
+    if names is not None:
+        with timings.stage("geocode"):
+            adapter.geocode(names)
+    size = module.MAX_ES_ROW_INJECT
+    Batch = modules["batches"].Batch
+    with timings.stage("format"):
+        formatted = adapter.format(rows, headers, object_name, size)
+    nb_rows = len(rows)
+    nb_documents = sum(
+        len(batch) if isinstance(batch, Batch) else 1 for batch in formatted
+    )
+    del rows
+    serialized_bytes = 0
+    with timings.stage("serialize"):
+        document_ids = documents.DocumentIds(object_name)
+        for batch in batches(formatted, size, Batch):
+            ids = module.rows_ids(batch, document_ids)
+            prepared = es_client.prepare_rows(batch, index_name, ids)
+            serialized_bytes += sum(map(len, prepared.lines(range(len(prepared)))))
+    endpoint.reset()
+    with timings.stage("ship"):
+        document_ids = documents.DocumentIds(object_name)
+        for batch in batches(formatted, size, Batch):
+            module.inject_rows_to_es(batch, index_name, document_ids)
+        es_client.join()
+    result = {
+        "file": {
+            "rows": nb_rows,
+            "bytes": nb_bytes,
+            "delimiter": dialect.delimiter,
+            "fast_reader": fast,
+        },
+        "documents": nb_documents,
+        "serialized_bytes": serialized_bytes,
+        "stages": timings.report(nb_rows, nb_bytes),
+        "bulk": bulk_summary(endpoint.reset()),
+        "end_to_end": {},
+    }
+    del formatted
+
+    if "parquet" in engines and "parquet" in supported_engines:
+        # Converted once, the parquet engine then reads the curated files
+        curated = module.curated
+        with timings.stage("normalize"):
+            manifest = curated.normalize_object(
+                minio, minio.stat_object(bucket_name, object_name), module.layout
+            )
+        result["stages"] = timings.report(nb_rows, nb_bytes)
+        result["curated"] = {
+            "bytes": minio.size(
+                curated.CURATED_BUCKET,
+                curated.curated_prefix(bucket_name, object_name),
+            ),
+            "partitions": len(manifest["partitions"]),
+        }
+
+    for engine in engines:
+        if engine not in supported_engines:
+            continue
+        modules["metrics"].drain()
+        started = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            adapter.run(engine, index_name, object_name, file_path)
+        seconds = time.perf_counter() - started
+        bulk = bulk_summary(endpoint.reset())
+        result["end_to_end"][engine] = {
+            "seconds": seconds,
+            "rows_per_second": nb_rows / seconds,
+            "documents": bulk["documents"],
+            "bulk": bulk,
+            "counters": modules["metrics"].summary()["counters"],
+        }
+    return result
+
+
+def bench_news(endpoint, stand_in, crawler) -> dict:
+    """Crawls the stand-in with the Google News flow's own task"""
+    endpoint.reset()
+    started = time.perf_counter()
+    crawler.GetNews().run("bench_news")
+    seconds = time.perf_counter() - started
+    queries = [end - start for _, start, end in stand_in.requests]
+    bulk = bulk_summary(endpoint.reset())
+    return {
+        "queries": len(queries),
+        "seconds": seconds,
+        "slowest_query_seconds": max(queries, default=0),
+        "queries_total_seconds": sum(queries),
+        "documents": bulk["documents"],
+        "bulk": bulk,
+    }
+
+
+def check_pickling(module_names):
+    """Pickles the flows as registering them does, failing on what can't be
+
+    The scripts are run again under another name: as when registered from
+    `__main__`, their functions and globals are pickled by value.
+    """
+    import cloudpickle
+
+    for module_name in module_names:
+        namespace = runpy.run_path(
+            os.path.join(SCRIPTS_DIR, f"{module_name}.py"), run_name="pickle_check"
+        )
+        cloudpickle.dumps(namespace["flow"])
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=SCRIPTS_DIR,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, results: dict):
+    """Prints how much faster (> 1) or slower (< 1) each measure got"""
+    for name, result in results["datasets"].items():
+        before = baseline.get("datasets", {}).get(name)
+        if before is None:
+            continue
+        measures = [
+            (f"stage {stage}", before["stages"].get(stage), result["stages"][stage])
+            for stage in result["stages"]
+        ] + [
+            (f"engine {engine}", before["end_to_end"].get(engine), run)
+            for engine, run in result["end_to_end"].items()
+        ]
+        for label, old, new in measures:
+            if old is not None and new["seconds"]:
+                speedup = old["seconds"] / new["seconds"]
+                print(f"{name:12} {label:20} x{speedup:.2f}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the ingestion flows offline, writes results as JSON"
+    )
+    parser.add_argument("--datasets", default=",".join(datasets))
+    parser.add_argument("--engines", default="row,columnar,parallel,parquet")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--delimiter", default=",")
+    parser.add_argument("--quote-all", action="store_true")
+    parser.add_argument("--locations", type=int, default=50)
+    parser.add_argument("--known-ratio", type=float, default=0.8)
+    parser.add_argument("--bulk-latency-ms", type=float, default=0)
+    parser.add_argument(
+        "--bulk-ms-per-mb", type=float, default=0, help="bulk latency per MB sent"
+    )
+    parser.add_argument(
+        "--bulk-reject-ratio", type=float, default=0, help="share of 429 answers"
+    )
+    parser.add_argument("--geocode-latency-ms", type=float, default=0)
+    parser.add_argument("--news", action="store_true", help="crawl a news stand-in")
+    parser.add_argument("--news-latency-ms", type=float, default=500)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="previous results to compare with")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="pandemic-knowledge-bench-")
+    endpoint = fakes.FakeBulkEndpoint(
+        latency=args.bulk_latency_ms / 1000,
+        seconds_per_mb=args.bulk_ms_per_mb / 1000,
+        reject_ratio=args.bulk_reject_ratio,
+    ).start()
+    # Read by the flow modules at import
+    os.environ.update(
+        ELASTIC_SCHEME="http",
+        ELASTIC_ENDPOINT="127.0.0.1",
+        ELASTIC_PORT=str(endpoint.port),
+        ELASTIC_USER="bench",
+        ELASTIC_PWD="bench",
+        STATE_DIR=workdir,
+        SPILL_DIR=workdir,
+    )
+    if args.news:
+        stand_in = fakes.FakeGoogleNews(latency=args.news_latency_ms / 1000).start()
+        os.environ["GOOGLE_NEWS_URL"] = stand_in.url
+        os.environ.setdefault("NEWS_HOST_RATE_LIMIT", "100")  # only hits the stand-in
+    os.environ.setdefault(
+        "LOOKUP_TABLE_CSV", os.path.join(SCRIPTS_DIR, "UID_ISO_FIPS_LookUp_Table.csv")
+    )
+    sys.path.insert(0, SCRIPTS_DIR)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("prefect").setLevel(logging.WARNING)
+
+    names = [name for name in args.datasets.split(",") if name]
+    modules = {
+        module_name: importlib.import_module(module_name)
+        for module_name in [
+            "lookup_table",
+            "minio_source",
+            "documents",
+            "es_client",
+            "batches",
+            "metrics",
+            "dialects",
+        ]
+        + [datasets[name][1] for name in names]
+    }
+    check_pickling({datasets[name][1] for name in names})
+    geocoder = fakes.StubGeocoder(latency=args.geocode_latency_ms / 1000)
+    importlib.import_module("geocoding").GEOCODE_RATE_LIMIT = float("inf")
+
+    files, objects = {}, {}
+    for name in names:
+        kind, module_name, bucket_name, _ = datasets[name]
+        files[name] = os.path.join(workdir, f"{name}.csv")
+        synthetic.generate(
+            kind,
+            files[name],
+            args.rows,
+            args.delimiter,
+            args.quote_all,
+            args.locations,
+            args.known_ratio,
+        )
+        objects[(bucket_name, os.path.basename(files[name]))] = files[name]
+        modules[module_name].geocode = geocoder
+    minio = fakes.FakeMinio(objects, os.path.join(workdir, "minio"))
+    for name in names:
+        modules[datasets[name][1]].Minio = minio
+
+    results = {
+        "meta": {
+            "date": datetime.utcnow().isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "datasets": {},
+    }
+    try:
+        for name in names:
+            print(f"Benchmarking {name}...", file=sys.stderr)
+            geocoder.calls = 0
+            results["datasets"][name] = bench_dataset(
+                name, files[name], endpoint, minio, args.engines.split(","), modules
+            )
+            results["datasets"][name]["geocoder_calls"] = geocoder.calls
+        if args.news:
+            print("Benchmarking news crawling...", file=sys.stderr)
+            results["news"] = bench_news(
+                endpoint, stand_in, importlib.import_module("crawl_google_news")
+            )
+    finally:
+        endpoint.stop()
+        if args.news:
+            stand_in.stop()
+        shutil.rmtree(workdir)
+
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            compare(json.load(fp), results)
+
+
+if __name__ == "__main__":
+    main()
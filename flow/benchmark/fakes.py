@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import random
+import shutil
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeBulkEndpoint:
+    """In-process HTTP server answering the Elasticsearch calls of the flows
+
+    Bulk requests are acknowledged after `latency` seconds (plus
+    `seconds_per_mb` per MB of body, as ES indexing them) and recorded
+    (bytes, documents, time spent). A `reject_ratio` share of the documents
+    is rejected with a 429, as by an overloaded cluster. No index exists, mget finds nothing,
+    everything else is acknowledged.
+    """
+
+    def __init__(
+        self, latency: float = 0, seconds_per_mb: float = 0, reject_ratio: float = 0
+    ):
+        self.latency = latency
+        self.seconds_per_mb = seconds_per_mb
+        self.reject_ratio = reject_ratio
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.requests = []
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, body=None, status=200):
+                data = json.dumps(body if body is not None else {}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(data)
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                path = self.path.split("?")[0]
+                if self.command == "HEAD":  # no index nor alias exists
+                    self._reply(status=404)
+                elif path.endswith("/_bulk"):
+                    self._reply(endpoint.bulk(body))
+                elif path.endswith("/_mget"):
+                    ids = json.loads(body).get("ids", [])
+                    self._reply({"docs": [{"_id": id, "found": False} for id in ids]})
+                elif path.endswith("/_mapping") and self.command == "GET":
+                    self._reply({path.split("/")[1]: {"mappings": {}}})
+                elif path == "/":
+                    self._reply({"version": {"number": "7.12.0"}})
+                else:
+                    self._reply({"acknowledged": True})
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def bulk(self, body: bytes) -> dict:
+        started = time.perf_counter()
+        items = []
+        lines = body.splitlines()
+        i = 0
+        while i < len(lines):
+            operation = next(iter(json.loads(lines[i])))
+            if self.random.random() < self.reject_ratio:
+                error = {"type": "es_rejected_execution_exception"}
+                items.append({operation: {"status": 429, "error": error}})
+            else:
+                items.append({operation: {"status": 201, "result": "created"}})
+            i += 1 if operation == "delete" else 2
+        latency = self.latency + self.seconds_per_mb * len(body) / 1e6
+        if latency:
+            time.sleep(latency)
+        with self.lock:
+            self.requests.append(
+                {
+                    "bytes": len(body),
+                    "documents": sum(
+                        "error" not in next(iter(item.values())) for item in items
+                    ),
+                    "seconds": time.perf_counter() - started,
+                }
+            )
+        errors = any("error" in next(iter(item.values())) for item in items)
+        return {"took": 1, "errors": errors, "items": items}
+
+    def reset(self) -> list:
+        """Recorded bulk requests, forgotten afterwards"""
+        with self.lock:
+            requests, self.requests = self.requests, []
+        return requests
+
+
+class StubGeocoder:
+    """Stands for Nominatim: deterministic locations after `latency` seconds"""
+
+    def __init__(self, latency: float = 0, miss_ratio: float = 0):
+        self.latency = latency
+        self.miss_ratio = miss_ratio
+        self.calls = 0
+
+    def __call__(self, location_name: str):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        digest = hashlib.sha1(location_name.encode("utf-8")).digest()
+        if digest[0] / 256 < self.miss_ratio:
+            return None
+        return (
+            {"lat": digest[1] * 180 / 256 - 90, "lon": digest[2] * 360 / 256 - 180},
+            "ZZ",
+        )
+
+
+class FakeObject:
+    def __init__(self, bucket_name: str, object_name: str, file_path: str):
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        stat = os.stat(file_path)
+        self.etag = hashlib.md5(
+            f"{stat.st_size}:{stat.st_mtime_ns}".encode()
+        ).hexdigest()
+
+
+class FakeResponse:
+    def __init__(self, file_path: str):
+        self.fp = open(file_path, "rb")
+
+    def read(self, size: int = -1) -> bytes:
+        return self.fp.read(size)
+
+    def close(self):
+        self.fp.close()
+
+    def release_conn(self):
+        pass
+
+
+class FakeMinio:
+    """The few Minio client methods the flows use, serving local files
+
+    Uploaded objects are written to `directory`.
+    """
+
+    def __init__(self, objects: dict, directory: str):
+        self.objects = objects  # {(bucket_name, object_name): file path}
+        self.directory = directory
+        self.buckets = {bucket for bucket, _ in objects}
+
+    def __call__(self, *args, **kwargs):
+        """Stands for the Minio constructor too"""
+        return self
+
+    def bucket_exists(self, bucket_name: str) -> bool:
+        return bucket_name in self.buckets
+
+    def make_bucket(self, bucket_name: str):
+        self.buckets.add(bucket_name)
+
+    def list_objects(self, bucket_name: str):
+        return [
+            FakeObject(bucket, name, path)
+            for (bucket, name), path in self.objects.items()
+            if bucket == bucket_name
+        ]
+
+    def stat_object(self, bucket_name: str, object_name: str) -> FakeObject:
+        path = self.objects[(bucket_name, object_name)]
+        return FakeObject(bucket_name, object_name, path)
+
+    def get_object(self, bucket_name: str, object_name: str) -> FakeResponse:
+        return FakeResponse(self.objects[(bucket_name, object_name)])
+
+    def fget_object(self, bucket_name: str, object_name: str, file_path: str):
+        shutil.copyfile(self.objects[(bucket_name, object_name)], file_path)
+
+    def fput_object(self, bucket_name: str, object_name: str, file_path: str):
+        path = os.path.join(self.directory, bucket_name, object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(file_path, path)
+        self.objects[(bucket_name, object_name)] = path
+
+    def remove_object(self, bucket_name: str, object_name: str):
+        os.remove(self.objects.pop((bucket_name, object_name)))
+
+    def size(self, bucket_name: str, prefix: str = "") -> int:
+        """Bytes stored in a bucket, under `prefix` if given"""
+        return sum(
+            os.path.getsize(path)
+            for (bucket, name), path in self.objects.items()
+            if bucket == bucket_name and name.startswith(prefix)
+        )
+
+
+class FakeGoogleNews:
+    """Local stand-in for Google News search pages
+
+    Each search returns `nb_news` articles (links derived from the query)
+    after `latency` seconds. Requests are recorded with their start and end
+    times, to check how they overlap.
+    """
+
+    article = (
+        '<div class="NiLAwe y6IFtc R7GTQ keNKEd j7vNaf nID9nc">'
+        '<h3><a href="./articles/{id}">News {id}</a></h3>'
+        "<span>About {query}</span>"
+        '<img src="https://example.org/{id}.jpg">'
+        '<div><a href="#">example.org</a><time datetime="2021-05-01T10:00:00Z">'
+        "2 hours ago</time></div></div>"
+    )
+
+    def __init__(self, latency: float = 0, nb_news: int = 20):
+        self.latency = latency
+        self.nb_news = nb_news
+        self.lock = threading.Lock()
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                started = time.perf_counter()
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                query = hashlib.sha1(self.path.encode("utf-8")).hexdigest()[:8]
+                data = (
+                    "<html><body>"
+                    + "".join(
+                        stand_in.article.format(id=f"{query}-{i}", query=query)
+                        for i in range(stand_in.nb_news)
+                    )
+                    + "</body></html>"
+                ).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                with stand_in.lock:
+                    stand_in.requests.append((self.path, started, time.perf_counter()))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
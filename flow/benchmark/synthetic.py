@@ -0,0 +1,210 @@
+import sys
+import csv
+import random
+import argparse
+from datetime import date, timedelta
+
+# Known to the lookup table, the others have to be geocoded
+COUNTRIES = [
+    "France",
+    "Italy",
+    "Germany",
+    "Spain",
+    "Portugal",
+    "Belgium",
+    "Netherlands",
+    "Switzerland",
+    "Austria",
+    "Poland",
+    "Greece",
+    "Sweden",
+    "Norway",
+    "Denmark",
+    "Finland",
+    "Ireland",
+    "United Kingdom",
+    "Canada",
+    "Mexico",
+    "Brazil",
+    "Argentina",
+    "Chile",
+    "India",
+    "Japan",
+    "China",
+    "Australia",
+    "South Africa",
+    "Egypt",
+    "Morocco",
+    "Turkey",
+]
+COUNTRY_CODES = ["FR", "IT", "DE", "ES", "PT", "BE", "NL", "AT", "PL", "EL", "SE"]
+FIRST_DAY = date(2020, 1, 22)
+
+
+def _locations(nb_locations: int, known_ratio: float) -> list:
+    nb_known = min(len(COUNTRIES), round(nb_locations * known_ratio))
+    return COUNTRIES[:nb_known] + [
+        f"Region {i}" for i in range(nb_locations - nb_known)
+    ]
+
+
+def _count(rng, missing_ratio=0.1):
+    return "" if rng.random() < missing_ratio else str(rng.randint(0, 50000))
+
+
+def owid_rows(nb_rows: int, nb_locations: int, known_ratio: float, rng):
+    """Our World In Data: one row per location and day"""
+    yield [
+        "iso_code",
+        "continent",
+        "location",
+        "date",
+        "total_cases",
+        "new_cases",
+        "new_deaths",
+        "new_vaccinations",
+        "new_tests",
+    ]
+    locations = _locations(nb_locations, known_ratio)
+    for i in range(nb_rows):
+        location = locations[i % len(locations)]
+        day = FIRST_DAY + timedelta(days=i // len(locations))
+        yield [
+            location[:3].upper(),
+            "Europe",
+            location,
+            day.isoformat(),
+            str(i),
+            _count(rng),
+            _count(rng),
+            _count(rng, 0.5),
+            f"{_count(rng, 0.3)}.0" if rng.random() < 0.5 else _count(rng),
+        ]
+
+
+def ecdc_rows(nb_rows: int, nb_locations: int, known_ratio: float, rng):
+    """ECDC vaccination: one row per country, ISO week, target group and vaccine"""
+    yield [
+        "YearWeekISO",
+        "FirstDose",
+        "SecondDose",
+        "NumberDosesReceived",
+        "Region",
+        "population",
+        "ReportingCountry",
+        "TargetGroup",
+        "Vaccine",
+    ]
+    countries = (COUNTRY_CODES * (nb_locations // len(COUNTRY_CODES) + 1))[
+        :nb_locations
+    ]
+    groups = [(group, vaccine) for group in ("ALL", "Age<18") for vaccine in "AB"]
+    for i in range(nb_rows):
+        country = countries[i % len(countries)]
+        group, vaccine = groups[(i // len(countries)) % len(groups)]
+        week = i // (len(countries) * len(groups))
+        day = FIRST_DAY + timedelta(weeks=week)
+        year, number, _ = day.isocalendar()
+        yield [
+            f"{year}-W{number:02d}",
+            _count(rng),
+            _count(rng),
+            _count(rng),
+            country,
+            str(rng.randint(10**5, 10**8)),
+            country,
+            group,
+            vaccine,
+        ]
+
+
+def opencovid19_rows(nb_rows: int, nb_locations: int, known_ratio: float, rng):
+    """OpenCovid19-fr chiffres-cles: several granularities, several sources"""
+    yield [
+        "date",
+        "granularite",
+        "maille_code",
+        "maille_nom",
+        "cas_confirmes",
+        "cas_ehpad",
+        "deces",
+        "deces_ehpad",
+        "reanimation",
+        "hospitalises",
+        "gueris",
+        "depistes",
+        "source_nom",
+        "source_url",
+        "source_type",
+    ]
+    granularities = ["departement"] * 3 + ["region", "pays"]
+    for i in range(nb_rows):
+        granularity = granularities[i % len(granularities)]
+        code = (i // len(granularities)) % nb_locations + 1
+        day = FIRST_DAY + timedelta(days=i // (nb_locations * len(granularities)))
+        yield [
+            day.isoformat(),
+            granularity,
+            f"DEP-{code:02d}" if granularity == "departement" else f"REG-{code:02d}",
+            COUNTRIES[code % len(COUNTRIES)] if rng.random() < known_ratio else "",
+            _count(rng),
+            _count(rng, 0.8),
+            _count(rng),
+            _count(rng, 0.8),
+            _count(rng),
+            _count(rng),
+            _count(rng),
+            _count(rng, 0.5),
+            "Santé publique France",
+            "https://www.santepubliquefrance.fr/",
+            "ministere-sante",
+        ]
+
+
+kinds = {"owid": owid_rows, "ecdc": ecdc_rows, "opencovid19": opencovid19_rows}
+
+
+def generate(
+    kind: str,
+    file_path: str,
+    nb_rows: int,
+    delimiter: str = ",",
+    quote_all: bool = False,
+    nb_locations: int = 50,
+    known_ratio: float = 0.8,
+    seed: int = 0,
+) -> int:
+    """Writes a CSV file shaped like a source, returns its size in bytes"""
+    rng = random.Random(seed)
+    with open(file_path, "w", newline="") as fp:
+        writer = csv.writer(
+            fp,
+            delimiter=delimiter,
+            quoting=csv.QUOTE_ALL if quote_all else csv.QUOTE_MINIMAL,
+        )
+        writer.writerows(kinds[kind](nb_rows, nb_locations, known_ratio, rng))
+        return fp.tell()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates synthetic CSV files")
+    parser.add_argument("kind", choices=list(kinds))
+    parser.add_argument("output")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--delimiter", default=",")
+    parser.add_argument("--quote-all", action="store_true")
+    parser.add_argument("--locations", type=int, default=50)
+    parser.add_argument("--known-ratio", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    size = generate(
+        args.kind,
+        args.output,
+        args.rows,
+        args.delimiter,
+        args.quote_all,
+        args.locations,
+        args.known_ratio,
+        args.seed,
+    )
+    print(f"Wrote {args.rows} rows ({size} bytes) to {args.output}", file=sys.stderr)
@@ -0,0 +1,161 @@
+import json
+import math
+import hashlib
+from itertools import islice, repeat
+from operator import itemgetter
+
+
+class Constant:
+    """Column of a value shared by every document of a batch (e.g. filename)"""
+
+    __slots__ = ("value", "size")
+
+    def __init__(self, value, size: int):
+        self.value = value
+        self.size = size
+
+    def __getitem__(self, i):
+        return self.value
+
+    def __iter__(self):
+        return repeat(self.value, self.size)
+
+    def __len__(self):
+        return self.size
+
+
+def _fragments(encode):
+    """Memoized `encode`, for values repeated across the documents of a batch"""
+    cache, by_id = {}, {}
+
+    def fragment(value) -> str:
+        kind = type(value)
+        if kind is int:
+            return str(value)
+        if kind is float and math.isfinite(value):
+            return repr(value)
+        if value is None:
+            return "null"
+        try:
+            encoded = cache.get((kind, value))
+            if encoded is None:
+                encoded = cache[kind, value] = encode(value)
+        except TypeError:  # unhashable, e.g. locations shared by the documents
+            entry = by_id.get(id(value))
+            if entry is None:
+                entry = by_id[id(value)] = (value, encode(value))
+            encoded = entry[1]
+        return encoded
+
+    return fragment
+
+
+class Batch:
+    """Documents sharing the same fields, stored as columns
+
+    Batches are serialized straight to NDJSON, each distinct value being
+    encoded once per batch, and only the documents to write are. Documents
+    are built as dicts only when asked for (`batch[i]`).
+    """
+
+    __slots__ = ("fields", "columns", "size")
+
+    def __init__(self, columns: dict, size: int):
+        self.fields = list(columns.keys())
+        self.columns = list(columns.values())
+        self.size = size
+
+    @classmethod
+    def from_rows(cls, rows: list):
+        """Batch of dicts having the same keys"""
+        if not len(rows):
+            return cls({}, 0)
+        fields = list(rows[0].keys())
+        if any(len(row) != len(fields) for row in rows):
+            raise ValueError("Documents of a batch must have the same fields")
+        values = map(itemgetter(*fields), rows)
+        if len(fields) == 1:
+            values = ((value,) for value in values)
+        return cls(dict(zip(fields, zip(*values))), len(rows))
+
+    @classmethod
+    def from_columns(cls, columns: dict, size: int):
+        """Batch of columns (lists) and values shared by all documents"""
+        return cls(
+            {
+                field: (
+                    column
+                    if isinstance(column, (list, tuple, Constant))
+                    else Constant(column, size)
+                )
+                for field, column in columns.items()
+            },
+            size,
+        )
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i) -> dict:
+        return {field: column[i] for field, column in zip(self.fields, self.columns)}
+
+    def __iter__(self):
+        return (self[i] for i in range(self.size))
+
+    def column(self, field: str):
+        return self.columns[self.fields.index(field)]
+
+    def _encoded(self, fragment, indexes=None) -> list:
+        """Columns of JSON fragments, of the documents at `indexes` (or all)"""
+        encoded = []
+        for column in self.columns:
+            if isinstance(column, Constant):
+                encoded.append(repeat(fragment(column.value)))
+            elif indexes is None:
+                encoded.append([fragment(value) for value in column])
+            else:
+                encoded.append([fragment(column[i]) for i in indexes])
+        return encoded
+
+    def content_hashes(self) -> list:
+        """documents.content_hash() of each document"""
+        fragment = _fragments(
+            lambda value: json.dumps(value, sort_keys=True, default=str)
+        )
+        order = sorted(range(len(self.fields)), key=lambda i: self.fields[i])
+        template = ", ".join(
+            json.dumps(self.fields[i]).replace("%", "%%") + ": %s" for i in order
+        )
+        template = "{" + template + "}"
+        encoded = self._encoded(fragment)
+        columns = [encoded[i] for i in order]
+        return [
+            hashlib.sha1((template % values).encode("utf-8")).hexdigest()
+            for values in islice(zip(*columns), self.size)
+        ]
+
+    def ndjson(self, serializer, index_name: str, ids: list, hashes: list, indexes):
+        """Bulk request lines (NDJSON bytes) indexing each document at `indexes`"""
+
+        def encode(value) -> str:
+            # The serializer passes strings through, taking them for JSON
+            if isinstance(value, str):
+                return json.dumps(value, ensure_ascii=False)
+            return serializer.dumps(value)
+
+        template = "".join(
+            encode(field).replace("%", "%%") + ":%s," for field in self.fields
+        )
+        template = (
+            '{"index":{"_index":'
+            + encode(index_name).replace("%", "%%")
+            + ',"_id":%s}}\n{'
+            + template
+            + '"content_hash":"%s"}\n'
+        )
+        indexes = list(indexes)
+        encoded = self._encoded(_fragments(encode), indexes)
+        return [
+            (template % (encode(ids[i]), *values, hashes[i])).encode("utf-8")
+            for i, values in zip(indexes, zip(*encoded))
+        ]
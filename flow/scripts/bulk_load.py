@@ -0,0 +1,109 @@
+import os
+import prefect
+from contextlib import contextmanager
+
+import es_client
+import index_generations
+
+ES_BULK_LOAD = os.environ.get("ES_BULK_LOAD") or "rebuild"  # off | rebuild | always
+ES_FORCE_MERGE_SEGMENTS = int(os.environ.get("ES_FORCE_MERGE_SEGMENTS") or 1)
+ES_MAINTENANCE_TIMEOUT = int(os.environ.get("ES_MAINTENANCE_TIMEOUT") or 3600)  # s
+
+logger = prefect.context.get("logger")
+
+# The indexing buffer is a node setting: flushing the translog less often is
+# the closest we can get per index
+BULK_LOAD_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": "0",
+    "index.translog.durability": "async",
+    "index.translog.flush_threshold_size": "1gb",
+}
+
+
+def concrete_indices(es_inst, index_name: str) -> list:
+    if es_inst.indices.exists_alias(name=index_name):
+        return list(es_inst.indices.get_alias(name=index_name))
+    return [index_name]
+
+
+def current_settings(es_inst, index_name: str) -> dict:
+    """Values of BULK_LOAD_SETTINGS an index currently has, defaults included"""
+    settings = es_inst.indices.get_settings(
+        index=index_name,
+        name=list(BULK_LOAD_SETTINGS),
+        include_defaults=True,
+        flat_settings=True,
+    )[index_name]
+    values = {**settings.get("defaults", {}), **settings["settings"]}
+    return {name: values.get(name) for name in BULK_LOAD_SETTINGS}
+
+
+def apply_bulk_profile(es_inst, index_name: str):
+    """Switches an index to BULK_LOAD_SETTINGS, saving its serving settings
+
+    Serving settings are saved in the index `_meta`: a run interrupted before
+    restoring them leaves them for the next run to restore.
+    """
+    if index_generations.get_meta(es_inst, index_name).get("serving_settings") is None:
+        index_generations.update_meta(
+            es_inst, index_name, serving_settings=current_settings(es_inst, index_name)
+        )
+    es_inst.indices.put_settings(index=index_name, body=BULK_LOAD_SETTINGS)
+    logger.info(f"Bulk load profile applied to {index_name}")
+
+
+def restore_serving_settings(es_inst, index_name: str, force_merge: bool):
+    """Restores the settings saved by `apply_bulk_profile`, if any
+
+    The index is then force-merged (if asked) and we wait for it to be green.
+    """
+    saved = index_generations.get_meta(es_inst, index_name).get("serving_settings")
+    if saved is None:
+        return
+    es_inst.indices.put_settings(index=index_name, body=saved)
+    es_inst.indices.refresh(index=index_name)
+    if force_merge:
+        es_inst.indices.forcemerge(
+            index=index_name,
+            max_num_segments=ES_FORCE_MERGE_SEGMENTS,
+            request_timeout=ES_MAINTENANCE_TIMEOUT,
+        )
+    health = es_inst.cluster.health(
+        index=index_name,
+        wait_for_status="green",
+        timeout=f"{ES_MAINTENANCE_TIMEOUT}s",
+        request_timeout=ES_MAINTENANCE_TIMEOUT + 10,
+    )
+    if health["timed_out"]:
+        logger.warning(f"{index_name} is still {health['status']}")
+    index_generations.update_meta(es_inst, index_name, serving_settings=None)
+    logger.info(f"Serving settings restored for {index_name}")
+
+
+@contextmanager
+def bulk_load(index_name: str):
+    """Loads an index with the bulk load profile, restored whatever happens
+
+    With ES_BULK_LOAD=rebuild, only generations being built (not the live
+    index behind an alias) get the profile. Those are force-merged once
+    successfully loaded: no more documents will be written to them.
+    """
+    es_inst = es_client.get_es_instance()
+    building = index_generations.is_generation(index_name)
+    indices = concrete_indices(es_inst, index_name)
+    if ES_BULK_LOAD == "off" or (ES_BULK_LOAD == "rebuild" and not building):
+        for name in indices:  # left by an interrupted run
+            restore_serving_settings(es_inst, name, force_merge=False)
+        yield
+        return
+
+    for name in indices:
+        apply_bulk_profile(es_inst, name)
+    loaded = False
+    try:
+        yield
+        loaded = True
+    finally:
+        for name in indices:
+            restore_serving_settings(es_inst, name, force_merge=building and loaded)
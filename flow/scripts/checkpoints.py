@@ -0,0 +1,53 @@
+import json
+import time
+import sqlite3
+import threading
+
+from state import state_path
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class CheckpointStore:
+    """Progress of incremental crawls and loads (JSON values), persisted in SQLite"""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS checkpoints (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+
+    def get(self, name: str, default=None):
+        with self.lock, self.conn:
+            entry = self.conn.execute(
+                "SELECT value FROM checkpoints WHERE name = ?", (name,)
+            ).fetchone()
+        return json.loads(entry[0]) if entry is not None else default
+
+    def put(self, name: str, value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO checkpoints (name, value, updated_at)
+                VALUES (?, ?, ?)""",
+                (name, json.dumps(value, default=str), time.time()),
+            )
+
+    def delete(self, name: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM checkpoints WHERE name = ?", (name,))
+
+
+def get_store() -> CheckpointStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CheckpointStore(state_path("checkpoints.sqlite"))
+        return _store
@@ -0,0 +1,83 @@
+import csv
+import pandas as pd
+
+import batches
+import metrics
+
+
+def read_csv_chunks(file_path, dialect, chunksize: int):
+    """Reads a CSV file as DataFrames of `chunksize` rows, all cells as str ("" when empty)"""
+    return pd.read_csv(
+        file_path,
+        sep=dialect.delimiter,
+        quotechar=dialect.quotechar or '"',
+        quoting=csv.QUOTE_MINIMAL if dialect.quotechar else csv.QUOTE_NONE,
+        escapechar=dialect.escapechar or None,
+        dtype=str,
+        keep_default_na=False,
+        na_filter=False,
+        chunksize=chunksize,
+    )
+
+
+def resolve_columns(headers: list, columns_allowed: dict) -> dict:
+    """Resolves the `columns_allowed` candidates present in a file, once per file"""
+    return {
+        name: [candidate for candidate in candidates if candidate in headers]
+        for name, candidates in columns_allowed.items()
+    }
+
+
+def pick_nonempty_column(frame, columns: list):
+    """Columnar pick_nonempty_cell(): first non-empty cell among `columns`, NaN if none"""
+    picked = pd.Series(None, index=frame.index, dtype=object)
+    for column in columns:
+        picked = picked.fillna(frame[column].where(frame[column] != ""))
+    return picked
+
+
+def to_counts(column):
+    """Columnar `int(float(cell)) if cell else 0`"""
+    return pd.to_numeric(column, errors="coerce").fillna(0).astype("int64")
+
+
+def map_distinct(column, func):
+    """Applies `func` once per distinct non-empty value of `column`"""
+    return column.map({value: func(value) for value in column.dropna().unique()})
+
+
+def to_datetimes(column, date_normalizer, source=None):
+    """Parses a date column of a source with a dates.DateNormalizer, NaN if invalid"""
+    return pd.Series(
+        date_normalizer.parse_column(column.tolist(), source),
+        index=column.index,
+        dtype=object,
+    )
+
+
+def to_batch(columns: dict, size: int) -> batches.Batch:
+    """Named columns (Series or scalars) as a batch of ready-to-index documents"""
+    return batches.Batch.from_columns(
+        {
+            name: (
+                value.astype(object).where(value.notna(), None).tolist()
+                if isinstance(value, pd.Series)
+                else value
+            )
+            for name, value in columns.items()
+        },
+        size,
+    )
+
+
+def count_rejected(flow: str, invalid: dict):
+    """Counts rows rejected by reason, `invalid` masks by reason in priority order"""
+    remaining = None
+    for reason, mask in invalid.items():
+        if remaining is not None:
+            mask = mask & remaining
+        if mask.any():
+            metrics.inc(
+                "rows_rejected_total", int(mask.sum()), flow=flow, reason=reason
+            )
+        remaining = ~mask if remaining is None else remaining & ~mask
@@ -1,155 +1,202 @@
-# python3
-import os
-from typing import Iterable
-import uuid
-import prefect
-from elasticsearch import Elasticsearch, helpers
-from prefect import Flow, Task, Client
-from datetime import timedelta, datetime
-
-from prefect.schedules import IntervalSchedule
-from GoogleNews import GoogleNews
-
-from crawl_mapping import mapping
-
-
-project_name = "pandemic-knowledge-crawl-googlenews"
-index_name = "news_googlenews"
-
-MAX_ES_ROW_INJECT = int(os.environ.get("MAX_ES_ROW_INJECT", 1000))
-ELASTIC_SCHEME = os.environ.get("ELASTIC_SCHEME")
-ELASTIC_PORT = os.environ.get("ELASTIC_PORT")
-ELASTIC_USER = os.environ.get("ELASTIC_USER")
-ELASTIC_PWD = os.environ.get("ELASTIC_PWD")
-ELASTIC_ENDPOINT = os.environ.get("ELASTIC_ENDPOINT")
-
-logger = prefect.context.get("logger")
-
-schedule = IntervalSchedule(
-    start_date=datetime.utcnow() + timedelta(seconds=1), interval=timedelta(hours=24)
-)
-
-
-def get_es_instance():
-    es_inst = Elasticsearch(
-        [ELASTIC_ENDPOINT],
-        http_auth=(ELASTIC_USER, ELASTIC_PWD),
-        scheme=ELASTIC_SCHEME,
-        port=ELASTIC_PORT,
-        verify_certs=False,
-    )
-    return es_inst
-
-
-def inject_rows_to_es(rows, index_name):
-    es_inst = get_es_instance()
-
-    logger.info("Injecting {} rows in Elasticsearch".format(len(rows)))
-
-    actions = [
-        {"_index": index_name, "_id": uuid.uuid4(), "_source": row} for row in rows
-    ]
-
-    helpers.bulk(es_inst, actions)
-
-
-def format_new(new: dict, lang: str) -> dict:
-    """Formatting a single Google News new for elasticsearch injection"""
-    if len(new):
-        return {
-            "title": str(new["title"]),
-            "desc": str(new["desc"]),
-            "img": str(new["img"]),
-            "link": "https://" + str(new["link"]),
-            "source.crawler": "Google News",
-            "source.website": str(new["site"]),
-            "source.url": str(new["link"]),
-            "date": new["datetime"],
-            "lang": lang,
-        }
-    return None
-
-
-def get_news(googlenews: GoogleNews, lang: str, search_tag: str) -> Iterable:
-    googlenews.get_news(search_tag)
-    news = googlenews.results(sort=True)
-    if news:
-        for new in news:
-            fmt_new = format_new(new, lang)
-            if fmt_new:
-                yield fmt_new
-    return []
-
-
-class GetNews(Task):
-    def run(self, index_name):
-        googlenews = GoogleNews(
-            period="24h",  # TODO(): Improve using googlenews.set_time_range('02/01/2020','02/28/2020')
-            encode="utf-8",
-        )
-        news_to_inject = []
-        langs = ["fr", "en"]
-        search_tags = ["COVID", "CORONA"]
-        for lang in langs:
-            for search_tag in search_tags:
-                logger.info(
-                    f"Crawling GoogleNews for '{lang}' lang and {search_tag} search tag..."
-                )
-                googlenews.set_lang(lang)
-                try:
-                    news = list(get_news(googlenews, lang, search_tag))
-                    news_to_inject += news if len(news) else []
-                    logger.info(f"Found {len(news)} news.")
-                except Exception as e:
-                    logger.error(e)
-                googlenews.clear()
-                if len(news_to_inject) > 0:
-                    inject_rows_to_es(news_to_inject, index_name)
-                    news_to_inject = []
-
-
-class GenerateEsMapping(Task):
-    def __init__(self, index_name, **kwargs):
-        self.index_name = index_name
-        super().__init__(**kwargs)
-
-    def run(self):
-        index_name = self.index_name
-        es_inst = get_es_instance()
-
-        logger.info("Generating mapping for index {}".format(index_name))
-
-        es_inst.indices.delete(index=index_name, ignore=[400, 404])
-
-        response = es_inst.indices.create(index=index_name, body=mapping, ignore=400)
-
-        if "acknowledged" in response:
-            if response["acknowledged"] == True:
-                logger.info(
-                    "INDEX MAPPING SUCCESS FOR INDEX: {}".format(response["index"])
-                )
-            elif "error" in response:
-                logger.error(response["error"]["root_cause"])
-                logger.error("Error type: {}".format(response["error"]["type"]))
-                raise Exception("Unable to create index mapping")
-
-
-with Flow("Crawl news and insert", schedule=schedule) as flow:
-    flow.set_dependencies(
-        upstream_tasks=[GenerateEsMapping(index_name)],
-        task=GetNews(),
-        keyword_tasks=dict(index_name=index_name),
-    )
-
-if __name__ == "__main__":
-    try:
-        client = Client()
-        client.create_project(project_name=project_name)
-    except prefect.utilities.exceptions.ClientError as e:
-        logger.info("Project already exists")
-
-    flow.register(
-        project_name=project_name,
-        labels=["development"],
-        add_default_labels=False,
-    )
+# python3
+import os
+import prefect
+import requests
+import threading
+import urllib.parse
+from prefect import Flow, Task, Client
+from datetime import timedelta, datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from prefect.schedules import IntervalSchedule
+from bs4 import BeautifulSoup
+from GoogleNews import define_date
+
+from crawl_mapping import mapping
+import documents
+import es_client
+import index_generations
+import bulk_load
+import metrics
+import news_dedup
+import geocoding
+import http_source
+
+
+project_name = "pandemic-knowledge-crawl-googlenews"
+index_name = "news_googlenews"
+
+MAX_ES_ROW_INJECT = int(os.environ.get("MAX_ES_ROW_INJECT", 1000))
+GOOGLE_NEWS_URL = os.environ.get("GOOGLE_NEWS_URL") or "https://news.google.com"
+NEWS_LANGS = (os.environ.get("NEWS_LANGS") or "fr,en").split(",")
+NEWS_SEARCH_TAGS = (os.environ.get("NEWS_SEARCH_TAGS") or "COVID,CORONA").split(",")
+NEWS_PERIOD = os.environ.get("NEWS_PERIOD") or "24h"
+NEWS_WORKERS = int(os.environ.get("NEWS_WORKERS") or 8)
+NEWS_HOST_CONCURRENCY = int(os.environ.get("NEWS_HOST_CONCURRENCY") or 2)
+NEWS_HOST_RATE_LIMIT = float(os.environ.get("NEWS_HOST_RATE_LIMIT") or 1)  # req/s
+
+# Those of the GoogleNews package, whose page parsing is reproduced here
+user_agent = (
+    "Mozilla/5.0 (X11; Ubuntu; Linux i686; rv:64.0) Gecko/20100101 Firefox/64.0"
+)
+article_selector = 'div[class="NiLAwe y6IFtc R7GTQ keNKEd j7vNaf nID9nc"]'
+
+logger = prefect.context.get("logger")
+
+schedule = IntervalSchedule(
+    start_date=datetime.utcnow() + timedelta(seconds=1), interval=timedelta(hours=24)
+)
+
+
+def inject_rows_to_es(rows, index_name):
+    ids = [
+        documents.document_id(row["source.crawler"], row["source.url"]) for row in rows
+    ]
+    logger.info("Injecting {} rows in Elasticsearch".format(len(rows)))
+    news_dedup.ship_rows(rows, index_name, ids)
+
+
+def format_new(new: dict, lang: str) -> dict:
+    """Formatting a single Google News new for elasticsearch injection"""
+    if len(new):
+        return {
+            "title": str(new["title"]),
+            "desc": str(new["desc"]),
+            "img": str(new["img"]),
+            "link": "https://" + str(new["link"]),
+            "source.crawler": "Google News",
+            "source.website": str(new["site"]),
+            "source.url": str(new["link"]),
+            "date": new["datetime"],
+            "lang": lang,
+        }
+    return None
+
+
+class HostLimiter:
+    """At most `concurrency` requests at once to a host, `rate` per second"""
+
+    def __init__(self, concurrency: int, rate: float):
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.rate_limiter = geocoding.RateLimiter(rate)
+
+    def get(self, url: str) -> str:
+        with self.slots:
+            self.rate_limiter.wait()
+            # The shared session backs off on 429 and 5xx (Retry-After included)
+            response = http_source.get_session().get(
+                url,
+                headers={"User-Agent": user_agent},
+                timeout=http_source.HTTP_TIMEOUT,
+            )
+        response.raise_for_status()
+        return response.text
+
+
+def search_url(lang: str, search_tag: str) -> str:
+    key = urllib.parse.quote("+".join(search_tag.split(" ")).encode("utf-8"))
+    return f"{GOOGLE_NEWS_URL}/search?q={key}+when:{NEWS_PERIOD}&hl={lang.lower()}"
+
+
+def _text(element):
+    return element.text if element is not None else None
+
+
+def parse_news(page: str) -> list:
+    """News of a Google News search page, as the GoogleNews package reads them"""
+    news = []
+    for article in BeautifulSoup(page, "html.parser").select(article_selector):
+        title, time = article.find("h3"), article.find("time")
+        anchor = title.find("a") if title is not None else None
+        if anchor is None or anchor.get("href") is None:
+            continue
+        image = article.find("img")
+        date = _text(time)
+        news.append(
+            {
+                "title": _text(title),
+                "desc": _text(article.find("span")),
+                "date": date,
+                "datetime": define_date(date) if date is not None else None,
+                "link": "news.google.com/" + anchor.get("href"),
+                "img": image.get("src") if image is not None else None,
+                "site": _text(time.parent.find("a")) if time is not None else None,
+            }
+        )
+    return news
+
+
+def get_news(limiter: HostLimiter, lang: str, search_tag: str) -> list:
+    """Formatted news of a search, the query sharing no state with the others"""
+    with metrics.timer("crawl_seconds", flow=project_name, lang=lang):
+        page = limiter.get(search_url(lang, search_tag))
+    news = [format_new(new, lang) for new in parse_news(page)]
+    return [new for new in news if new]
+
+
+class GetNews(Task):
+    def run(self, index_name):
+        with bulk_load.bulk_load(index_name):
+            limiter = HostLimiter(NEWS_HOST_CONCURRENCY, NEWS_HOST_RATE_LIMIT)
+            queries = [(lang, tag) for lang in NEWS_LANGS for tag in NEWS_SEARCH_TAGS]
+            with ThreadPoolExecutor(
+                max_workers=min(NEWS_WORKERS, len(queries)),
+                thread_name_prefix="news",
+            ) as executor:
+                futures = {
+                    executor.submit(get_news, limiter, lang, tag): (lang, tag)
+                    for lang, tag in queries
+                }
+                # Injected as soon as each query returns
+                for future in as_completed(futures):
+                    lang, search_tag = futures[future]
+                    try:
+                        news = future.result()
+                    except requests.RequestException as e:
+                        logger.error(f"Crawling '{lang}' {search_tag} failed: {e}")
+                        metrics.inc("crawl_errors_total", flow=project_name)
+                        continue
+                    logger.info(f"Found {len(news)} '{lang}' {search_tag} news.")
+                    metrics.inc("rows_read_total", len(news), flow=project_name)
+                    if len(news) > 0:
+                        inject_rows_to_es(news, index_name)
+            es_client.join()
+        return metrics.report(project_name)
+
+
+class GenerateEsMapping(Task):
+    def __init__(self, index_name, **kwargs):
+        self.index_name = index_name
+        super().__init__(**kwargs)
+
+    def run(self):
+        index_name = self.index_name
+        es_inst = es_client.get_es_instance()
+
+        logger.info("Generating mapping for index {}".format(index_name))
+
+        # News accumulate crawl after crawl: never rebuilt, always upserted
+        index_generations.prepare_index(es_inst, index_name, mapping, rebuild=False)
+        # Indices created before news were deduplicated lack the sources fields
+        es_inst.indices.put_mapping(index=index_name, body=mapping["mappings"])
+
+
+with Flow("Crawl news and insert", schedule=schedule) as flow:
+    flow.set_dependencies(
+        upstream_tasks=[GenerateEsMapping(index_name)],
+        task=GetNews(),
+        keyword_tasks=dict(index_name=index_name),
+    )
+
+if __name__ == "__main__":
+    try:
+        client = Client()
+        client.create_project(project_name=project_name)
+    except prefect.utilities.exceptions.ClientError as e:
+        logger.info("Project already exists")
+
+    flow.register(
+        project_name=project_name,
+        labels=["development"],
+        add_default_labels=False,
+    )
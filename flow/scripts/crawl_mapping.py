@@ -18,7 +18,22 @@ mapping = {
                     "tweet": {"properties": {"id": {"type": "text"}}},
                 }
             },
+            "sources": {
+                "properties": {
+                    "crawler": {"type": "text"},
+                    "website": {"type": "text"},
+                    "author": {"type": "text"},
+                    "url": {"type": "text"},
+                    "date": {
+                        "type": "date",
+                        "format": "strict_date_optional_time||epoch_millis",
+                    },
+                    "lang": {"type": "keyword"},
+                }
+            },
+            "sources_count": {"type": "integer"},
             "lang": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+            "content_hash": {"type": "keyword", "index": False},
         }
     }
 }
\ No newline at end of file
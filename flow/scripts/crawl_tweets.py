@@ -1,8 +1,7 @@
 # python3
 import os
-import uuid
+import time
 import prefect
-from elasticsearch import Elasticsearch, helpers
 from prefect import Flow, Task, Client
 from datetime import datetime
 from datetime import timedelta
@@ -11,19 +10,22 @@ from prefect.schedules import IntervalSchedule
 import snscrape.modules.twitter as sntwitter
 
 from crawl_mapping import mapping
+import documents
+import es_client
+import index_generations
+import bulk_load
+import metrics
+import news_dedup
+import checkpoints
 
 project_name = "pandemic-knowledge-crawl-tweets"
 index_name = "news_tweets"
 
 lang = "en"
-tweet_limit = 1000
+search = "covid"
 
 MAX_ES_ROW_INJECT = int(os.environ.get("MAX_ES_ROW_INJECT", 1000))
-ELASTIC_SCHEME = os.environ.get("ELASTIC_SCHEME")
-ELASTIC_PORT = os.environ.get("ELASTIC_PORT")
-ELASTIC_USER = os.environ.get("ELASTIC_USER")
-ELASTIC_PWD = os.environ.get("ELASTIC_PWD")
-ELASTIC_ENDPOINT = os.environ.get("ELASTIC_ENDPOINT")
+TWEETS_TIME_BUDGET = int(os.environ.get("TWEETS_TIME_BUDGET") or 1800)  # s per run
 
 logger = prefect.context.get("logger")
 
@@ -32,58 +34,104 @@ schedule = IntervalSchedule(
 )
 
 
-def get_es_instance():
-    es_inst = Elasticsearch(
-        [ELASTIC_ENDPOINT],
-        http_auth=(ELASTIC_USER, ELASTIC_PWD),
-        scheme=ELASTIC_SCHEME,
-        port=ELASTIC_PORT,
-        verify_certs=False,
-    )
-    return es_inst
-
-
 def inject_rows_to_es(rows, index_name):
-    es_inst = get_es_instance()
-
-    logger.info("Injecting {} rows in Elasticsearch".format(len(rows)))
-
-    actions = [
-        {"_index": index_name, "_id": uuid.uuid4(), "_source": row} for row in rows
+    ids = [
+        documents.document_id(row["source.crawler"], row["source.tweet.id"])
+        for row in rows
     ]
-
-    helpers.bulk(es_inst, actions)
-
-
-class GetTweets(Task):
-    def run(self, index_name):
+    metrics.inc("rows_read_total", len(rows), flow=project_name)
+    logger.info("Injecting {} rows in Elasticsearch".format(len(rows)))
+    news_dedup.ship_rows(rows, index_name, ids, titled=False)
+
+
+def format_tweet(tweet) -> dict:
+    return {
+        "title": f"Tweet from {tweet.username} the {tweet.date}",
+        "desc": tweet.content,
+        "date": tweet.date,
+        "link": tweet.url,
+        "source.crawler": "twitter",
+        "source.website": "https://twitter.com",
+        "source.author": tweet.username,
+        "source.url": tweet.url,
+        "source.tweet.id": tweet.id,
+        "lang": lang,
+    }
+
+
+def window_query(query: str, checkpoint: dict) -> str:
+    """Search for the tweets after `since_id`, up to `max_id` when backfilling"""
+    if checkpoint.get("since_id") is None:  # first run
         tweets_from = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+        query = f"{query} since:{tweets_from}"
+    else:
+        query = f"{query} since_id:{checkpoint['since_id']}"
+    if checkpoint.get("max_id") is not None:
+        query = f"{query} max_id:{checkpoint['max_id']}"
+    return query
+
+
+def crawl(query: str, checkpoint: dict, deadline: float, index_name: str) -> dict:
+    """Injects the tweets matching `query` not crawled yet, returns the checkpoint
+
+    Searches return the newest tweets first. A search cut by the deadline
+    leaves a window (since_id, max_id] to backfill before crawling the tweets
+    newer than the newest seen (newest_id).
+    """
+    checkpoint = dict(checkpoint)
+    while True:
         to_inject = []
+        oldest_id, cut = None, False
         tweets = sntwitter.TwitterSearchScraper(
-            f"covid since:{tweets_from} lang:{lang}"
+            window_query(query, checkpoint)
         ).get_items()
-        for i, tweet in enumerate(tweets):
-            if i > tweet_limit:
+        for tweet in tweets:
+            if time.monotonic() > deadline:
+                cut = True
                 break
-            if i % 100 == 0:
+            if (
+                checkpoint.get("newest_id") is None
+                or tweet.id > checkpoint["newest_id"]
+            ):
+                checkpoint["newest_id"], checkpoint["newest_date"] = (
+                    tweet.id,
+                    tweet.date,
+                )
+            oldest_id = tweet.id
+            to_inject.append(format_tweet(tweet))
+            if len(to_inject) >= MAX_ES_ROW_INJECT:
                 inject_rows_to_es(to_inject, index_name)
                 to_inject = []
-            to_inject.append(
-                {
-                    "title": f"Tweet from {tweet.username} the {tweet.date}",
-                    "desc": tweet.content,
-                    "date": tweet.date,
-                    "link": tweet.url,
-                    "source.crawler": "twitter",
-                    "source.website": "https://twitter.com",
-                    "source.author": tweet.username,
-                    "source.url": tweet.url,
-                    "source.tweet.id": tweet.id,
-                    "lang": lang
-                }
-            )
         if len(to_inject):
             inject_rows_to_es(to_inject, index_name)
+        if cut:
+            if oldest_id is not None:
+                checkpoint["max_id"] = oldest_id - 1
+            logger.warning(f"Time budget spent, '{query}' resumes next run")
+            return checkpoint
+        if checkpoint.get("max_id") is None:  # caught up
+            checkpoint["since_id"] = checkpoint.get("newest_id")
+            return checkpoint
+        # Backfilled, now for the tweets published meanwhile
+        checkpoint["since_id"], checkpoint["max_id"] = checkpoint["newest_id"], None
+
+
+class GetTweets(Task):
+    def run(self, index_name):
+        with bulk_load.bulk_load(index_name):
+            store = checkpoints.get_store()
+            query = f"{search} lang:{lang}"
+            checkpoint_name = f"tweets:{query}"
+            checkpoint = crawl(
+                query,
+                store.get(checkpoint_name, {}),
+                time.monotonic() + TWEETS_TIME_BUDGET,
+                index_name,
+            )
+            es_client.join()
+            # Only once the tweets are indexed
+            store.put(checkpoint_name, checkpoint)
+        return metrics.report(project_name)
 
 
 class GenerateEsMapping(Task):
@@ -93,23 +141,14 @@ class GenerateEsMapping(Task):
 
     def run(self):
         index_name = self.index_name
-        es_inst = get_es_instance()
+        es_inst = es_client.get_es_instance()
 
         logger.info("Generating mapping for index {}".format(index_name))
 
-        es_inst.indices.delete(index=index_name, ignore=[400, 404])
-
-        response = es_inst.indices.create(index=index_name, body=mapping, ignore=400)
-
-        if "acknowledged" in response:
-            if response["acknowledged"] == True:
-                logger.info(
-                    "INDEX MAPPING SUCCESS FOR INDEX: {}".format(response["index"])
-                )
-            elif "error" in response:
-                logger.error(response["error"]["root_cause"])
-                logger.error("Error type: {}".format(response["error"]["type"]))
-                raise Exception("Unable to create index mapping")
+        # News accumulate crawl after crawl: never rebuilt, always upserted
+        index_generations.prepare_index(es_inst, index_name, mapping, rebuild=False)
+        # Indices created before news were deduplicated lack the sources fields
+        es_inst.indices.put_mapping(index=index_name, body=mapping["mappings"])
 
 
 with Flow("Crawl tweets and insert", schedule=schedule) as flow:
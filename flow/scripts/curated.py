@@ -0,0 +1,279 @@
+import os
+import shutil
+import prefect
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import checkpoints
+import columnar
+import dialects
+import metrics
+import minio_source
+
+CURATED_BUCKET = os.environ.get("CURATED_BUCKET") or "curated"
+CURATED_DATE_PARTITION = os.environ.get("CURATED_DATE_PARTITION") or "month"
+CURATED_CHUNK_ROWS = int(os.environ.get("CURATED_CHUNK_ROWS") or 1000000)
+CURATED_ROW_GROUP_ROWS = int(os.environ.get("CURATED_ROW_GROUP_ROWS") or 10000)
+CURATED_READ_THREADS = int(os.environ.get("CURATED_READ_THREADS") or 8)
+# Partitions read by the parquet engine (all if unset)
+PARQUET_SINCE = os.environ.get("PARQUET_SINCE") or None  # period, e.g. 2021-03
+PARQUET_COUNTRIES = (
+    set(os.environ["PARQUET_COUNTRIES"].split(","))  # e.g. FR,DE
+    if os.environ.get("PARQUET_COUNTRIES")
+    else None
+)
+SNIFF_SAMPLE_BYTES = 100000
+
+logger = prefect.context.get("logger")
+
+period_formats = {"year": "%Y", "month": "%Y-%m", "day": "%Y-%m-%d"}
+UNKNOWN = "unknown"  # partition of the rows without date or country
+# Partition keys and source row number added to the rows, apart from the CSV columns
+PERIOD, COUNTRY, ROW = "_period", "_country", "_row"
+# Manifests of another version are converted again
+MANIFEST_VERSION = 2
+
+
+class Layout:
+    """Columns of a flow's CSV files, as typed and partitioned in Parquet
+
+    `columns_allowed` are the flow's, the first present date and location
+    columns partition the files, `counts` columns are stored as numbers and
+    `parse_date(cell, source)` gives the date of a row of a source (None if
+    invalid).
+    """
+
+    def __init__(self, columns_allowed: dict, counts: list, parse_date):
+        self.columns_allowed = columns_allowed
+        self.counts = counts
+        self.parse_date = parse_date
+
+    def typed(self, frame):
+        """A frame of str cells, with its counts columns as numbers (NaN if empty)"""
+        resolved = columnar.resolve_columns(list(frame.columns), self.columns_allowed)
+        for name in self.counts:
+            for column in resolved[name]:
+                numbers = pd.to_numeric(frame[column], errors="coerce")
+                if (numbers.dropna() % 1 == 0).all():
+                    numbers = numbers.astype("Int64")
+                frame[column] = numbers
+        return frame
+
+    def period(self, cell: str, source: str) -> str:
+        date = self.parse_date(cell, source)
+        if date is None:
+            return UNKNOWN
+        return date.strftime(period_formats[CURATED_DATE_PARTITION])
+
+    def partitions(self, frame, source: str):
+        """(period, country) partition keys of each row of a source"""
+        resolved = columnar.resolve_columns(list(frame.columns), self.columns_allowed)
+        dates = columnar.pick_nonempty_column(frame, resolved["date"])
+        periods = columnar.map_distinct(dates, lambda cell: self.period(cell, source))
+        countries = columnar.pick_nonempty_column(frame, resolved["location"])
+        return periods.fillna(UNKNOWN), countries.fillna(UNKNOWN)
+
+
+def curated_prefix(bucket_name: str, object_name: str) -> str:
+    return f"{bucket_name}/{object_name}/"
+
+
+def partition_order(partition: str):
+    """(period, chunk) of a partition, to read the chunks of a period in order"""
+    chunk = partition.rsplit("/part-", 1)[-1].split(".", 1)[0]
+    return period_of(partition) or "", int(chunk) if chunk.isdigit() else 0
+
+
+def period_of(partition: str):
+    """Period of a partition's object name (.../period=.../part-N.parquet)"""
+    for part in partition.split("/"):
+        if part.startswith("period="):
+            return part[len("period=") :]
+    return None
+
+
+def write_partition(frame, path: str):
+    """Writes the rows of a period sorted by country
+
+    Row groups then span a few countries each, their statistics letting
+    readers skip the other countries.
+    """
+    frame = frame.drop(columns=PERIOD).sort_values(COUNTRY, kind="mergesort")
+    table = pa.Table.from_pandas(frame, preserve_index=False).replace_schema_metadata()
+    pq.write_table(
+        table, path, row_group_size=CURATED_ROW_GROUP_ROWS, compression="zstd"
+    )
+
+
+def convert_object(minio_client, bucket_name: str, object_name: str, layout) -> dict:
+    """Converts a CSV object into Parquet files, uploaded to CURATED_BUCKET
+
+    Files are partitioned by period (CURATED_DATE_PARTITION) and, within a
+    file, sorted by country. Returns the manifest of the conversion:
+    the CSV columns and the object names of the files.
+    """
+    source = f"{bucket_name}/{object_name}"
+    output_dir = tempfile.mkdtemp(
+        prefix="pandemic-knowledge-", dir=minio_source.SPILL_DIR
+    )
+    try:
+        with minio_source.spill_object(
+            minio_client, bucket_name, object_name
+        ) as csv_file_path:
+            with open(csv_file_path, "r", newline="") as fp:
+                dialect, _ = dialects.resolve(source, fp.read(SNIFF_SAMPLE_BYTES))
+            columns, nb_rows = None, 0
+            chunks = columnar.read_csv_chunks(
+                csv_file_path, dialect, CURATED_CHUNK_ROWS
+            )
+            for chunk, frame in enumerate(chunks):
+                columns = list(frame.columns)
+                frame = layout.typed(frame)
+                frame[PERIOD], frame[COUNTRY] = layout.partitions(frame, source)
+                frame[ROW] = np.arange(nb_rows, nb_rows + len(frame))
+                nb_rows += len(frame)
+                for period, rows in frame.groupby(PERIOD, sort=True):
+                    directory = os.path.join(output_dir, f"period={period}")
+                    os.makedirs(directory, exist_ok=True)
+                    write_partition(
+                        rows, os.path.join(directory, f"part-{chunk}.parquet")
+                    )
+        if not minio_client.bucket_exists(CURATED_BUCKET):
+            minio_client.make_bucket(CURATED_BUCKET)
+        partitions = []
+        for directory, _, files in os.walk(output_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                partition = curated_prefix(bucket_name, object_name) + os.path.relpath(
+                    path, output_dir
+                ).replace(os.sep, "/")
+                minio_client.fput_object(CURATED_BUCKET, partition, path)
+                metrics.inc(
+                    "curated_bytes_total", os.path.getsize(path), bucket=bucket_name
+                )
+                partitions.append(partition)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    logger.info(
+        f"Converted {source} ({nb_rows} rows) into {len(partitions)} Parquet files"
+    )
+    return {
+        "bucket": bucket_name,
+        "columns": columns or [],
+        "rows": nb_rows,
+        "partitions": sorted(partitions, key=partition_order),
+    }
+
+
+def normalize_object(minio_client, obj, layout) -> dict:
+    """Manifest of an object's Parquet partitions, converted if new or changed"""
+    store = checkpoints.get_store()
+    name = f"curated:{obj.bucket_name}/{obj.object_name}"
+    manifest = store.get(name)
+    if (
+        manifest is not None
+        and manifest.get("etag") == obj.etag
+        and manifest.get("version") == MANIFEST_VERSION
+    ):
+        return manifest
+    with metrics.timer("normalize_seconds", bucket=obj.bucket_name):
+        converted = convert_object(
+            minio_client, obj.bucket_name, obj.object_name, layout
+        )
+    converted["etag"] = obj.etag
+    converted["version"] = MANIFEST_VERSION
+    store.put(name, converted)
+    # Partitions of the previous version that the new one didn't overwrite
+    for partition in (manifest or {}).get("partitions", []):
+        if partition not in converted["partitions"]:
+            minio_client.remove_object(CURATED_BUCKET, partition)
+    return converted
+
+
+def is_selected(partition: str) -> bool:
+    """Whether a partition is from PARQUET_SINCE on (any partition if unset)"""
+    if PARQUET_SINCE is None:
+        return True
+    period = period_of(partition)
+    return period not in (None, UNKNOWN) and period >= PARQUET_SINCE
+
+
+def read_partition(minio_client, partition: str, columns: list):
+    """Columns of a Parquet file, of the row groups with PARQUET_COUNTRIES if set
+
+    Rows are back in the order of the source, as ids depend on it (see
+    documents.DocumentIds).
+    """
+    response = minio_client.get_object(CURATED_BUCKET, partition)
+    try:
+        data = response.read()
+    finally:
+        response.close()
+        response.release_conn()
+    parquet_file = pq.ParquetFile(pa.BufferReader(data))
+    if PARQUET_COUNTRIES is None:
+        frame = parquet_file.read(columns=columns + [ROW]).to_pandas()
+    else:
+        country = parquet_file.schema_arrow.get_field_index(COUNTRY)
+        row_groups = []
+        for i in range(parquet_file.num_row_groups):
+            statistics = parquet_file.metadata.row_group(i).column(country).statistics
+            if any(statistics.min <= c <= statistics.max for c in PARQUET_COUNTRIES):
+                row_groups.append(i)
+        frame = parquet_file.read_row_groups(
+            row_groups, columns=columns + [COUNTRY, ROW]
+        ).to_pandas()
+        frame = frame[frame[COUNTRY].isin(PARQUET_COUNTRIES)]
+    return frame.sort_values(ROW, kind="mergesort")[columns]
+
+
+def read_frames(minio_client, manifest: dict, columns: list, chunksize: int):
+    """Yields DataFrames of `chunksize` rows of an object's Parquet files
+
+    Only `columns` are read, of the partitions from PARQUET_SINCE on and of
+    the PARQUET_COUNTRIES (all if unset). Files are downloaded ahead by
+    CURATED_READ_THREADS. Rows are read period by period, in the order of the
+    source within each period: rows sharing a document key share their date,
+    hence their period.
+    """
+    partitions = sorted(
+        (partition for partition in manifest["partitions"] if is_selected(partition)),
+        key=partition_order,
+    )
+    metrics.inc(
+        "curated_partitions_skipped_total",
+        len(manifest["partitions"]) - len(partitions),
+        bucket=manifest["bucket"],
+    )
+    pending, frames, nb_rows = deque(), [], 0
+    with ThreadPoolExecutor(
+        max_workers=CURATED_READ_THREADS, thread_name_prefix="curated-read"
+    ) as executor:
+        partitions = iter(partitions)
+        while True:
+            while len(pending) < CURATED_READ_THREADS * 2:
+                partition = next(partitions, None)
+                if partition is None:
+                    break
+                pending.append(
+                    executor.submit(read_partition, minio_client, partition, columns)
+                )
+            if not len(pending):
+                break
+            frame = pending.popleft().result()
+            frames.append(frame)
+            nb_rows += len(frame)
+            if nb_rows < chunksize:
+                continue
+            frame = pd.concat(frames, ignore_index=True)
+            end = len(frame) - len(frame) % chunksize
+            for start in range(0, end, chunksize):
+                yield frame.iloc[start : start + chunksize]
+            frames, nb_rows = [frame.iloc[end:]], len(frame) - end
+    if nb_rows:
+        yield pd.concat(frames, ignore_index=True)
@@ -0,0 +1,140 @@
+import re
+import prefect
+from datetime import datetime, timedelta
+
+import metrics
+
+MAX_CACHED_DATES = 100000
+
+logger = prefect.context.get("logger")
+
+iso_week_regex = re.compile(r"(\d{4})-W(\d{2})$")
+
+
+def parse_iso(value: str) -> datetime:
+    """2021-01-31, 2021/01/31 or 2021-01-31T12:00:00"""
+    return datetime.fromisoformat(value.replace("/", "-"))
+
+
+def parse_dmy(value: str) -> datetime:
+    """31/01/2021 or 31-01-2021"""
+    separator = value[2:3]
+    if separator not in ("/", "-") or value[5:6] != separator:
+        raise ValueError(f"Not a dd/mm/yyyy date: {value}")
+    return datetime(int(value[6:10]), int(value[3:5]), int(value[0:2]))
+
+
+def parse_iso_week(value: str) -> datetime:
+    """2021-W04, as the first day of the week"""
+    matches = iso_week_regex.match(value)
+    if matches is None:
+        raise ValueError(f"Not a week: {value}")
+    year, week = matches.groups()
+    return datetime.strptime(f"{year}-W{int(week) - 1}-1", "%Y-W%W-%w")
+
+
+def parse_epoch(value: str) -> datetime:
+    """Seconds (10 digits) or milliseconds (13 digits) since epoch"""
+    if not value.isdigit() or len(value) not in (10, 13):
+        raise ValueError(f"Not a timestamp: {value}")
+    return datetime.utcfromtimestamp(int(value) / (1000 if len(value) == 13 else 1))
+
+
+parsers = {
+    "iso_week": parse_iso_week,
+    "iso": parse_iso,
+    "dmy": parse_dmy,
+    "epoch": parse_epoch,
+}
+
+periods = {"iso_week": timedelta(days=6)}
+
+
+class DateNormalizer:
+    """Parses the dates of a source, with the format its values are using
+
+    The format of each source (e.g. a file name) is inferred from a sample
+    (`infer`) or from the first value parsed, files of a flow may not use the
+    same. Values it does not match are parsed with the other `formats`, then
+    with `fallback` (e.g. dateparser.parse). Results are memoized, dates
+    repeat for every location.
+    """
+
+    def __init__(self, formats=tuple(parsers), fallback=None):
+        self.formats = formats
+        self.fallback = fallback
+        self.inferred = {}  # source: format
+        self.cache = {}  # (source, value): (datetime, format)
+
+    def infer(self, sample, source=None) -> str:
+        """Picks the format most values of `sample` match"""
+        matches = {name: 0 for name in self.formats}
+        for value in sample:
+            for name in self.formats:
+                try:
+                    parsers[name](value)
+                except (ValueError, TypeError, OverflowError):
+                    continue
+                matches[name] += 1
+        best = max(matches, key=matches.get) if len(matches) else None
+        if best is not None and matches[best] > 0:
+            self.inferred[source] = best
+        return self.inferred.get(source)
+
+    def _parse(self, value: str, source):
+        inferred = self.inferred.get(source)
+        if inferred is not None:
+            try:
+                return parsers[inferred](value), inferred
+            except (ValueError, OverflowError):
+                pass
+        for name in self.formats:
+            if name == inferred:
+                continue
+            try:
+                parsed = parsers[name](value)
+            except (ValueError, OverflowError):
+                continue
+            self.inferred.setdefault(source, name)
+            return parsed, name
+        if self.fallback is not None:
+            try:
+                return self.fallback(value), None
+            except Exception as e:
+                logger.error(e)
+        return None, None
+
+    def _parse_cached(self, value, source):
+        if not value or not isinstance(value, str):
+            return None, None
+        try:
+            return self.cache[(source, value)]
+        except KeyError:
+            pass
+        if len(self.cache) >= MAX_CACHED_DATES:
+            self.cache.clear()
+        parsed = self.cache[(source, value)] = self._parse(value, source)
+        metrics.inc(
+            "dates_parsed_total",
+            format=parsed[1] or ("fallback" if parsed[0] is not None else "invalid"),
+        )
+        return parsed
+
+    def parse(self, value, source=None):
+        """datetime of a value, None if it can't be parsed"""
+        return self._parse_cached(value, source)[0]
+
+    def parse_period(self, value, source=None):
+        """(first day, last day) of a value (a week or a day), None if invalid"""
+        parsed, name = self._parse_cached(value, source)
+        if parsed is None:
+            return None
+        return parsed, parsed + periods.get(name, timedelta(0))
+
+    def parse_column(self, values, source=None) -> list:
+        """parse() for a whole column, inferring the format first if unknown"""
+        values = list(values)
+        if source not in self.inferred:
+            sample = [value for value in values[:1000] if isinstance(value, str)]
+            self.infer(sample[:100], source)
+        return [self.parse(value, source) for value in values]
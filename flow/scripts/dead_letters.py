@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import glob
+import prefect
+import itertools
+import threading
+from datetime import datetime
+from minio import Minio
+
+import es_client
+import index_generations
+from state import state_path
+
+MINIO_SCHEME = os.environ.get("MINIO_SCHEME")
+MINIO_ENDPOINT = os.environ.get("MINIO_ENDPOINT")
+MINIO_ACCESS_KEY = os.environ.get("MINIO_ACCESS_KEY")
+MINIO_SECRET_KEY = os.environ.get("MINIO_SECRET_KEY")
+DEAD_LETTER_DIR = os.environ.get("DEAD_LETTER_DIR") or None  # STATE_DIR/dead_letters
+DEAD_LETTER_BUCKET = os.environ.get("DEAD_LETTER_BUCKET") or None  # None: kept local
+
+logger = prefect.context.get("logger")
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def spool_dir() -> str:
+    path = DEAD_LETTER_DIR or state_path("dead_letters")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def to_json(value):
+    # Dates as the index mappings expect them
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def get_minio_client() -> Minio:
+    return Minio(
+        MINIO_ENDPOINT,
+        access_key=MINIO_ACCESS_KEY,
+        secret_key=MINIO_SECRET_KEY,
+        secure=MINIO_SCHEME == "https",
+    )
+
+
+class Spool:
+    """Documents Elasticsearch refused for good, with the reason, as NDJSON
+
+    A file is written per process until `flush`, then uploaded to
+    DEAD_LETTER_BUCKET if set. `replay` ships them again: documents failing
+    again are spooled to a new file, not to one being replayed.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.file = None
+        self.count = 0
+        self.files = itertools.count()  # several files a second (replays)
+
+    def add(self, index_name: str, _id: str, document: dict, status, error):
+        entry = {
+            "index": index_name,
+            "id": _id,
+            "status": status,
+            "error": error,
+            "failed_at": datetime.utcnow().isoformat(),
+            "document": document,
+        }
+        line = json.dumps(entry, ensure_ascii=False, default=to_json) + "\n"
+        with self.lock:
+            if self.file is None:
+                name = "dead-letters-{}-{}-{}.ndjson".format(
+                    datetime.utcnow().strftime("%Y%m%d%H%M%S"),
+                    os.getpid(),
+                    next(self.files),
+                )
+                self.file = open(os.path.join(self.directory, name), "a")
+            self.file.write(line)
+            # Written through: the batch may be checkpointed as acknowledged
+            self.file.flush()
+            self.count += 1
+
+    def flush(self):
+        """Closes the current file, uploaded to DEAD_LETTER_BUCKET if set"""
+        with self.lock:
+            file, count = self.file, self.count
+            self.file, self.count = None, 0
+        if file is None:
+            return
+        file.close()
+        logger.warning(f"{count} document(s) could not be indexed, see {file.name}")
+        if DEAD_LETTER_BUCKET is not None:
+            minio_client = get_minio_client()
+            if not minio_client.bucket_exists(DEAD_LETTER_BUCKET):
+                minio_client.make_bucket(DEAD_LETTER_BUCKET)
+            minio_client.fput_object(
+                DEAD_LETTER_BUCKET, os.path.basename(file.name), file.name
+            )
+            os.remove(file.name)
+
+
+def get_spool() -> Spool:
+    global _spool
+    with _spool_lock:
+        if _spool is None:
+            _spool = Spool(spool_dir())
+        return _spool
+
+
+def replay_entries(lines) -> int:
+    """Ships dead letters (NDJSON lines) again, to the alias of their index
+
+    Those failing again are spooled again. Returns the number of entries.
+    """
+    by_index = {}  # index name: {id: document}
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        index_name = index_generations.alias_of(entry["index"])
+        by_index.setdefault(index_name, {})[entry["id"]] = entry["document"]
+    for index_name, documents in by_index.items():
+        logger.info(f"Replaying {len(documents)} dead letter(s) to {index_name}")
+        es_client.ship_rows(list(documents.values()), index_name, list(documents))
+    es_client.join()
+    return sum(len(documents) for documents in by_index.values())
+
+
+def replay():
+    """Replays every spooled file, local or in DEAD_LETTER_BUCKET, then removes it"""
+    get_spool().flush()
+    replayed = 0
+    for path in sorted(glob.glob(os.path.join(spool_dir(), "dead-letters-*.ndjson"))):
+        with open(path) as fp:
+            replayed += replay_entries(fp)
+        os.remove(path)
+    if DEAD_LETTER_BUCKET is not None:
+        minio_client = get_minio_client()
+        if minio_client.bucket_exists(DEAD_LETTER_BUCKET):
+            # Listed first: those failing again are uploaded while replaying
+            objects = list(
+                minio_client.list_objects(DEAD_LETTER_BUCKET, prefix="dead-letters-")
+            )
+            for obj in objects:
+                response = minio_client.get_object(DEAD_LETTER_BUCKET, obj.object_name)
+                try:
+                    lines = response.read().decode("utf-8").splitlines()
+                finally:
+                    response.close()
+                    response.release_conn()
+                replayed += replay_entries(lines)
+                minio_client.remove_object(DEAD_LETTER_BUCKET, obj.object_name)
+    return replayed
+
+
+if __name__ == "__main__":
+    # python3 dead_letters.py replay
+    if sys.argv[1:] != ["replay"]:
+        sys.exit(f"Usage: python3 {sys.argv[0]} replay")
+    print(f"Replayed {replay()} dead letter(s)")
@@ -0,0 +1,143 @@
+import io
+import csv
+import time
+import hashlib
+import sqlite3
+import threading
+import clevercsv
+from clevercsv.dialect import SimpleDialect
+from itertools import islice
+
+import metrics
+from state import state_path
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def csv_kwargs(dialect) -> dict:
+    """Arguments of the stdlib (C) csv reader for a clevercsv dialect"""
+    return dict(
+        delimiter=dialect.delimiter,
+        quotechar=dialect.quotechar or '"',
+        quoting=csv.QUOTE_MINIMAL if dialect.quotechar else csv.QUOTE_NONE,
+        escapechar=dialect.escapechar or None,
+    )
+
+
+def reader(fp, dialect, fast: bool = True):
+    """Rows of a CSV file, read by the C reader if `fast`, clevercsv otherwise"""
+    if fast:
+        return csv.reader(fp, **csv_kwargs(dialect))
+    return clevercsv.reader(fp, dialect)
+
+
+def header_signature(sample: str) -> str:
+    return hashlib.sha1(sample.split("\n", 1)[0].encode("utf-8")).hexdigest()
+
+
+def _complete_lines(sample: str) -> str:
+    """The sample without its last line, probably cut"""
+    return sample[: sample.rfind("\n") + 1]
+
+
+def is_fast_compatible(sample: str, dialect) -> bool:
+    """Whether the C reader reads the sample just like clevercsv does"""
+    text = _complete_lines(sample)
+    try:
+        fast_rows = list(reader(io.StringIO(text, newline=""), dialect))
+    except csv.Error:
+        return False
+    return fast_rows == list(clevercsv.reader(io.StringIO(text, newline=""), dialect))
+
+
+def is_consistent(sample: str, dialect) -> bool:
+    """Whether all the rows of the sample are as wide as its header"""
+    text = _complete_lines(sample)
+    try:
+        rows = list(islice(reader(io.StringIO(text, newline=""), dialect), 1000))
+    except csv.Error:
+        return False
+    return len(rows) > 0 and all(len(row) == len(rows[0]) for row in rows if row)
+
+
+class DialectStore:
+    """Dialects detected by source and header signature, persisted in SQLite"""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS dialects (
+                    source TEXT NOT NULL,
+                    signature TEXT NOT NULL,
+                    delimiter TEXT NOT NULL,
+                    quotechar TEXT NOT NULL,
+                    escapechar TEXT NOT NULL,
+                    fast INTEGER NOT NULL,
+                    detected_at REAL NOT NULL,
+                    PRIMARY KEY (source, signature)
+                )"""
+            )
+
+    def get(self, source: str, signature: str):
+        """(dialect, fast) known for a source and header, or None"""
+        with self.lock, self.conn:
+            entry = self.conn.execute(
+                """SELECT delimiter, quotechar, escapechar, fast FROM dialects
+                WHERE source = ? AND signature = ?""",
+                (source, signature),
+            ).fetchone()
+        if entry is None:
+            return None
+        delimiter, quotechar, escapechar, fast = entry
+        return SimpleDialect(delimiter, quotechar, escapechar), bool(fast)
+
+    def put(self, source: str, signature: str, dialect, fast: bool):
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO dialects (source, signature, delimiter,
+                    quotechar, escapechar, fast, detected_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    source,
+                    signature,
+                    dialect.delimiter,
+                    dialect.quotechar or "",
+                    dialect.escapechar or "",
+                    int(fast),
+                    time.time(),
+                ),
+            )
+
+
+def get_store() -> DialectStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = DialectStore(state_path("dialects.sqlite"))
+        return _store
+
+
+def resolve(source: str, sample: str) -> tuple:
+    """Dialect of a source's file and whether the C reader can read it
+
+    Sniffing is skipped when the file starts with the same header as last
+    time and the known dialect still reads the sample consistently. Raises
+    like clevercsv's sniffer when the dialect can't be detected.
+    """
+    store = get_store()
+    signature = header_signature(sample)
+    known = store.get(source, signature)
+    if known is not None and is_consistent(sample, known[0]):
+        metrics.inc("dialect_cache_total", result="hit")
+        return known
+    metrics.inc("dialect_cache_total", result="miss")
+    dialect = clevercsv.Sniffer().sniff(sample, verbose=True)
+    if dialect is None:
+        raise clevercsv.Error(f"Could not determine the dialect of {source}")
+    fast = is_fast_compatible(sample, dialect)
+    store.put(source, signature, dialect, fast)
+    return dialect, fast
@@ -0,0 +1,48 @@
+import json
+import hashlib
+
+
+def document_id(*key) -> str:
+    """Stable elasticsearch document id derived from a natural key"""
+    return hashlib.sha1(
+        "\x1f".join(str(part) for part in key).encode("utf-8")
+    ).hexdigest()
+
+
+def content_hash(document: dict) -> str:
+    """Hash of a document content, independent from its keys order"""
+    return hashlib.sha1(
+        json.dumps(document, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class DocumentIds:
+    """Stable ids for the rows of a file
+
+    Sources may repeat a natural key (e.g. one row per vaccine for the same
+    country and week): repeated keys get their occurrence number appended so
+    ids stay distinct, and stable as long as the file keeps its rows order.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.occurrences = {}
+
+    def __call__(self, *key) -> str:
+        occurrence = self.occurrences.get(key, 0)
+        self.occurrences[key] = occurrence + 1
+        return document_id(self.source, *key, occurrence)
+
+
+def stored_hashes(es_inst, index_name: str, ids: list) -> dict:
+    """Content hashes of the documents already indexed, by id"""
+    if not len(ids):
+        return {}
+    existing = es_inst.mget(
+        index=index_name, body={"ids": ids}, _source_includes="content_hash"
+    )
+    return {
+        doc["_id"]: doc["_source"].get("content_hash")
+        for doc in existing["docs"]
+        if doc.get("found")
+    }
@@ -0,0 +1,463 @@
+import os
+import time
+import random
+import prefect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch, TransportError
+
+import batches
+import dead_letters
+import documents
+import index_generations
+import metrics
+
+ELASTIC_SCHEME = os.environ.get("ELASTIC_SCHEME")
+ELASTIC_PORT = os.environ.get("ELASTIC_PORT")
+ELASTIC_USER = os.environ.get("ELASTIC_USER")
+ELASTIC_PWD = os.environ.get("ELASTIC_PWD")
+ELASTIC_ENDPOINT = os.environ.get("ELASTIC_ENDPOINT")
+ES_WRITE_MODE = os.environ.get("ES_WRITE_MODE") or "upsert"  # upsert | rebuild
+ES_BULK_THREADS = int(os.environ.get("ES_BULK_THREADS") or 4)
+ES_BULK_MAX_IN_FLIGHT = int(os.environ.get("ES_BULK_MAX_IN_FLIGHT") or 8)
+# Bounds of the bulk requests, sized at runtime (see BulkController)
+ES_BULK_MAX_BYTES = int(os.environ.get("ES_BULK_MAX_BYTES") or 10 * 2**20)
+ES_BULK_MIN_DOCS = int(os.environ.get("ES_BULK_MIN_DOCS") or 100)
+ES_BULK_MAX_DOCS = int(os.environ.get("ES_BULK_MAX_DOCS") or 5000)
+ES_BULK_TARGET_SECONDS = float(os.environ.get("ES_BULK_TARGET_SECONDS") or 2)
+# Documents rejected with RETRY_STATUSES are sent again up to ES_BULK_RETRIES
+# times, after a random delay of up to ES_BULK_BACKOFF_SECONDS, doubling
+ES_BULK_RETRIES = int(os.environ.get("ES_BULK_RETRIES") or 5)
+ES_BULK_BACKOFF_SECONDS = float(os.environ.get("ES_BULK_BACKOFF_SECONDS") or 1)
+ES_BULK_MAX_BACKOFF_SECONDS = float(os.environ.get("ES_BULK_MAX_BACKOFF_SECONDS") or 60)
+
+RETRY_STATUSES = (429, 502, 503, 504, "N/A")  # N/A: connection errors
+
+logger = prefect.context.get("logger")
+
+_lock = threading.Lock()
+_es_inst = None
+_shipper = None
+_controller = None
+_pid = None
+_write_listeners = []
+
+
+def _reset_after_fork():
+    """Clients and threads are not inherited by forked workers"""
+    global _es_inst, _shipper, _controller, _pid
+    if _pid != os.getpid():
+        _es_inst, _shipper, _controller, _pid = None, None, None, os.getpid()
+
+
+def get_es_instance() -> Elasticsearch:
+    """Process-wide client, keeping one pool of keep-alive connections"""
+    global _es_inst
+    with _lock:
+        _reset_after_fork()
+        if _es_inst is None:
+            _es_inst = Elasticsearch(
+                [ELASTIC_ENDPOINT],
+                http_auth=(ELASTIC_USER, ELASTIC_PWD),
+                scheme=ELASTIC_SCHEME,
+                port=ELASTIC_PORT,
+                verify_certs=False,
+                maxsize=ES_BULK_THREADS + 1,
+            )
+        return _es_inst
+
+
+class BulkShipper:
+    """Ships bulk requests from a thread pool
+
+    At most `max_in_flight` requests are pending at once: `submit` blocks the
+    caller beyond that. A failed request is raised by the next `submit` or by
+    `join`.
+    """
+
+    def __init__(self, threads: int, max_in_flight: int):
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="es-bulk"
+        )
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.futures = []
+
+    def _raise_failures(self, wait: bool):
+        while len(self.futures) and (wait or self.futures[0].done()):
+            self.futures.pop(0).result()
+
+    def submit(self, func, *args):
+        self._raise_failures(wait=False)
+        self.in_flight.acquire()
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self.in_flight.release()
+            raise
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+
+    def join(self):
+        """Waits for every pending request, raising the first failure
+
+        The others are logged, and none is left for the next `submit` or
+        `join` in any case.
+        """
+        futures, self.futures = self.futures, []
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        for error in errors[1:]:
+            logger.error(f"Bulk request failed too: {error!r}")
+        if len(errors):
+            raise errors[0]
+
+
+def get_bulk_shipper() -> BulkShipper:
+    global _shipper
+    with _lock:
+        _reset_after_fork()
+        if _shipper is None:
+            _shipper = BulkShipper(ES_BULK_THREADS, ES_BULK_MAX_IN_FLIGHT)
+        return _shipper
+
+
+class BulkController:
+    """Size and concurrency of the bulk requests, adapted to how ES copes
+
+    Requests hold at most `docs` documents and `max_bytes` bytes, and at
+    most `concurrency` of them are sent at once. Both are cut when ES rejects
+    documents (429, by half) or answers slower than `target_seconds` (by a
+    quarter, or one request less once at `min_docs`), and grow back a step
+    after each request fast enough, up to `max_docs` and `max_concurrency`.
+    Requests sent before a cut don't cut again.
+    """
+
+    def __init__(
+        self,
+        min_docs: int,
+        max_docs: int,
+        max_bytes: int,
+        max_concurrency: int,
+        target_seconds: float,
+    ):
+        self.condition = threading.Condition()
+        self.min_docs = max(1, min_docs)
+        self.max_docs = max(self.min_docs, max_docs)
+        self.max_bytes = max_bytes
+        self.max_concurrency = max(1, max_concurrency)
+        self.target_seconds = target_seconds
+        self.docs = self.max_docs
+        self.concurrency = self.max_concurrency
+        self.running = 0
+        self.successes = 0  # fast requests since concurrency last changed
+        self.cut_at = 0.0
+
+    def chunks(self, lines: list):
+        """(start, end) slices of the lines of a batch, one request each"""
+        start, size = 0, 0
+        for i, line in enumerate(lines):
+            if i > start and (
+                i - start >= self.docs or size + len(line) > self.max_bytes
+            ):
+                yield start, i
+                start, size = i, 0
+            size += len(line)
+        if start < len(lines):
+            yield start, len(lines)
+
+    def acquire(self) -> float:
+        """Waits for a request to be allowed, returns when it started"""
+        with self.condition:
+            while self.running >= self.concurrency:
+                self.condition.wait()
+            self.running += 1
+        return time.perf_counter()
+
+    def release(self, started: float, rejected: bool = False, failed: bool = False):
+        """Adapts the limits to how the request started at `started` went"""
+        seconds = time.perf_counter() - started
+        with self.condition:
+            self.running -= 1
+            if rejected:
+                self._cut(
+                    started, max(self.min_docs, self.docs // 2), self.concurrency // 2
+                )
+            elif failed:
+                pass
+            elif seconds > self.target_seconds:
+                if self.docs > self.min_docs:
+                    self._cut(
+                        started,
+                        max(self.min_docs, self.docs * 3 // 4),
+                        self.concurrency,
+                        "slow",
+                    )
+                else:
+                    self._cut(started, self.docs, self.concurrency - 1, "slow")
+            else:
+                self.successes += 1
+                concurrency = self.concurrency
+                if self.successes >= self.concurrency:
+                    concurrency = min(self.max_concurrency, concurrency + 1)
+                self._set(
+                    min(self.max_docs, self.docs + self.min_docs),
+                    concurrency,
+                    "up",
+                    "fast",
+                )
+            self.condition.notify_all()
+
+    def _cut(self, started: float, docs: int, concurrency: int, reason="rejected"):
+        if started < self.cut_at:
+            return
+        self.cut_at = time.perf_counter()
+        self._set(docs, max(1, concurrency), "down", reason)
+
+    def _set(self, docs: int, concurrency: int, direction: str, reason: str):
+        if docs != self.docs:
+            metrics.inc(
+                "es_bulk_adjustments_total",
+                direction=direction,
+                reason=reason,
+                limit="documents",
+            )
+        if concurrency != self.concurrency:
+            self.successes = 0
+            metrics.inc(
+                "es_bulk_adjustments_total",
+                direction=direction,
+                reason=reason,
+                limit="concurrency",
+            )
+        if (docs, concurrency) != (self.docs, self.concurrency):
+            log = logger.info if direction == "down" else logger.debug
+            log(
+                f"Bulk requests of {docs} documents at most, {concurrency} at once "
+                f"(ES {reason})"
+            )
+        self.docs, self.concurrency = docs, concurrency
+
+
+def get_bulk_controller() -> BulkController:
+    global _controller
+    with _lock:
+        _reset_after_fork()
+        if _controller is None:
+            _controller = BulkController(
+                ES_BULK_MIN_DOCS,
+                ES_BULK_MAX_DOCS,
+                ES_BULK_MAX_BYTES,
+                ES_BULK_THREADS,
+                ES_BULK_TARGET_SECONDS,
+            )
+        return _controller
+
+
+class BulkBatch:
+    """Documents of an index to ship, with their ids and content hashes"""
+
+    __slots__ = ("index_name", "ids", "hashes", "documents")
+
+    def __init__(self, index_name: str, ids: list, hashes: list, documents):
+        self.index_name = index_name
+        self.ids = ids
+        self.hashes = hashes
+        self.documents = documents  # batches.Batch, or list of dicts
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lines(self, indexes) -> list:
+        """Bulk request lines (NDJSON bytes) indexing each document at `indexes`"""
+        serializer = get_es_instance().transport.serializer
+        if isinstance(self.documents, batches.Batch):
+            return self.documents.ndjson(
+                serializer, self.index_name, self.ids, self.hashes, indexes
+            )
+        lines = []
+        for i in indexes:
+            action = {"index": {"_index": self.index_name, "_id": self.ids[i]}}
+            source = dict(self.documents[i], content_hash=self.hashes[i])
+            lines.append(
+                f"{serializer.dumps(action)}\n{serializer.dumps(source)}\n".encode(
+                    "utf-8"
+                )
+            )
+        return lines
+
+
+def prepare_rows(rows, index_name: str, ids: list) -> BulkBatch:
+    """Hashes rows (a batches.Batch or dicts) for `ship_batch`
+
+    Documents are serialized by the shipping threads, only those to write.
+    """
+    if isinstance(rows, batches.Batch):
+        hashes = rows.content_hashes()
+    else:
+        hashes = [documents.content_hash(row) for row in rows]
+    return BulkBatch(index_name, ids, hashes, rows)
+
+
+def _backoff(attempt: int):
+    """Sleeps before a retry, "full jitter" so that threads don't retry at once"""
+    delay = min(ES_BULK_MAX_BACKOFF_SECONDS, ES_BULK_BACKOFF_SECONDS * 2**attempt)
+    time.sleep(random.uniform(0, delay))
+
+
+def _send(lines: list, index_label: str) -> list:
+    """Results of a bulk request (one per document), told to the controller"""
+    controller = get_bulk_controller()
+    payload = b"".join(lines)
+    metrics.observe("es_bulk_bytes", len(payload), index=index_label)
+    metrics.observe("es_bulk_documents", len(lines), index=index_label)
+    started = controller.acquire()
+    try:
+        with metrics.timer("es_bulk_seconds", index=index_label):
+            response = get_es_instance().bulk(body=payload)
+    except Exception as e:
+        # 429: the whole request was rejected, ES is overloaded
+        rejected = isinstance(e, TransportError) and e.status_code == 429
+        controller.release(started, rejected, failed=True)
+        raise
+    results = [next(iter(item.values())) for item in response["items"]]
+    controller.release(
+        started,
+        rejected=any(
+            result.get("status") == 429 for result in results if "error" in result
+        ),
+    )
+    return results
+
+
+def _dead_letter(batch: BulkBatch, i: int, status, error):
+    metrics.inc(
+        "es_documents_total",
+        index=index_generations.alias_of(batch.index_name),
+        result="rejected",
+        status=status,
+    )
+    dead_letters.get_spool().add(
+        batch.index_name, batch.ids[i], batch.documents[i], status, error
+    )
+
+
+def _bulk_request(batch: BulkBatch, indexes: list, lines: list) -> list:
+    """Sends the documents at `indexes` of a batch, serialized as `lines`
+
+    Documents rejected for a transient reason are retried, backing off, and
+    requests too large for ES are split. Documents failing for good are
+    dead-lettered (see dead_letters) rather than failing the whole run.
+    Returns the indexes of the documents indexed.
+    """
+    index_label = index_generations.alias_of(batch.index_name)
+    pending = list(range(len(indexes)))  # positions in indexes and lines
+    indexed = []
+    split = []  # indexed by the requests it was split into, counted by them
+    attempt = 0
+    while len(pending):
+        if attempt:
+            metrics.inc("es_bulk_retries_total", len(pending), index=index_label)
+            _backoff(attempt - 1)
+        try:
+            results = _send([lines[p] for p in pending], index_label)
+        except TransportError as e:
+            if e.status_code == 413 and len(pending) > 1:
+                half = len(pending) // 2
+                for part in (pending[:half], pending[half:]):
+                    split += _bulk_request(
+                        batch, [indexes[p] for p in part], [lines[p] for p in part]
+                    )
+                break
+            if e.status_code == 413:
+                _dead_letter(batch, indexes[pending[0]], 413, str(e.error))
+                break
+            if e.status_code in RETRY_STATUSES and attempt < ES_BULK_RETRIES:
+                attempt += 1
+                continue
+            raise
+        retried = []
+        for p, result in zip(pending, results):
+            if "error" not in result:
+                indexed.append(indexes[p])
+            elif result.get("status") in RETRY_STATUSES and attempt < ES_BULK_RETRIES:
+                retried.append(p)
+            else:
+                _dead_letter(batch, indexes[p], result.get("status"), result["error"])
+        pending = retried
+        attempt += 1
+    metrics.inc("es_documents_total", len(indexed), index=index_label, result="indexed")
+    for listener in _write_listeners:
+        listener(batch.index_name, [batch.documents[i] for i in indexed])
+    return indexed + split
+
+
+def _bulk_batch(batch: BulkBatch, on_done=None):
+    es_inst = get_es_instance()
+    index_name = batch.index_name
+    if ES_WRITE_MODE == "upsert":
+        stored = documents.stored_hashes(es_inst, index_name, batch.ids)
+        written = [
+            i for i, _id in enumerate(batch.ids) if stored.get(_id) != batch.hashes[i]
+        ]
+    else:
+        written = range(len(batch))
+    metrics.inc(
+        "es_documents_total",
+        len(batch) - len(written),
+        index=index_generations.alias_of(index_name),
+        result="unchanged",
+    )
+    indexed = sorted(set(range(len(batch))) - set(written))  # unchanged
+    if len(written):
+        lines = batch.lines(written)
+        # Requests are cut as the batch is sent, following the current limits
+        for start, end in get_bulk_controller().chunks(lines):
+            indexed += _bulk_request(batch, list(written[start:end]), lines[start:end])
+    logger.info(
+        "Injected {} rows in {} ({} unchanged)".format(
+            len(written), index_name, len(batch) - len(written)
+        )
+    )
+    if on_done is not None:
+        on_done([batch.ids[i] for i in indexed])
+
+
+def _bulk_rows(rows, index_name: str, ids: list):
+    _bulk_batch(prepare_rows(rows, index_name, ids))
+
+
+def on_write(listener):
+    """Calls `listener(index_name, documents)` after each successful bulk request
+
+    Only the documents actually written are passed (not the unchanged
+    ones), from the shipping threads.
+    """
+    _write_listeners.append(listener)
+
+
+def ship_rows(rows, index_name: str, ids: list):
+    """Queues rows (dicts or a batches.Batch) for injection, see `join` to wait"""
+    get_bulk_shipper().submit(_bulk_rows, rows, index_name, ids)
+
+
+def ship_batch(batch: BulkBatch, on_done=None):
+    """Queues rows hashed by `prepare_rows`, see `join` to wait for them
+
+    `on_done(ids)` is called once they are all indexed or dead-lettered,
+    with the ids of those now in ES (indexed, or unchanged when upserting).
+    """
+    if len(batch):
+        get_bulk_shipper().submit(_bulk_batch, batch, on_done)
+    elif on_done is not None:
+        on_done([])
+
+
+def join():
+    """Waits for every queued bulk request, raising the first failure
+
+    Documents that could not be indexed are then in the dead letter spool.
+    """
+    try:
+        get_bulk_shipper().join()
+    finally:
+        dead_letters.get_spool().flush()
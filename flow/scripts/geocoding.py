@@ -0,0 +1,250 @@
+import os
+import time
+import prefect
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from geopy.geocoders import Nominatim
+
+import metrics
+import dialects
+from state import state_path
+
+NOMINATIM_DOMAIN = os.environ.get("NOMINATIM_DOMAIN") or ("nominatim.openstreetmap.org")
+NOMINATIM_SCHEME = os.environ.get("NOMINATIM_SCHEME") or "https"
+GEOCODE_RATE_LIMIT = float(os.environ.get("GEOCODE_RATE_LIMIT") or 1)  # requests/s
+GEOCODE_WORKERS = int(os.environ.get("GEOCODE_WORKERS") or 4)
+GEOCODE_NEGATIVE_TTL = float(os.environ.get("GEOCODE_NEGATIVE_TTL") or 604800)  # s
+
+logger = prefect.context.get("logger")
+
+_store = None
+_store_lock = threading.Lock()
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+class GeocodeStore:
+    """Geocoding results persisted in SQLite
+
+    Found locations are kept forever, failures ("negative" entries) only for
+    `negative_ttl` seconds so they get another chance. Entries count how many
+    times they were used.
+    """
+
+    def __init__(self, path: str, negative_ttl: float = GEOCODE_NEGATIVE_TTL):
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS geocodes (
+                    name TEXT PRIMARY KEY,
+                    lat REAL,
+                    lon REAL,
+                    iso_code2 TEXT,
+                    resolved_at REAL NOT NULL,
+                    uses INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+
+    def get_many(self, names: list) -> dict:
+        """Known locations ((location, iso_code2), or None if not found) by name"""
+        found = {}
+        now = time.time()
+        with self.lock, self.conn:
+            for name in names:
+                entry = self.conn.execute(
+                    """SELECT lat, lon, iso_code2, resolved_at FROM geocodes
+                    WHERE name = ?""",
+                    (name,),
+                ).fetchone()
+                if entry is None:
+                    continue
+                lat, lon, iso_code2, resolved_at = entry
+                if iso_code2 is None and now - resolved_at > self.negative_ttl:
+                    continue
+                found[name] = (
+                    ({"lat": lat, "lon": lon}, iso_code2)
+                    if iso_code2 is not None
+                    else None
+                )
+                self.conn.execute(
+                    "UPDATE geocodes SET uses = uses + 1 WHERE name = ?", (name,)
+                )
+        return found
+
+    def put(self, name: str, location):
+        lat, lon, iso_code2 = (
+            (location[0]["lat"], location[0]["lon"], location[1])
+            if location is not None
+            else (None, None, None)
+        )
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT INTO geocodes (name, lat, lon, iso_code2, resolved_at, uses)
+                VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT(name) DO UPDATE SET lat = excluded.lat,
+                    lon = excluded.lon, iso_code2 = excluded.iso_code2,
+                    resolved_at = excluded.resolved_at, uses = uses + 1""",
+                (name, lat, lon, iso_code2, time.time()),
+            )
+
+
+def get_store() -> GeocodeStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = GeocodeStore(state_path("geocodes.sqlite"))
+        return _store
+
+
+class RateLimiter:
+    """Spaces calls by at least 1 / `rate` seconds, whatever the calling thread"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Process-wide limiter: concurrent callers share GEOCODE_RATE_LIMIT"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(GEOCODE_RATE_LIMIT)
+        return _rate_limiter
+
+
+_geolocator = None
+
+
+def nominatim_geocode(location_name: str):
+    """(location, iso_code2) of a place name, None if Nominatim can't tell"""
+    global _geolocator
+    if _geolocator is None:
+        _geolocator = Nominatim(
+            user_agent="pandemic-knowledge",
+            domain=NOMINATIM_DOMAIN,
+            scheme=NOMINATIM_SCHEME,
+        )
+    location = _geolocator.geocode(location_name, addressdetails=True)
+    if location and "country_code" in location.raw.get("address", {}):
+        return (
+            {"lat": location.latitude, "lon": location.longitude},
+            location.raw["address"]["country_code"].upper(),
+        )
+    return None
+
+
+def resolve_locations(names, geocode=nominatim_geocode, store=None) -> dict:
+    """Geocodes distinct location names, from the store or concurrently
+
+    Names missing from the store are geocoded by GEOCODE_WORKERS threads
+    without exceeding GEOCODE_RATE_LIMIT requests per second, shared with
+    the other calls running at once in the process. Names that
+    could not be geocoded because of an error are left out (and not stored).
+    """
+    store = store or get_store()
+    names = list(set(names))
+    locations = store.get_many(names)
+    missing = [name for name in names if name not in locations]
+    metrics.inc("geocode_lookups_total", len(locations), source="store")
+    metrics.inc("geocode_lookups_total", len(missing), source="geocoder")
+    if not len(missing):
+        return locations
+
+    logger.info(f"Geocoding {len(missing)} locations...")
+    rate_limiter = get_rate_limiter()
+
+    def resolve(name):
+        rate_limiter.wait()
+        try:
+            with metrics.timer("geocode_request_seconds"):
+                location = geocode(name)
+        except Exception as e:
+            logger.error(f"Failed to geocode {name}: {e}")
+            metrics.inc("geocode_requests_total", result="error")
+            return
+        metrics.inc(
+            "geocode_requests_total",
+            result="found" if location is not None else "not_found",
+        )
+        if location is None:
+            logger.error(
+                f"Failed to locate (no country code and/or coordinates) {name}"
+            )
+        store.put(name, location)
+        locations[name] = location
+
+    with ThreadPoolExecutor(max_workers=GEOCODE_WORKERS) as executor:
+        list(executor.map(resolve, missing))
+    return locations
+
+
+class LocationCache(dict):
+    """Locations by name ((location, iso_code2), None if not found) of a flow
+
+    `resolve` is safe from concurrent threads (e.g. several format workers):
+    a name being geocoded by one of them is waited for by the others.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lock = threading.Lock()
+        self.pending = {}  # name: Event set once it is in the cache
+
+    def __reduce__(self):
+        # Flows are pickled to be registered, the lock and events can't be:
+        # a copy gets its own, without the locations still being geocoded
+        return LocationCache, (dict(self),)
+
+    def resolve(self, names, geocode=nominatim_geocode):
+        """Geocodes at once the names not cached yet, cached as None if not found"""
+        owned, waited = [], []
+        with self.lock:
+            for name in set(names):
+                if name in self:
+                    continue
+                if name in self.pending:
+                    waited.append(self.pending[name])
+                else:
+                    self.pending[name] = threading.Event()
+                    owned.append(name)
+        try:
+            if len(owned):
+                locations = resolve_locations(owned, geocode)
+                for name in owned:
+                    self[name] = locations.get(name)
+        finally:
+            with self.lock:
+                for name in owned:
+                    # Locations that failed to resolve are retried on next run only
+                    self.setdefault(name, None)
+                    self.pending.pop(name).set()
+        for event in waited:
+            event.wait()
+
+
+def distinct_values(csv_file_path: str, dialect, columns: list) -> set:
+    """Distinct non-empty values of some columns of a CSV file"""
+    values = set()
+    with open(csv_file_path, "r", newline="") as fp:
+        reader = dialects.reader(fp, dialect)
+        headers = next(reader, [])
+        indexes = [headers.index(column) for column in columns if column in headers]
+        for row in reader:
+            for index in indexes:
+                if index < len(row) and row[index]:
+                    values.add(row[index])
+    return values
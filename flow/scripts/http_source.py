@@ -0,0 +1,188 @@
+import io
+import os
+import time
+import sqlite3
+import prefect
+import requests
+import threading
+from urllib.parse import urlparse
+from contextlib import contextmanager
+from prefect import Task
+from prefect.engine import signals
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import es_client
+import metrics
+from minio_source import PrefetchedStream
+from state import state_path
+
+HTTP_READ_CHUNK_BYTES = int(os.environ.get("HTTP_READ_CHUNK_BYTES") or 1024 * 1024)
+HTTP_PREFETCH_CHUNKS = int(os.environ.get("HTTP_PREFETCH_CHUNKS") or 8)
+HTTP_TIMEOUT = int(os.environ.get("HTTP_TIMEOUT") or 60)  # s, between bytes
+
+logger = prefect.context.get("logger")
+
+_session = None
+_store = None
+_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Session shared by the downloads of the process, keeping connections"""
+    global _session
+    with _lock:
+        if _session is None:
+            retry = Retry(
+                connect=3,
+                read=3,
+                status=3,
+                status_forcelist=(429, 500, 502, 503, 504),
+                backoff_factor=0.5,
+            )
+            adapter = HTTPAdapter(max_retries=retry)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+class DownloadStore:
+    """Validators (ETag, Last-Modified) of the last ingested version of URIs"""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS downloads (
+                    uri TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    ingested_at REAL NOT NULL
+                )"""
+            )
+
+    def get(self, uri: str) -> dict:
+        with self.lock, self.conn:
+            entry = self.conn.execute(
+                "SELECT etag, last_modified FROM downloads WHERE uri = ?", (uri,)
+            ).fetchone()
+        if entry is None:
+            return {}
+        return {"etag": entry[0], "last_modified": entry[1]}
+
+    def put(self, uri: str, validators: dict):
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO downloads (uri, etag, last_modified,
+                    ingested_at)
+                VALUES (?, ?, ?, ?)""",
+                (
+                    uri,
+                    validators.get("etag"),
+                    validators.get("last_modified"),
+                    time.time(),
+                ),
+            )
+
+
+def get_store() -> DownloadStore:
+    global _store
+    with _lock:
+        if _store is None:
+            _store = DownloadStore(state_path("downloads.sqlite"))
+        return _store
+
+
+def response_validators(response) -> dict:
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def has_changed(uri: str) -> bool:
+    """Whether the URI changed since last ingested, revalidated without download"""
+    known = get_store().get(uri)
+    headers = {}
+    if known.get("etag"):
+        headers["If-None-Match"] = known["etag"]
+    if known.get("last_modified"):
+        headers["If-Modified-Since"] = known["last_modified"]
+    if not headers:
+        return True
+    with get_session().get(
+        uri, headers=headers, stream=True, timeout=HTTP_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        changed = response.status_code != 304
+    metrics.inc(
+        "http_revalidations_total",
+        host=urlparse(uri).netloc,
+        result="changed" if changed else "unchanged",
+    )
+    return changed
+
+
+@contextmanager
+def open_uri(uri: str, sample_size: int):
+    """Streams a URI as text, like minio_source.open_object
+
+    Yields (sample, stream, validators): validators are to be stored (see
+    `mark_ingested`) once the content is ingested.
+    """
+    response = get_session().get(uri, stream=True, timeout=HTTP_TIMEOUT)
+    try:
+        response.raise_for_status()
+        response.raw.decode_content = True  # gzip transfer
+        raw_stream = PrefetchedStream(
+            response.raw,
+            HTTP_READ_CHUNK_BYTES,
+            HTTP_PREFETCH_CHUNKS,
+            source="http",
+            host=urlparse(uri).netloc,
+        )
+        try:
+            sample = raw_stream.peek(sample_size)
+            text_stream = io.TextIOWrapper(
+                io.BufferedReader(raw_stream, buffer_size=HTTP_READ_CHUNK_BYTES),
+                encoding="utf-8",
+                newline="",
+            )
+            sample = sample.decode("utf-8", errors="ignore")
+            yield sample, text_stream, response_validators(response)
+        finally:
+            raw_stream.close()
+    finally:
+        response.close()
+
+
+def mark_ingested(uri: str, validators: dict):
+    get_store().put(uri, validators)
+
+
+class CheckForUpdates(Task):
+    """Returns the URIs changed since last ingested
+
+    The rest of the flow run is skipped when none did. Rebuilds
+    (ES_WRITE_MODE=rebuild) ingest them all anyway.
+    """
+
+    def run(self, uris: list) -> list:
+        if es_client.ES_WRITE_MODE == "rebuild":
+            return uris
+        changed = []
+        for uri in uris:
+            try:
+                if has_changed(uri):
+                    changed.append(uri)
+                else:
+                    logger.info(f"{uri} did not change since last ingested")
+            except requests.RequestException as e:
+                logger.warning(f"Can't revalidate {uri}: {e}")
+                changed.append(uri)
+        if not len(changed):
+            raise signals.SKIP("No source changed since last ingested")
+        return changed
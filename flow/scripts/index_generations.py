@@ -0,0 +1,185 @@
+import os
+import re
+import prefect
+from datetime import datetime
+from prefect import Task
+
+import checkpoints
+import es_client
+
+ES_MIN_DOCS_RATIO = float(os.environ.get("ES_MIN_DOCS_RATIO") or 0.9)
+ES_KEEP_GENERATIONS = int(os.environ.get("ES_KEEP_GENERATIONS") or 2)
+
+logger = prefect.context.get("logger")
+
+# Generations are hidden: `news_*` like patterns only match their aliases
+GENERATION_SETTINGS = {"index.hidden": True}
+
+
+generation_regex = re.compile(r".+-\d{14}$")
+
+
+def generation_name(alias: str) -> str:
+    return f"{alias}-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+
+
+def is_generation(index_name: str) -> bool:
+    """Whether an index name is a generation (rather than an alias)"""
+    return generation_regex.match(index_name) is not None
+
+
+def alias_of(index_name: str) -> str:
+    """Alias of a generation, the name itself if not a generation"""
+    return index_name.rsplit("-", 1)[0] if is_generation(index_name) else index_name
+
+
+def list_generations(es_inst, alias: str) -> dict:
+    """{index: published or not} of an alias, oldest first (names sort by date)"""
+    indices = es_inst.indices.get(index=f"{alias}-*", expand_wildcards="all")
+    return {
+        name: indices[name]["mappings"].get("_meta", {}).get("published", False)
+        for name in sorted(indices)
+    }
+
+
+def current_generation(es_inst, alias: str):
+    """Index the alias points to, None if there is none (or not an alias yet)"""
+    if not es_inst.indices.exists_alias(name=alias):
+        return None
+    return next(iter(es_inst.indices.get_alias(name=alias)))
+
+
+def create_generation(es_inst, alias: str, body: dict) -> str:
+    """Creates an empty generation, with the replicas of the current one"""
+    index_name = generation_name(alias)
+    settings = dict(GENERATION_SETTINGS)
+    previous = current_generation(es_inst, alias)
+    if previous is not None:
+        replicas = es_inst.indices.get_settings(
+            index=previous, name="index.number_of_replicas"
+        )
+        settings["index.number_of_replicas"] = replicas[previous]["settings"]["index"][
+            "number_of_replicas"
+        ]
+    es_inst.indices.create(
+        index=index_name,
+        body={**body, "settings": {**body.get("settings", {}), **settings}},
+    )
+    logger.info(f"Created index {index_name} for {alias}")
+    return index_name
+
+
+def get_meta(es_inst, index_name: str) -> dict:
+    mappings = es_inst.indices.get_mapping(index=index_name)[index_name]["mappings"]
+    return mappings.get("_meta", {})
+
+
+def update_meta(es_inst, index_name: str, **values):
+    """Updates the `_meta` of an index mapping, None values remove their key"""
+    meta = {**get_meta(es_inst, index_name), **values}
+    es_inst.indices.put_mapping(
+        index=index_name,
+        body={
+            "_meta": {key: value for key, value in meta.items() if value is not None}
+        },
+    )
+
+
+def mark_published(es_inst, index_name: str):
+    update_meta(es_inst, index_name, published=True)
+
+
+def prepare_index(
+    es_inst, alias: str, body: dict, rebuild: bool = None, resume: bool = False
+) -> str:
+    """Name of the index a run should write to
+
+    When rebuilding (ES_WRITE_MODE=rebuild), a new generation is created: it
+    is published by `publish_index` once loaded. With `resume`, the
+    generation of a previous run whose load was interrupted (not forgotten
+    by `forget_build`) is loaded on instead. Otherwise documents are
+    upserted in place, through the alias (created along with a first
+    generation if missing). Indices created before generations are kept
+    until the first rebuild.
+    """
+    if rebuild is None:
+        rebuild = es_client.ES_WRITE_MODE == "rebuild"
+    if rebuild:
+        store = checkpoints.get_store()
+        index_name = store.get(f"build:{alias}") if resume else None
+        if (
+            index_name is not None
+            and es_inst.indices.exists(index=index_name)
+            and not get_meta(es_inst, index_name).get("published", False)
+        ):
+            logger.info(f"Resuming the load of {index_name} for {alias}")
+            return index_name
+        index_name = create_generation(es_inst, alias, body)
+        if resume:
+            store.put(f"build:{alias}", index_name)
+        return index_name
+    if not es_inst.indices.exists(index=alias):
+        index_name = create_generation(es_inst, alias, body)
+        es_inst.indices.put_alias(index=index_name, name=alias)
+        mark_published(es_inst, index_name)
+    return alias
+
+
+def forget_build(index_name: str):
+    """Once a generation is loaded, the next run builds a new one"""
+    alias = alias_of(index_name)
+    store = checkpoints.get_store()
+    if store.get(f"build:{alias}") == index_name:
+        store.delete(f"build:{alias}")
+
+
+def count_documents(es_inst, index_name: str) -> int:
+    es_inst.indices.refresh(index=index_name)
+    return es_inst.count(index=index_name)["count"]
+
+
+def publish_index(es_inst, alias: str, index_name: str):
+    """Points the alias to a loaded generation, then removes the oldest ones
+
+    The swap is atomic, readers never see a half-built index. It is refused
+    (the generation is left for inspection) if the generation holds less than
+    ES_MIN_DOCS_RATIO times the documents of the current one.
+    """
+    if index_name == alias:
+        return
+    previous_count = 0
+    if es_inst.indices.exists(index=alias):
+        previous_count = count_documents(es_inst, alias)
+    count = count_documents(es_inst, index_name)
+    if count < previous_count * ES_MIN_DOCS_RATIO:
+        raise Exception(
+            f"Not publishing {index_name}: {count} documents, "
+            f"{alias} has {previous_count}"
+        )
+
+    actions = [{"add": {"index": index_name, "alias": alias}}]
+    if es_inst.indices.exists_alias(name=alias):
+        for previous in es_inst.indices.get_alias(name=alias):
+            actions.insert(0, {"remove": {"index": previous, "alias": alias}})
+    elif es_inst.indices.exists(index=alias):
+        # Index from before generations, replaced by the alias
+        actions.insert(0, {"remove_index": {"index": alias}})
+    es_inst.indices.update_aliases(body={"actions": actions})
+    logger.info(f"{alias} now points to {index_name} ({count} documents)")
+
+    mark_published(es_inst, index_name)
+    generations = list_generations(es_inst, alias)
+    older = [name for name in generations if name < index_name]
+    # Previously published generations are kept to switch back to them,
+    # builds that failed or were refused are not worth keeping anymore
+    kept = [name for name in older if generations[name]][::-1]
+    kept = kept[: ES_KEEP_GENERATIONS - 1]
+    for old_index in older:
+        if old_index not in kept:
+            logger.info(f"Deleting old generation {old_index}")
+            es_inst.indices.delete(index=old_index, ignore=404)
+
+
+class PublishIndex(Task):
+    def run(self, alias, index_name):
+        publish_index(es_client.get_es_instance(), alias, index_name)
@@ -0,0 +1,112 @@
+import prefect
+import threading
+
+import checkpoints
+import curated
+import index_generations
+
+# Bumped when batches are numbered differently: older checkpoints don't resume
+CHECKPOINT_VERSION = 2
+
+logger = prefect.context.get("logger")
+
+
+def ingest_settings(engine: str, batch_size: int) -> dict:
+    """Settings the batches of an object depend on
+
+    A checkpoint is only resumed with the same settings: batches are
+    numbered in the order they are parsed, skipping them otherwise would skip
+    other rows.
+    """
+    settings = {
+        "version": CHECKPOINT_VERSION,
+        "engine": engine,
+        "batch_size": batch_size,
+    }
+    if engine == "parquet":
+        settings["since"] = curated.PARQUET_SINCE
+        settings["countries"] = sorted(curated.PARQUET_COUNTRIES or [])
+    return settings
+
+
+class ObjectProgress:
+    """Batches of an object acknowledged by ES, checkpointed as they are
+
+    Batches are numbered in the order they are parsed, even those left empty
+    once formatted, and acknowledged once all their documents are indexed (or
+    dead-lettered), possibly out of order. The checkpoint holds the ETag of the object and how many batches
+    (and documents) were acknowledged in a row from the first one: a run
+    restarted after a crash skips them, or the whole object once `complete`.
+    Checkpoints are kept per index written to, `finish_load` forgets them.
+    """
+
+    def __init__(self, index_name: str, obj, settings: dict):
+        self.name = f"ingest:{index_name}:{obj.bucket_name}/{obj.object_name}"
+        self.store = checkpoints.get_store()
+        self.lock = threading.Lock()
+        self.pending = {}  # {sequence: documents} acknowledged after a gap
+        self.state = {
+            "etag": obj.etag,
+            "settings": settings,
+            "batches": 0,
+            "documents": 0,
+            "complete": False,
+        }
+        saved = self.store.get(self.name)
+        if saved is None:
+            return
+        if saved["etag"] != obj.etag or saved["settings"] != settings:
+            logger.info(f"{obj.object_name} changed since {self.name}, starting over")
+            return
+        self.state = saved
+        if saved["complete"]:
+            logger.info(f"{obj.object_name} already loaded, skipped")
+        elif saved["batches"]:
+            logger.info(
+                f"Resuming {obj.object_name} after {saved['batches']} batches "
+                f"({saved['documents']} documents)"
+            )
+
+    @property
+    def complete(self) -> bool:
+        return self.state["complete"]
+
+    @property
+    def acknowledged(self) -> int:
+        """Batches acknowledged in a row from the first one"""
+        return self.state["batches"]
+
+    def ack(self, sequence: int, nb_documents: int):
+        """Called by the shipping threads once a batch is acknowledged"""
+        with self.lock:
+            self.pending[sequence] = nb_documents
+            if self.state["batches"] not in self.pending:
+                return
+            while self.state["batches"] in self.pending:
+                self.state["documents"] += self.pending.pop(self.state["batches"])
+                self.state["batches"] += 1
+            self.store.put(self.name, self.state)
+
+    def finish(self):
+        """Marks the object loaded, once every batch is acknowledged"""
+        with self.lock:
+            self.state["complete"] = True
+            self.store.put(self.name, self.state)
+
+    def forget(self):
+        self.store.delete(self.name)
+
+
+def finish_load(index_name: str, progresses: list):
+    """Forgets the checkpoints of a load once every object is complete
+
+    Until then, the next run resumes the load, in the same generation when
+    rebuilding (see `index_generations.prepare_index`).
+    """
+    incomplete = [progress.name for progress in progresses if not progress.complete]
+    if len(incomplete):
+        logger.warning(f"{len(incomplete)} objects not loaded, kept to resume them")
+        return
+    for progress in progresses:
+        progress.forget()
+    index_generations.forget_build(index_name)
@@ -1,29 +1,33 @@
 import os
 import dateparser
-import uuid
-import requests
 import prefect
-import clevercsv
 from tqdm import tqdm
+from itertools import islice
+from functools import partial
 from prefect import Flow, Task, Client, task
 from datetime import timedelta, datetime
 from prefect.schedules import IntervalSchedule
-from elasticsearch import Elasticsearch, helpers
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 
 from mapping import mapping
+from lookup_table import get_lookup_table
+import documents
+import es_client
+import index_generations
+import bulk_load
+import columnar
+import dates
+import dialects
+import http_source
+import metrics
+import pipeline
 
 MINIO_SCHEME = os.environ.get("MINIO_SCHEME")
 MINIO_ENDPOINT = os.environ.get("MINIO_ENDPOINT")
 MINIO_ACCESS_KEY = os.environ.get("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = os.environ.get("MINIO_SECRET_KEY")
 MAX_ES_ROW_INJECT = int(os.environ.get("MAX_ES_ROW_INJECT", 1000))
-ELASTIC_SCHEME = os.environ.get("ELASTIC_SCHEME")
-ELASTIC_PORT = os.environ.get("ELASTIC_PORT")
-ELASTIC_USER = os.environ.get("ELASTIC_USER")
-ELASTIC_PWD = os.environ.get("ELASTIC_PWD")
-ELASTIC_ENDPOINT = os.environ.get("ELASTIC_ENDPOINT")
+INGEST_ENGINE = pipeline.ingest_engine("insert_france_virtests", ("row", "columnar"))
+SNIFF_SAMPLE_BYTES = 10000
 
 csv_endpoint = "https://www.data.gouv.fr/en/datasets/r/406c6a23-e283-4300-9484-54e78c8ae675"
 project_name = f"pandemic-knowledge-santepublic-tests"
@@ -47,26 +51,13 @@ extra_locations = {"EL": "GR"}
 
 locations_cache = {"World": None}
 
-
-def get_es_instance():
-    es_inst = Elasticsearch(
-        [ELASTIC_ENDPOINT],
-        http_auth=(ELASTIC_USER, ELASTIC_PWD),
-        scheme=ELASTIC_SCHEME,
-        port=ELASTIC_PORT,
-        verify_certs=False,
-    )
-    return es_inst
+date_normalizer = dates.DateNormalizer(
+    formats=("iso", "epoch"), fallback=dateparser.parse
+)
 
 
-def format_date(date):
-    if not date:
-        return None
-    try:
-        return dateparser.parse(date)
-    except Exception as e:
-        logger.error(e)
-    return None
+def format_date(date, filename):
+    return date_normalizer.parse(date, filename)
 
 
 def format_location(lookup_table, location_name):
@@ -95,7 +86,7 @@ def pick_nonempty_cell(row, headers, potential_keys):
 
 def format_row(lookup_table, row, headers, filename):
     date_start = date_end = format_date(
-        pick_nonempty_cell(row, headers, columns_allowed["date"])
+        pick_nonempty_cell(row, headers, columns_allowed["date"]), filename
     )
     location = format_location(
         lookup_table, pick_nonempty_cell(row, headers, columns_allowed["location"])
@@ -122,137 +113,184 @@ def format_row(lookup_table, row, headers, filename):
             "iso_region2": f"FR-{location_name}",
         }
     logger.warning(f"format_row(): Invalid row : {row}")
+    metrics.inc("rows_rejected_total", flow=flow_name, reason="date")
     return None
 
 
-def inject_rows_to_es(rows, index_name):
-    es_inst = get_es_instance()
+def format_frame(lookup_table, frame, columns, filename):
+    """Columnar format_row(), for a whole chunk of rows at once"""
+    date_column = columnar.pick_nonempty_column(frame, columns["date"])
+    parsed_dates = columnar.to_datetimes(date_column, date_normalizer, filename)
+    valid = parsed_dates.notna()
+    if not valid.all():
+        logger.warning(f"format_frame(): {(~valid).sum()} invalid rows")
+    columnar.count_rejected(flow_name, {"date": ~valid})
+    frame, parsed_dates = frame[valid], parsed_dates[valid]
+    locations = columnar.map_distinct(
+        columnar.pick_nonempty_column(frame, columns["location"]),
+        lambda location_name: format_location(lookup_table, location_name),
+    )
+    location_names = columnar.pick_nonempty_column(frame, columns["location_name"])
+    return columnar.to_batch(
+        {
+            "date_start": parsed_dates,
+            "date_end": parsed_dates,
+            "location": locations.map(lambda location: location[0], na_action="ignore"),
+            "location_name": location_names,
+            "confirmed": columnar.to_counts(
+                columnar.pick_nonempty_column(frame, columns["confirmed"])
+            ),
+            "deaths": columnar.to_counts(
+                columnar.pick_nonempty_column(frame, columns["deaths"])
+            ),
+            "recovered": columnar.to_counts(
+                columnar.pick_nonempty_column(frame, columns["recovered"])
+            ),
+            "vaccinated": columnar.to_counts(
+                columnar.pick_nonempty_column(frame, columns["vaccinated"])
+            ),
+            "tested": columnar.to_counts(
+                columnar.pick_nonempty_column(frame, columns["tested"])
+            ),
+            "filename": filename,
+            "iso_code2": locations.map(
+                lambda location: location[1], na_action="ignore"
+            ),
+            "iso_region2": "FR-" + location_names.fillna("None"),
+        },
+        len(frame),
+    )
+
 
-    logger.info("Injecting {} rows in Elasticsearch".format(len(rows)))
+def rows_ids(batch, document_ids):
+    keys = zip(batch.column("location_name"), batch.column("date_start"))
+    return [document_ids(*key) for key in keys]
 
-    actions = [
-        {"_index": index_name, "_id": uuid.uuid4(), "_source": row} for row in rows
-    ]
-    helpers.bulk(es_inst, actions)
 
+def inject_rows_to_es(batch, index_name, document_ids):
+    ids = rows_ids(batch, document_ids)
+    logger.info("Injecting {} rows in Elasticsearch".format(len(batch)))
+    es_client.ship_rows(batch, index_name, ids)
 
-def parse_file(lookup_table, file_path):
-    with open(file_path, "r", newline="") as fp:
-        char_read = 10000 if os.path.getsize(file_path) > 10000 else None
 
-        try:
-            dialect = clevercsv.Sniffer().sniff(fp.read(char_read), verbose=True)
-        except Exception as e:
-            logger.error(e)
-            return []
+def format_block(lookup_table, block, headers, filename):
+    with metrics.timer("format_seconds", flow=flow_name):
+        return [format_row(lookup_table, row, headers, filename) for row in block]
 
-        fp.seek(0)
-        reader = clevercsv.reader(fp, dialect)
-        headers_list = next(reader)
-        headers = {}
-        for i, header in enumerate(headers_list):
-            headers[header] = i
-        for row in tqdm(reader, unit="entry"):
-            yield format_row(lookup_table, row, headers, file_path)
+
+def parse_file(lookup_table, sample, fp, filename):
+    """Yields blocks of rows to format (see `format_block`)"""
+    try:
+        with metrics.timer("sniff_seconds", flow=flow_name):
+            dialect, fast = dialects.resolve(filename, sample)
+    except Exception as e:
+        logger.error(e)
+        return []
+
+    reader = dialects.reader(fp, dialect, fast)
+    headers_list = next(reader)
+    headers = {}
+    for i, header in enumerate(headers_list):
+        headers[header] = i
+    nb_rows = 0
+    rows = tqdm(reader, unit="entry")
+    try:
+        while True:
+            with metrics.timer("parse_seconds", flow=flow_name):
+                block = list(islice(rows, MAX_ES_ROW_INJECT))
+            if not len(block):
+                break
+            nb_rows += len(block)
+            yield partial(format_block, lookup_table, block, headers, filename)
+    finally:
+        metrics.inc("rows_read_total", nb_rows, flow=flow_name)
+    return []
+
+
+def format_chunk(lookup_table, frame, columns, filename):
+    with metrics.timer("format_seconds", flow=flow_name):
+        return format_frame(lookup_table, frame, columns, filename)
+
+
+def parse_file_columnar(lookup_table, sample, fp, filename):
+    """Yields chunks of rows to format (see `format_chunk`), parsed with pandas"""
+    try:
+        with metrics.timer("sniff_seconds", flow=flow_name):
+            dialect, _ = dialects.resolve(filename, sample)
+    except Exception as e:
+        logger.error(e)
+        return []
+
+    columns = None
+    chunks = columnar.read_csv_chunks(fp, dialect, MAX_ES_ROW_INJECT)
+    for frame in tqdm(chunks, unit="chunk"):
+        metrics.inc("rows_read_total", len(frame), flow=flow_name)
+        if columns is None:
+            columns = columnar.resolve_columns(list(frame.columns), columns_allowed)
+        yield partial(format_chunk, lookup_table, frame, columns, filename)
     return []
 
 
-def process_file(lookup_table, index_name, file_path):
-    to_inject = []
-    logger.info(f"process_file(): Processing {file_path}...")
-    for row in parse_file(lookup_table, file_path):
-        if row is not None:
-            to_inject.append(row)
-            if len(to_inject) >= MAX_ES_ROW_INJECT:
-                inject_rows_to_es(to_inject, index_name)
-                to_inject = []
-        else:
-            logger.warning("process_file(): Invalid row")
-    if len(to_inject) > 0:
-        inject_rows_to_es(to_inject, index_name)
+def process_file(lookup_table, index_name, sample, fp, filename):
+    """Ingests a CSV text stream, starting with `sample`"""
+    document_ids = documents.DocumentIds(filename)
+    logger.info(f"process_file(): Processing {filename} ({INGEST_ENGINE})...")
+    parse = parse_file_columnar if INGEST_ENGINE == "columnar" else parse_file
+    pipeline.ingest(
+        flow_name,
+        parse(lookup_table, sample, fp, filename),
+        index_name,
+        lambda rows: rows_ids(rows, document_ids),
+    )
 
 
 class ParseFiles(Task):
-    def run(self, lookup_table, index_name, http_csv_uris: list):
-        for file_uri in tqdm(http_csv_uris):
-            logger.info(f"Processing file {file_uri}...")
-            file_path = f"/tmp/{uuid.uuid4()}"
-            session = requests.Session()
-            retry = Retry(connect=3, backoff_factor=0.5)
-            adapter = HTTPAdapter(max_retries=retry)
-            session.mount("http://", adapter)
-            session.mount("https://", adapter)
-            r = session.get(file_uri, allow_redirects=True)
-            with open(file_path, "wb") as f:
-                f.write(r.content)
-            process_file(lookup_table, index_name, file_path)
+    def run(self, index_name, http_csv_uris: list):
+        with bulk_load.bulk_load(index_name):
+            lookup_table = get_lookup_table()
+            for file_uri in tqdm(http_csv_uris):
+                logger.info(f"Processing file {file_uri}...")
+                with metrics.timer("file_seconds", flow=flow_name):
+                    with http_source.open_uri(file_uri, SNIFF_SAMPLE_BYTES) as (
+                        sample,
+                        fp,
+                        validators,
+                    ):
+                        process_file(lookup_table, index_name, sample, fp, file_uri)
+                http_source.mark_ingested(file_uri, validators)
+        return metrics.report(flow_name)
 
 
 class GenerateEsMapping(Task):
     def run(self, index_name) -> str:
         """
         Returns:
-            str: index_name
+            str: name of the index to write to
         """
-        es_inst = get_es_instance()
+        es_inst = es_client.get_es_instance()
         logger.info("Generating mapping for index {}".format(index_name))
-        es_inst.indices.delete(index=index_name, ignore=[400, 404])
-        response = es_inst.indices.create(
-            index=index_name, body=mapping, ignore=400  # ignore 400 already exists code
-        )
-        if "acknowledged" in response:
-            if response["acknowledged"] == True:
-                logger.info(
-                    "INDEX MAPPING SUCCESS FOR INDEX: {}".format(response["index"])
-                )
-            elif "error" in response:
-                logger.error(response["error"]["root_cause"])
-                logger.error("Error type: {}".format(response["error"]["type"]))
-                raise Exception("Unable to create index mapping")
-        return index_name
-
-
-def read_lookup_table(lookup_file_path: str):
-    logger.info("Loading lookup table...")
-    lookup = {}
-    with open(lookup_file_path, "r", newline="") as fp:
-        char_read = 10000 if os.path.getsize(lookup_file_path) > 10000 else None
-        dialect = clevercsv.Sniffer().sniff(fp.read(char_read), verbose=True)
-        fp.seek(0)
-        reader = clevercsv.reader(fp, dialect)
-        next(reader)
-        for row in tqdm(reader, unit="entry"):
-            for location in [
-                row[6],  # Province_State
-                row[7],  # Country_Region
-                row[10],  # Combined_Key
-            ]:
-                if location and location not in lookup:
-                    if row[8] and row[9]:  # Lat, Long
-                        lookup[location] = (
-                            {"lat": float(row[8]), "lon": float(row[9])},
-                            row[1],
-                        )
-    logger.info(f"Found {len(lookup)} locations.")
-    return lookup
-
-
-lookup_table = read_lookup_table("/usr/app/UID_ISO_FIPS_LookUp_Table.csv")
+        return index_generations.prepare_index(es_inst, index_name, mapping)
+
 
 schedule = IntervalSchedule(
     start_date=datetime.utcnow() + timedelta(seconds=1), interval=timedelta(hours=24)
 )
 with Flow(flow_name, schedule=schedule) as flow:
+    check_updates_task = http_source.CheckForUpdates()
+    http_csv_uris = check_updates_task([csv_endpoint])
+
     es_mapping_task = GenerateEsMapping()
-    index_name = es_mapping_task(index_name)
+    write_index_name = es_mapping_task(index_name, upstream_tasks=[http_csv_uris])
 
     parse_files_task = ParseFiles()
-    parse_files_task(
-        lookup_table=lookup_table,
-        index_name=index_name,
-        http_csv_uris=[csv_endpoint],
+    parse_files = parse_files_task(
+        index_name=write_index_name,
+        http_csv_uris=http_csv_uris,
     )
 
+    publish_index_task = index_generations.PublishIndex()
+    publish_index_task(index_name, write_index_name, upstream_tasks=[parse_files])
+
 if __name__ == "__main__":
 
     try:
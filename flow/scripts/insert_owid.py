@@ -1,29 +1,42 @@
 import os
 import dateparser
-import uuid
 import prefect
-import clevercsv
 import traceback
+from functools import partial
 from tqdm import tqdm
+from itertools import islice
 from prefect import Flow, Task, Client, task
 from datetime import timedelta, datetime
 from prefect.schedules import IntervalSchedule
 from minio import Minio
-from elasticsearch import Elasticsearch, helpers
-from geopy.geocoders import Nominatim
 
 from mapping import mapping
+from lookup_table import get_lookup_table
+import documents
+import es_client
+import index_generations
+import ingest_progress
+import bulk_load
+import columnar
+import curated
+import dates
+import parallel_parse
+import geocoding
+import minio_source
+import dialects
+import metrics
+import pipeline
+import rollups
 
 MINIO_SCHEME = os.environ.get("MINIO_SCHEME")
 MINIO_ENDPOINT = os.environ.get("MINIO_ENDPOINT")
 MINIO_ACCESS_KEY = os.environ.get("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = os.environ.get("MINIO_SECRET_KEY")
 MAX_ES_ROW_INJECT = int(os.environ.get("MAX_ES_ROW_INJECT", 1000))
-ELASTIC_SCHEME = os.environ.get("ELASTIC_SCHEME")
-ELASTIC_PORT = os.environ.get("ELASTIC_PORT")
-ELASTIC_USER = os.environ.get("ELASTIC_USER")
-ELASTIC_PWD = os.environ.get("ELASTIC_PWD")
-ELASTIC_ENDPOINT = os.environ.get("ELASTIC_ENDPOINT")
+SNIFF_SAMPLE_BYTES = 10000
+INGEST_ENGINE = pipeline.ingest_engine(
+    "insert_owid", ("row", "columnar", "parallel", "parquet")
+)
 
 bucket_name = "contamination-owid"
 project_name = f"pandemic-knowledge-{bucket_name}"
@@ -45,28 +58,43 @@ columns_allowed = {
 
 extra_locations = {"EL": "GR"}
 
-locations_cache = {"World": None}
+locations_cache = geocoding.LocationCache({"World": None})
+
+date_normalizer = dates.DateNormalizer(
+    formats=("iso", "epoch"), fallback=dateparser.parse
+)
+
+layout = curated.Layout(
+    columns_allowed,
+    counts=["confirmed", "deaths", "recovered", "vaccinated", "tested"],
+    parse_date=date_normalizer.parse,
+)
+
+
+def format_date(date, filename):
+    return date_normalizer.parse(date, filename)
 
 
-def get_es_instance():
-    es_inst = Elasticsearch(
-        [ELASTIC_ENDPOINT],
-        http_auth=(ELASTIC_USER, ELASTIC_PWD),
-        scheme=ELASTIC_SCHEME,
-        port=ELASTIC_PORT,
-        verify_certs=False,
+def geocode(location_name):
+    logger.info(f"Guessing geolocation for {location_name}")
+    return geocoding.nominatim_geocode(
+        extra_locations.get(location_name, location_name)
     )
-    return es_inst
 
 
-def format_date(date):
-    if not date:
-        return None
-    try:
-        return dateparser.parse(date)
-    except Exception as e:
-        logger.error(e)
-    return None
+def prepare_locations(lookup_table, location_names):
+    """Geocodes at once the locations missing from the lookup table"""
+    unknown_locations = [
+        location_name
+        for location_name in set(location_names)
+        if location_name
+        and location_name not in locations_cache
+        and location_name not in lookup_table
+    ]
+    if not len(unknown_locations):
+        return
+    with metrics.timer("geocode_seconds", flow=flow_name):
+        locations_cache.resolve(unknown_locations, geocode)
 
 
 def format_location(lookup_table, location_name):
@@ -76,29 +104,8 @@ def format_location(lookup_table, location_name):
         return locations_cache[location_name]
     if location_name in lookup_table:
         return lookup_table[location_name]
-
-    logger.info(f"Guessing geolocation for {location_name}")
-    geolocator = Nominatim(user_agent="pandemic-knowledge")
-    location = geolocator.geocode(
-        extra_locations[location_name]
-        if location_name in extra_locations
-        else location_name,
-        addressdetails=True,
-    )
-
-    if location and location.raw:
-        logger.info(f"Found {location.latitude}, {location.longitude}")
-        if "address" in location.raw and "country_code" in location.raw["address"]:
-            locations_cache[location_name] = (
-                {"lat": location.latitude, "lon": location.longitude},
-                location.raw["address"]["country_code"].upper(),
-            )
-            return locations_cache[location_name]
-    locations_cache[location_name] = None
-    logger.error(
-        f"Failed to locate (no country code and/or coordinates) for {location}"
-    )
-    return None
+    locations_cache.resolve([location_name], geocode)
+    return locations_cache[location_name]
 
 
 def pick_one_of_elements(haystack: list, needles: list):
@@ -117,7 +124,7 @@ def pick_nonempty_cell(row, headers, potential_keys):
 
 def format_row(lookup_table, row, headers, filename):
     date_start = date_end = format_date(
-        pick_nonempty_cell(row, headers, columns_allowed["date"])
+        pick_nonempty_cell(row, headers, columns_allowed["date"]), filename
     )
     location = format_location(
         lookup_table, pick_nonempty_cell(row, headers, columns_allowed["location"])
@@ -142,62 +149,251 @@ def format_row(lookup_table, row, headers, filename):
             "filename": filename,
             "iso_code2": location[1] if len(location) else None,
         }
+    metrics.inc(
+        "rows_rejected_total",
+        flow=flow_name,
+        reason=(
+            "location"
+            if location is None
+            else "date"
+            if date_start is None
+            else "confirmed"
+        ),
+    )
     return None
 
 
-def inject_rows_to_es(rows, index_name):
-    es_inst = get_es_instance()
+def format_frame(lookup_table, frame, columns, filename):
+    """Columnar format_row(), for a whole chunk of rows at once"""
+    date_column = columnar.pick_nonempty_column(frame, columns["date"])
+    parsed_dates = columnar.to_datetimes(date_column, date_normalizer, filename)
+    locations = columnar.map_distinct(
+        columnar.pick_nonempty_column(frame, columns["location"]),
+        lambda location_name: format_location(lookup_table, location_name),
+    )
+    nb_confirmed = columnar.pick_nonempty_column(frame, columns["confirmed"])
+    valid = parsed_dates.notna() & locations.notna() & nb_confirmed.notna()
+    columnar.count_rejected(
+        flow_name,
+        {
+            "location": locations.isna(),
+            "date": parsed_dates.isna(),
+            "confirmed": nb_confirmed.isna(),
+        },
+    )
+    frame, locations = frame[valid], locations[valid]
+    parsed_dates = parsed_dates[valid]
+    return columnar.to_batch(
+        {
+            "date_start": parsed_dates,
+            "date_end": parsed_dates,
+            "location": locations.map(lambda location: location[0]),
+            "location_name": columnar.pick_nonempty_column(
+                frame, columns["location_name"]
+            ),
+            "confirmed": columnar.to_counts(nb_confirmed[valid]),
+            "deaths": columnar.to_counts(
+                columnar.pick_nonempty_column(frame, columns["deaths"])
+            ),
+            "recovered": columnar.to_counts(
+                columnar.pick_nonempty_column(frame, columns["recovered"])
+            ),
+            "vaccinated": columnar.to_counts(
+                columnar.pick_nonempty_column(frame, columns["vaccinated"])
+            ),
+            "tested": columnar.to_counts(
+                columnar.pick_nonempty_column(frame, columns["tested"])
+            ),
+            "filename": filename,
+            "iso_code2": locations.map(
+                lambda location: location[1] if len(location) else None
+            ),
+        },
+        len(frame),
+    )
 
-    logger.info("Injecting {} rows in Elasticsearch".format(len(rows)))
 
-    actions = [
-        {"_index": index_name, "_id": uuid.uuid4(), "_source": row} for row in rows
-    ]
-    helpers.bulk(es_inst, actions)
+def rows_ids(batch, document_ids):
+    keys = zip(batch.column("location_name"), batch.column("date_start"))
+    return [document_ids(*key) for key in keys]
 
 
-def parse_file(lookup_table, minio_client, bucket_name, object_name):
-    csv_file_path = "/tmp/" + str(uuid.uuid4())
-    minio_client.fget_object(bucket_name, object_name, csv_file_path)
-    with open(csv_file_path, "r", newline="") as fp:
-        char_read = 10000 if os.path.getsize(csv_file_path) > 10000 else None
+def inject_rows_to_es(batch, index_name, document_ids):
+    ids = rows_ids(batch, document_ids)
+    logger.info("Injecting {} rows in Elasticsearch".format(len(batch)))
+    es_client.ship_rows(batch, index_name, ids)
+
 
+def format_block(lookup_table, block, headers, filename):
+    """Formats a block of rows, geocoding its unknown locations at once"""
+    prepare_locations(
+        lookup_table,
+        [
+            pick_nonempty_cell(row, headers, columns_allowed["location"])
+            for row in block
+        ],
+    )
+    with metrics.timer("format_seconds", flow=flow_name):
+        return [format_row(lookup_table, row, headers, filename) for row in block]
+
+
+def parse_file(lookup_table, minio_client, bucket_name, object_name):
+    """Yields blocks of rows to format (see `format_block`)"""
+    with minio_source.open_object(
+        minio_client, bucket_name, object_name, SNIFF_SAMPLE_BYTES
+    ) as (sample, fp):
         try:
-            dialect = clevercsv.Sniffer().sniff(fp.read(char_read), verbose=True)
+            with metrics.timer("sniff_seconds", flow=flow_name):
+                dialect, fast = dialects.resolve(f"{bucket_name}/{object_name}", sample)
         except Exception as e:
             logger.error(e)
             return []
 
-        fp.seek(0)
-        reader = clevercsv.reader(fp, dialect)
+        reader = dialects.reader(fp, dialect, fast)
         headers_list = next(reader)
         headers = {}
         for i, header in enumerate(headers_list):
             headers[header] = i
-        for row in tqdm(reader, unit="entry"):
-            yield format_row(lookup_table, row, headers, object_name)
+        progress = tqdm(unit="entry")
+        # Locations are geocoded a block at a time, the file is read only once
+        while True:
+            with metrics.timer("parse_seconds", flow=flow_name):
+                block = list(islice(reader, MAX_ES_ROW_INJECT))
+            if not len(block):
+                break
+            metrics.inc("rows_read_total", len(block), flow=flow_name)
+            yield partial(format_block, lookup_table, block, headers, object_name)
+            progress.update(len(block))
+        progress.close()
     return []
 
 
-def process_file(lookup_table, index_name, bucket_name, object_name):
+def sniff_dialect(source, csv_file_path):
+    with open(csv_file_path, "r", newline="") as fp:
+        return dialects.resolve(source, fp.read(SNIFF_SAMPLE_BYTES))
+
+
+def format_chunk(lookup_table, frame, columns, filename):
+    prepare_locations(
+        lookup_table,
+        columnar.pick_nonempty_column(frame, columns["location"]).dropna(),
+    )
+    with metrics.timer("format_seconds", flow=flow_name):
+        return format_frame(lookup_table, frame, columns, filename)
+
+
+def parse_file_columnar(lookup_table, minio_client, bucket_name, object_name):
+    """Yields chunks of rows to format (see `format_chunk`), parsed with pandas"""
+    with minio_source.open_object(
+        minio_client, bucket_name, object_name, SNIFF_SAMPLE_BYTES
+    ) as (sample, fp):
+        try:
+            with metrics.timer("sniff_seconds", flow=flow_name):
+                dialect, _ = dialects.resolve(f"{bucket_name}/{object_name}", sample)
+        except Exception as e:
+            logger.error(e)
+            return []
+
+        columns = None
+        chunks = columnar.read_csv_chunks(fp, dialect, MAX_ES_ROW_INJECT)
+        for frame in tqdm(chunks, unit="chunk"):
+            metrics.inc("rows_read_total", len(frame), flow=flow_name)
+            if columns is None:
+                columns = columnar.resolve_columns(list(frame.columns), columns_allowed)
+            yield partial(format_chunk, lookup_table, frame, columns, object_name)
+    return []
+
+
+def parse_file_parquet(lookup_table, minio_client, obj):
+    """Yields chunks of rows to format (see `format_chunk`), read from Parquet
+
+    The object is converted first if it is new or changed.
+    """
+    manifest = curated.normalize_object(minio_client, obj, layout)
+    columns = columnar.resolve_columns(manifest["columns"], columns_allowed)
+    needed = sorted(
+        {column for candidates in columns.values() for column in candidates}
+    )
+    frames = curated.read_frames(minio_client, manifest, needed, MAX_ES_ROW_INJECT)
+    for frame in tqdm(frames, unit="chunk"):
+        metrics.inc("rows_read_total", len(frame), flow=flow_name)
+        yield partial(format_chunk, lookup_table, frame, columns, obj.object_name)
+    return []
+
+
+def parse_file_parallel(lookup_table, minio_client, bucket_name, object_name):
+    """Yields formatted rows, parsed by chunks of the file in a pool of processes"""
+    # Workers seek to their own chunk of the file, it has to be on disk
+    with minio_source.spill_object(
+        minio_client, bucket_name, object_name
+    ) as csv_file_path:
+        try:
+            with metrics.timer("sniff_seconds", flow=flow_name):
+                dialect, fast = sniff_dialect(
+                    f"{bucket_name}/{object_name}", csv_file_path
+                )
+        except Exception as e:
+            logger.error(e)
+            return []
+        prepare_locations(
+            lookup_table,
+            geocoding.distinct_values(
+                csv_file_path, dialect, columns_allowed["location"]
+            ),
+        )
+
+        def make_formatter(headers_list):
+            headers = {header: i for i, header in enumerate(headers_list)}
+            return lambda row: format_row(lookup_table, row, headers, object_name)
+
+        nb_rows = 0
+        try:
+            for row in tqdm(
+                parallel_parse.parse_file_parallel(
+                    csv_file_path, dialect, make_formatter, fast
+                ),
+                unit="entry",
+            ):
+                nb_rows += 1
+                yield row
+        finally:
+            metrics.inc("rows_read_total", nb_rows, flow=flow_name)
+    return []
+
+
+def process_file(
+    lookup_table, index_name, bucket_name, object_name, obj=None, progress=None
+):
     minio_client = Minio(
         MINIO_ENDPOINT,
         access_key=MINIO_ACCESS_KEY,
         secret_key=MINIO_SECRET_KEY,
         secure=MINIO_SCHEME == "https",
     )
-    to_inject = []
-    logger.info(f"Processing {object_name}...")
-    for row in parse_file(lookup_table, minio_client, bucket_name, object_name):
-        if row is not None:
-            to_inject.append(row)
-            if len(to_inject) >= MAX_ES_ROW_INJECT:
-                inject_rows_to_es(to_inject, index_name)
-                to_inject = []
-        else:
-            logger.info("Invalid row")
-    if len(to_inject) > 0:
-        inject_rows_to_es(to_inject, index_name)
+    document_ids = documents.DocumentIds(object_name)
+    logger.info(f"Processing {object_name} ({INGEST_ENGINE})...")
+    if INGEST_ENGINE == "columnar":
+        batches = parse_file_columnar(
+            lookup_table, minio_client, bucket_name, object_name
+        )
+    elif INGEST_ENGINE == "parallel":
+        batches = pipeline.batched(
+            parse_file_parallel(lookup_table, minio_client, bucket_name, object_name),
+            MAX_ES_ROW_INJECT,
+        )
+    elif INGEST_ENGINE == "parquet":
+        if obj is None:
+            obj = minio_client.stat_object(bucket_name, object_name)
+        batches = parse_file_parquet(lookup_table, minio_client, obj)
+    else:
+        batches = parse_file(lookup_table, minio_client, bucket_name, object_name)
+    pipeline.ingest(
+        flow_name,
+        batches,
+        index_name,
+        lambda rows: rows_ids(rows, document_ids),
+        progress,
+    )
 
 
 def get_files(bucket_name):
@@ -215,79 +411,66 @@ def get_files(bucket_name):
 
 
 class ParseFiles(Task):
-    def run(self, lookup_table, index_name):
-        logger.info(lookup_table)
-        for file in tqdm(get_files(bucket_name=bucket_name)):
-            object_name = file.object_name
-            try:
-                logger.info(f"Processing file {object_name}...")
-                process_file(lookup_table, index_name, bucket_name, object_name)
-            except Exception as e:
-                logger.error(traceback.format_exc())
-                logger.error(e)
-                logger.error(f"Can't process file {object_name}")
+    def run(self, index_name):
+        with bulk_load.bulk_load(index_name):
+            lookup_table = get_lookup_table()
+            settings = ingest_progress.ingest_settings(INGEST_ENGINE, MAX_ES_ROW_INJECT)
+            progresses = []
+            for file in tqdm(get_files(bucket_name=bucket_name)):
+                object_name = file.object_name
+                progress = ingest_progress.ObjectProgress(index_name, file, settings)
+                progresses.append(progress)
+                if progress.complete:
+                    continue
+                try:
+                    logger.info(f"Processing file {object_name}...")
+                    with metrics.timer("file_seconds", flow=flow_name):
+                        process_file(
+                            lookup_table,
+                            index_name,
+                            bucket_name,
+                            object_name,
+                            file,
+                            progress,
+                        )
+                except Exception as e:
+                    logger.error(traceback.format_exc())
+                    logger.error(e)
+                    logger.error(f"Can't process file {object_name}")
+            ingest_progress.finish_load(index_name, progresses)
+        return metrics.report(flow_name)
 
 
 class GenerateEsMapping(Task):
     def run(self, index_name) -> str:
         """
         Returns:
-            str: index_name
+            str: name of the index to write to
         """
-        es_inst = get_es_instance()
+        es_inst = es_client.get_es_instance()
         logger.info("Generating mapping for index {}".format(index_name))
-        es_inst.indices.delete(index=index_name, ignore=[400, 404])
-        response = es_inst.indices.create(
-            index=index_name, body=mapping, ignore=400  # ignore 400 already exists code
+        return index_generations.prepare_index(
+            es_inst, index_name, mapping, resume=True
         )
-        if "acknowledged" in response:
-            if response["acknowledged"] == True:
-                logger.info(
-                    "INDEX MAPPING SUCCESS FOR INDEX: {}".format(response["index"])
-                )
-            elif "error" in response:
-                logger.error(response["error"]["root_cause"])
-                logger.error("Error type: {}".format(response["error"]["type"]))
-                raise Exception("Unable to create index mapping")
-        return index_name
-
-
-def read_lookup_table(lookup_file_path: str):
-    logger.info("Loading lookup table...")
-    lookup = {}
-    with open(lookup_file_path, "r", newline="") as fp:
-        char_read = 10000 if os.path.getsize(lookup_file_path) > 10000 else None
-        dialect = clevercsv.Sniffer().sniff(fp.read(char_read), verbose=True)
-        fp.seek(0)
-        reader = clevercsv.reader(fp, dialect)
-        next(reader)
-        for row in tqdm(reader, unit="entry"):
-            for location in [
-                row[6],  # Province_State
-                row[7],  # Country_Region
-                row[10],  # Combined_Key
-            ]:
-                if location and location not in lookup:
-                    if row[8] and row[9]:  # Lat, Long
-                        lookup[location] = (
-                            {"lat": float(row[8]), "lon": float(row[9])},
-                            row[1],
-                        )
-    logger.info(f"Found {len(lookup)} locations.")
-    return lookup
 
 
-lookup_table = read_lookup_table("/usr/app/UID_ISO_FIPS_LookUp_Table.csv")
-
 schedule = IntervalSchedule(
     start_date=datetime.utcnow() + timedelta(seconds=1), interval=timedelta(hours=24)
 )
 with Flow(flow_name, schedule=schedule) as flow:
     es_mapping_task = GenerateEsMapping()
-    index_name = es_mapping_task(index_name)
+    write_index_name = es_mapping_task(index_name)
 
     parse_files_task = ParseFiles()
-    parse_files_task(lookup_table=lookup_table, index_name=index_name)
+    parse_files = parse_files_task(index_name=write_index_name)
+
+    publish_index_task = index_generations.PublishIndex()
+    publish_index = publish_index_task(
+        index_name, write_index_name, upstream_tasks=[parse_files]
+    )
+
+    update_rollups_task = rollups.UpdateRollups()
+    update_rollups_task(index_name, upstream_tasks=[publish_index])
 
 if __name__ == "__main__":
 
@@ -0,0 +1,169 @@
+import os
+import sys
+import csv
+import mmap
+import struct
+import threading
+from collections import namedtuple
+
+from state import state_path
+
+LOOKUP_TABLE_CSV = (
+    os.environ.get("LOOKUP_TABLE_CSV") or "/usr/app/UID_ISO_FIPS_LookUp_Table.csv"
+)
+LOOKUP_TABLE_PATH = os.environ.get("LOOKUP_TABLE_PATH")
+
+# File layout: header, one section descriptor per kind, sections entries
+# (sorted by name) then all names (UTF-8). Entries point to their name.
+HEADER = struct.Struct("<4sI")  # magic, version
+SECTION = struct.Struct("<II")  # entries offset, entries count
+ENTRY = struct.Struct("<IHdd2sq")  # name offset, name length, lat, lon, iso2, pop.
+MAGIC = b"PKLT"
+VERSION = 1
+
+# "any" resolves a name in any column, the first row mentioning it wins
+KINDS = ("any", "province_state", "country_region", "combined_key")
+COLUMNS = {"province_state": 6, "country_region": 7, "combined_key": 10}
+
+LookupRecord = namedtuple("LookupRecord", ["lat", "lon", "iso_code2", "population"])
+
+_lookup_table = None
+_lookup_table_lock = threading.Lock()
+
+
+def build(csv_path: str, output_path: str):
+    """Compiles the UID_ISO_FIPS lookup table CSV into a binary lookup table"""
+    sections = {kind: {} for kind in KINDS}
+    with open(csv_path, "r", newline="") as fp:
+        reader = csv.reader(fp)
+        next(reader)
+        for row in reader:
+            if not row[8] or not row[9]:  # Lat, Long
+                continue
+            record = LookupRecord(
+                float(row[8]), float(row[9]), row[1], int(row[11] or 0)
+            )
+            for kind, column in COLUMNS.items():
+                if row[column]:
+                    sections[kind].setdefault(row[column], record)
+                    sections["any"].setdefault(row[column], record)
+
+    names, names_offsets = bytearray(), {}
+    for section in sections.values():
+        for name in section:
+            if name not in names_offsets:
+                names_offsets[name] = len(names)
+                names += name.encode("utf-8")
+
+    offset = HEADER.size + SECTION.size * len(KINDS)
+    names_start = offset + ENTRY.size * sum(
+        len(section) for section in sections.values()
+    )
+    descriptors, entries = [], bytearray()
+    for kind in KINDS:
+        section = sorted(
+            sections[kind].items(), key=lambda item: item[0].encode("utf-8")
+        )
+        descriptors.append(SECTION.pack(offset + len(entries), len(section)))
+        for name, record in section:
+            entries += ENTRY.pack(
+                names_start + names_offsets[name],
+                len(name.encode("utf-8")),
+                record.lat,
+                record.lon,
+                record.iso_code2.encode("ascii"),
+                record.population,
+            )
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION))
+        fp.write(b"".join(descriptors))
+        fp.write(entries)
+        fp.write(names)
+    os.replace(tmp_path, output_path)
+
+
+class LookupTable:
+    """Read-only, memory-mapped lookup table
+
+    Behaves like the former {name: (location, iso_code2)} dict, and is
+    shared through the page cache by every process opening it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as fp:
+            self.buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a lookup table (version {VERSION})")
+        self.sections = {
+            kind: SECTION.unpack_from(self.buffer, HEADER.size + i * SECTION.size)
+            for i, kind in enumerate(KINDS)
+        }
+
+    def __reduce__(self):
+        # Pickled (e.g. to the parallel parse workers) as its path, mapped again
+        return LookupTable, (self.path,)
+
+    def record(self, name: str, kind: str = "any"):
+        """LookupRecord of a location name, None if unknown"""
+        offset, count = self.sections[kind]
+        needle = name.encode("utf-8")
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            entry = ENTRY.unpack_from(self.buffer, offset + middle * ENTRY.size)
+            candidate = self.buffer[entry[0] : entry[0] + entry[1]]
+            if candidate < needle:
+                low = middle + 1
+            elif candidate > needle:
+                high = middle
+            else:
+                iso_code2 = entry[4].rstrip(b"\0").decode("ascii")
+                return LookupRecord(entry[2], entry[3], iso_code2, entry[5])
+        return None
+
+    def get(self, name: str, default=None, kind: str = "any"):
+        record = self.record(name, kind) if name else None
+        if record is None:
+            return default
+        return ({"lat": record.lat, "lon": record.lon}, record.iso_code2)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __getitem__(self, name):
+        location = self.get(name)
+        if location is None:
+            raise KeyError(name)
+        return location
+
+    def __len__(self):
+        return self.sections["any"][1]
+
+
+def get_lookup_table_path() -> str:
+    return LOOKUP_TABLE_PATH or state_path("lookup_table.bin")
+
+
+def get_lookup_table() -> LookupTable:
+    """Opens the lookup table, compiling it first if missing or outdated"""
+    global _lookup_table
+    with _lookup_table_lock:
+        if _lookup_table is None:
+            path = get_lookup_table_path()
+            csv_mtime = os.path.getmtime(LOOKUP_TABLE_CSV)
+            if not os.path.exists(path) or os.path.getmtime(path) < csv_mtime:
+                build(LOOKUP_TABLE_CSV, path)
+            _lookup_table = LookupTable(path)
+        return _lookup_table
+
+
+if __name__ == "__main__":
+    # python3 lookup_table.py [lookup_table.csv] [lookup_table.bin]
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else LOOKUP_TABLE_CSV
+    output_path = sys.argv[2] if len(sys.argv) > 2 else get_lookup_table_path()
+    build(csv_path, output_path)
+    print(f"Compiled {csv_path} into {output_path}")
@@ -24,6 +24,7 @@ mapping = {
             "iso_region2": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
             "max_population": {"type": "long"},
             "percentage": {"type": "float"},
+            "content_hash": {"type": "keyword", "index": False},
         }
     }
 }
\ No newline at end of file
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import bisect
+import prefect
+import threading
+import urllib.request
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT") or 0)  # 0: no endpoint
+METRICS_PUSHGATEWAY = os.environ.get("METRICS_PUSHGATEWAY")  # e.g. http://host:9091
+METRICS_PREFIX = "pandemic_knowledge_"
+
+# Upper bounds of histograms buckets, in seconds, bytes (*_bytes) or
+# documents (*_documents)
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+BYTES_BUCKETS = tuple(4**i for i in range(5, 15))  # 1 KiB to 256 MiB
+DOCUMENTS_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+logger = prefect.context.get("logger")
+
+
+def buckets_of(name: str) -> tuple:
+    if name.endswith("_bytes"):
+        return BYTES_BUCKETS
+    if name.endswith("_documents"):
+        return DOCUMENTS_BUCKETS
+    return SECONDS_BUCKETS
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry:
+    """Counters and histograms, labelled like Prometheus' ones
+
+    Increments take a lock: record per batch of rows rather than per row.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # key: [count per bucket (+Inf last), sum]
+
+    def inc(self, name: str, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value, **labels):
+        buckets = buckets_of(name)
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+
+    def drain(self) -> tuple:
+        """Everything recorded so far, forgotten afterwards (see `merge`)"""
+        with self.lock:
+            drained = self.counters, self.histograms
+            self.counters, self.histograms = {}, {}
+        return drained
+
+    def merge(self, drained: tuple):
+        """Adds what another process recorded (and drained)"""
+        counters, histograms = drained
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (counts, total) in histograms.items():
+                histogram = self.histograms.setdefault(key, [[0] * len(counts), 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+
+    def summary(self) -> dict:
+        """JSON-serializable snapshot, histograms with estimated percentiles"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h[0]), h[1]) for key, h in self.histograms.items()}
+        summary = {"counters": {}, "histograms": {}}
+        for (name, labels), value in sorted(counters.items()):
+            summary["counters"].setdefault(name, []).append(
+                {"labels": dict(labels), "value": value}
+            )
+        for (name, labels), (counts, total) in sorted(histograms.items()):
+            buckets = buckets_of(name)
+            count = sum(counts)
+            summary["histograms"].setdefault(name, []).append(
+                {
+                    "labels": dict(labels),
+                    "count": count,
+                    "sum": total,
+                    "mean": total / count if count else None,
+                    "p50": _percentile(buckets, counts, 0.5),
+                    "p95": _percentile(buckets, counts, 0.95),
+                }
+            )
+        return summary
+
+    def prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h[0]), h[1]) for key, h in self.histograms.items()}
+        lines, typed = [], set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{METRICS_PREFIX}{name}{_labels(labels)} {value}")
+        for (name, labels), (counts, total) in sorted(histograms.items()):
+            buckets = buckets_of(name)
+            if name not in typed:
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+                typed.add(name)
+            cumulated = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], counts):
+                cumulated += count
+                bucket_labels = _labels(labels + (("le", bound),))
+                lines.append(
+                    f"{METRICS_PREFIX}{name}_bucket{bucket_labels} {cumulated}"
+                )
+            lines.append(f"{METRICS_PREFIX}{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{METRICS_PREFIX}{name}_count{_labels(labels)} {cumulated}")
+        return "\n".join(lines) + "\n"
+
+
+def _percentile(buckets, counts, ratio):
+    """Upper bound of the bucket holding the percentile"""
+    total = sum(counts)
+    if not total:
+        return None
+    cumulated = 0
+    for bound, count in zip(list(buckets) + [None], counts):
+        cumulated += count
+        if cumulated >= total * ratio:
+            return bound if bound is not None else buckets[-1]
+
+
+def _labels(labels) -> str:
+    if not len(labels):
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+drain = registry.drain
+merge = registry.merge
+summary = registry.summary
+
+_server = None
+_server_lock = threading.Lock()
+
+
+@contextmanager
+def timer(name: str, **labels):
+    """Observes the time spent in the block (even if it raises)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - started, **labels)
+
+
+def serve(port: int = METRICS_PORT):
+    """Serves /metrics from a thread, once per process (no-op without port)"""
+    global _server
+    with _server_lock:
+        if _server is not None or not port:
+            return
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                data = registry.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        try:
+            _server = ThreadingHTTPServer(("", port), Handler)
+        except OSError as e:  # e.g. another flow run serves it
+            logger.warning(f"Can't serve metrics on port {port}: {e}")
+            return
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+
+
+def report(job: str) -> dict:
+    """Logs the summary of a task and pushes it to the Pushgateway, returns it
+
+    What is reported is drained: each task of a run (e.g. a bucket of
+    parse_insert.py) reports its own metrics, not the ones before it. Flow runs
+    are short-lived processes: the Pushgateway keeps the last metrics of each
+    job for Prometheus to scrape.
+    """
+    reported = Registry()
+    reported.merge(drain())
+    run_summary = reported.summary()
+    logger.info(f"Metrics: {json.dumps(run_summary)}")
+    if METRICS_PUSHGATEWAY:
+        request = urllib.request.Request(
+            f"{METRICS_PUSHGATEWAY.rstrip('/')}/metrics/job/{job}",
+            data=reported.prometheus().encode("utf-8"),
+            method="PUT",
+        )
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+        except OSError as e:
+            logger.warning(f"Can't push metrics: {e}")
+    return run_summary
+
+
+serve()
@@ -0,0 +1,128 @@
+import io
+import os
+import queue
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+MINIO_READ_CHUNK_BYTES = int(os.environ.get("MINIO_READ_CHUNK_BYTES") or 1024 * 1024)
+MINIO_PREFETCH_CHUNKS = int(os.environ.get("MINIO_PREFETCH_CHUNKS") or 8)
+SPILL_DIR = os.environ.get("SPILL_DIR") or None  # system's temporary directory
+
+
+class PrefetchedStream(io.RawIOBase):
+    """Raw stream over an HTTP response, downloaded ahead by a thread
+
+    Up to `prefetch` chunks are read while the consumer parses, so network
+    transfer and parsing overlap. Reads are recorded as `<source>_*` metrics.
+    """
+
+    def __init__(
+        self, response, chunk_size: int, prefetch: int, source="minio", **labels
+    ):
+        self.source = source
+        self.labels = labels
+        self.chunks = queue.Queue(maxsize=prefetch)
+        self.stopped = threading.Event()
+        self.current = b""
+        self.eof = False
+        self.thread = threading.Thread(
+            target=self._download, args=(response, chunk_size), daemon=True
+        )
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _download(self, response, chunk_size):
+        try:
+            while not self.stopped.is_set():
+                with metrics.timer(f"{self.source}_read_seconds", **self.labels):
+                    chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                metrics.inc(f"{self.source}_bytes_total", len(chunk), **self.labels)
+                self._put(chunk)
+            self._put(b"")
+        except Exception as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def peek(self, size: int) -> bytes:
+        """First `size` bytes (or less at the end), read again by next reads"""
+        sample = b""
+        while len(sample) < size:
+            chunk = self.read(size - len(sample))
+            if not chunk:
+                break
+            sample += chunk
+        self.current = sample + self.current
+        return sample
+
+    def readinto(self, buffer):
+        while not self.current and not self.eof:
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            self.current, self.eof = chunk, not chunk
+        size = min(len(buffer), len(self.current))
+        buffer[:size] = self.current[:size]
+        self.current = self.current[size:]
+        return size
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        super().close()
+
+
+@contextmanager
+def open_object(minio_client, bucket_name: str, object_name: str, sample_size: int):
+    """Streams an object as text
+
+    Yields (sample, stream): the first `sample_size` bytes of the object as
+    text (to sniff its dialect) and the whole object as a text stream,
+    sample included.
+    """
+    response = minio_client.get_object(bucket_name, object_name)
+    raw_stream = PrefetchedStream(
+        response, MINIO_READ_CHUNK_BYTES, MINIO_PREFETCH_CHUNKS, bucket=bucket_name
+    )
+    try:
+        sample = raw_stream.peek(sample_size)
+        text_stream = io.TextIOWrapper(
+            io.BufferedReader(raw_stream, buffer_size=MINIO_READ_CHUNK_BYTES),
+            encoding="utf-8",
+            newline="",
+        )
+        yield sample.decode("utf-8", errors="ignore"), text_stream
+    finally:
+        raw_stream.close()
+        response.close()
+        response.release_conn()
+
+
+@contextmanager
+def spill_object(minio_client, bucket_name: str, object_name: str):
+    """Downloads an object for readers needing to seek, yields its path
+
+    The file is removed when leaving the context, whatever happens.
+    """
+    fd, file_path = tempfile.mkstemp(prefix="pandemic-knowledge-", dir=SPILL_DIR)
+    os.close(fd)
+    try:
+        with metrics.timer("minio_spill_seconds", bucket=bucket_name):
+            minio_client.fget_object(bucket_name, object_name, file_path)
+        metrics.inc("minio_bytes_total", os.path.getsize(file_path), bucket=bucket_name)
+        yield file_path
+    finally:
+        os.remove(file_path)
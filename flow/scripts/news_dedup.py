@@ -0,0 +1,319 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import es_client
+import metrics
+from state import state_path
+
+NEWS_DEDUP_THRESHOLD = float(os.environ.get("NEWS_DEDUP_THRESHOLD") or 0.7)
+NEWS_DEDUP_RETENTION_DAYS = int(os.environ.get("NEWS_DEDUP_RETENTION_DAYS") or 30)
+
+# Changing them invalidates the signatures already stored
+PERMUTATIONS = 128
+BANDS = 32  # of 4 rows: pairs similar at 0.7 share a band 99.9% of the time
+SHINGLE_SIZE = 5  # characters
+MIN_SHINGLES = 8  # below, texts are too short to be compared safely
+MIN_TITLE_LENGTH = 20  # characters, for titles to be matched exactly
+
+_prime = 4294967311  # above 2**32
+_random = np.random.RandomState(20210501)
+_a = _random.randint(1, 2**31, size=PERMUTATIONS, dtype=np.uint64)
+_b = _random.randint(0, 2**31, size=PERMUTATIONS, dtype=np.uint64)
+
+tracking_params = re.compile(r"^(utm_\w+|fbclid|gclid|ref|ref_src|s)$")
+source_fields = ["crawler", "website", "author", "url"]
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def normalize_url(url: str) -> str:
+    """URL without scheme, www, fragment, tracking parameters nor trailing /"""
+    parts = urlsplit(url if "//" in url else "//" + url)
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = urlencode(
+        sorted(
+            (key, value)
+            for key, value in parse_qsl(parts.query)
+            if not tracking_params.match(key)
+        )
+    )
+    return urlunsplit(("", host, parts.path.rstrip("/"), query, ""))[2:]
+
+
+def normalize_text(text: str) -> str:
+    """Lower case words without accents nor punctuation"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.findall(r"\w+", text.casefold()))
+
+
+def signature(text: str):
+    """MinHash signature of the text's shingles, None if it is too short"""
+    shingles = {text[i : i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    hashes = np.array(
+        [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles], dtype=np.uint64
+    )
+    # a * hash + b stays below 2**63
+    permuted = (np.outer(hashes, _a) + _b) % np.uint64(_prime)
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def similarity(signature_a, signature_b) -> float:
+    """Estimated Jaccard similarity of two texts"""
+    return float(np.mean(signature_a == signature_b))
+
+
+def band_buckets(signature) -> list:
+    """LSH buckets of a signature, one per band"""
+    buckets = []
+    for band, rows in enumerate(np.split(signature, BANDS)):
+        buckets.append(f"{band}:{hashlib.sha1(rows.tobytes()).hexdigest()[:16]}")
+    return buckets
+
+
+def to_json(value):
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def dumps(document: dict) -> str:
+    return json.dumps(document, default=to_json)
+
+
+class SignatureStore:
+    """Canonical news, their exact keys and LSH buckets, persisted in SQLite
+
+    News are forgotten NEWS_DEDUP_RETENTION_DAYS after they were last seen.
+    A news saved is pending until ES acknowledges this very document (see
+    `mark_shipped`).
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            # A commit per news: durable enough in WAL mode, and much faster
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS news (
+                    id TEXT PRIMARY KEY,
+                    index_name TEXT NOT NULL,
+                    document TEXT NOT NULL,
+                    signature BLOB,
+                    seen_at REAL NOT NULL,
+                    shipped INTEGER NOT NULL DEFAULT 1
+                )"""
+            )
+            columns = [
+                column[1] for column in self.conn.execute("PRAGMA table_info(news)")
+            ]
+            if "shipped" not in columns:  # stores from before, news were shipped
+                self.conn.execute(
+                    "ALTER TABLE news ADD COLUMN shipped INTEGER NOT NULL DEFAULT 1"
+                )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS news_keys (
+                    key TEXT PRIMARY KEY,
+                    id TEXT NOT NULL
+                )"""
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS news_buckets (
+                    bucket TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    PRIMARY KEY (bucket, id)
+                ) WITHOUT ROWID"""
+            )
+
+    def prune(self, retention_days: int):
+        expired = time.time() - retention_days * 86400
+        with self.lock, self.conn:
+            ids = "SELECT id FROM news WHERE seen_at < ?"
+            self.conn.execute(f"DELETE FROM news_keys WHERE id IN ({ids})", (expired,))
+            self.conn.execute(
+                f"DELETE FROM news_buckets WHERE id IN ({ids})", (expired,)
+            )
+            self.conn.execute("DELETE FROM news WHERE seen_at < ?", (expired,))
+
+    def find_key(self, keys: list):
+        """(id, key) of the news known by one of the keys, or (None, None)"""
+        with self.lock, self.conn:
+            for key in keys:
+                entry = self.conn.execute(
+                    "SELECT id FROM news_keys WHERE key = ?", (key,)
+                ).fetchone()
+                if entry is not None:
+                    return entry[0], key
+        return None, None
+
+    def find_similar(self, buckets: list, signature, threshold: float):
+        """Id of the most similar news sharing a bucket, if similar enough"""
+        with self.lock, self.conn:
+            candidates = self.conn.execute(
+                f"""SELECT news.id, news.signature FROM news
+                WHERE news.id IN (SELECT id FROM news_buckets
+                    WHERE bucket IN ({",".join("?" * len(buckets))}))""",
+                buckets,
+            ).fetchall()
+        best, best_similarity = None, threshold
+        for _id, candidate in candidates:
+            if candidate is None:
+                continue
+            score = similarity(signature, np.frombuffer(candidate, dtype=np.uint32))
+            if score >= best_similarity:
+                best, best_similarity = _id, score
+        return best
+
+    def get(self, _id: str):
+        """(index name, document, shipped or pending) of a canonical news"""
+        with self.lock, self.conn:
+            entry = self.conn.execute(
+                "SELECT index_name, document, shipped FROM news WHERE id = ?", (_id,)
+            ).fetchone()
+        return entry[0], json.loads(entry[1]), bool(entry[2])
+
+    def add(self, _id: str, index_name: str, document: dict, signature, keys, buckets):
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO news (id, index_name, document, signature,
+                    seen_at, shipped)
+                VALUES (?, ?, ?, ?, ?, 0)""",
+                (
+                    _id,
+                    index_name,
+                    dumps(document),
+                    signature.tobytes() if signature is not None else None,
+                    time.time(),
+                ),
+            )
+            self._add_keys(_id, keys, buckets)
+
+    def update(self, _id: str, document: dict, keys, buckets):
+        """Saves a canonical news, also known by its duplicate's keys from now
+
+        It is pending again if the document changed.
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                """UPDATE news SET shipped = shipped AND document = ?,
+                    document = ?, seen_at = ?
+                WHERE id = ?""",
+                (dumps(document), dumps(document), time.time(), _id),
+            )
+            self._add_keys(_id, keys, buckets)
+
+    def mark_shipped(self, documents: dict):
+        """Acknowledged news, {id: document as saved when shipped}
+
+        News saved again since (with one more source) stay pending.
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE news SET shipped = 1 WHERE id = ? AND document = ?",
+                list(documents.items()),
+            )
+
+    def _add_keys(self, _id: str, keys, buckets):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO news_keys (key, id) VALUES (?, ?)",
+            [(key, _id) for key in keys],
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO news_buckets (bucket, id) VALUES (?, ?)",
+            [(bucket, _id) for bucket in buckets],
+        )
+
+
+def get_store() -> SignatureStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SignatureStore(state_path("news_dedup.sqlite"))
+            _store.prune(NEWS_DEDUP_RETENTION_DAYS)
+        return _store
+
+
+def source_of(row: dict) -> dict:
+    source = {field: row.get(f"source.{field}") for field in source_fields}
+    source.update(date=to_json(row.get("date")), lang=row.get("lang"))
+    return {key: value for key, value in source.items() if value is not None}
+
+
+def ship_rows(rows: list, index_name: str, ids: list, titled: bool = True):
+    """Ships news like es_client.ship_rows, collapsing the duplicates
+
+    A news whose normalized URL or title, or whose title and description
+    (description alone if not `titled`, e.g. tweets) are near-identical to
+    those of a news seen before, in any news index, is not shipped: the
+    canonical news it duplicates is shipped again with one more source.
+    Canonical news not acknowledged by ES (e.g. dead-lettered) are shipped
+    again when crawled again.
+    """
+    store = get_store()
+    batches = {}  # index name: {id: document}
+    for row, _id in zip(rows, ids):
+        keys = []
+        if row.get("source.url"):
+            keys.append("url:" + normalize_url(row["source.url"]))
+        title = normalize_text(row.get("title")) if titled else ""
+        if len(title) >= MIN_TITLE_LENGTH:
+            keys.append("title:" + title)
+        text = normalize_text(
+            f"{row.get('title') or ''} {row.get('desc') or ''}"
+            if titled
+            else row.get("desc")
+        )
+        row_signature = signature(text)
+        buckets = band_buckets(row_signature) if row_signature is not None else []
+
+        canonical_id, key = store.find_key(keys)
+        match = key.split(":", 1)[0] if key is not None else "minhash"
+        if canonical_id is None and row_signature is not None:
+            canonical_id = store.find_similar(
+                buckets, row_signature, NEWS_DEDUP_THRESHOLD
+            )
+        if canonical_id is None:
+            document = dict(row, sources=[source_of(row)], sources_count=1)
+            store.add(_id, index_name, document, row_signature, keys, buckets)
+            batches.setdefault(index_name, {})[_id] = document
+            continue
+
+        canonical_index, document, shipped = store.get(canonical_id)
+        source = source_of(row)
+        known_urls = {
+            normalize_url(known.get("url", "")) for known in document["sources"]
+        }
+        if normalize_url(source.get("url", "")) in known_urls:  # crawled again
+            metrics.inc("news_recrawled_total", index=index_name)
+            store.update(canonical_id, document, keys, [])
+            if not shipped:  # not acknowledged (yet): shipped again
+                batches.setdefault(canonical_index, {})[canonical_id] = document
+            continue
+        metrics.inc("news_duplicates_total", index=index_name, match=match)
+        document["sources"].append(source)
+        document["sources_count"] = len(document["sources"])
+        store.update(canonical_id, document, keys, buckets)
+        batches.setdefault(canonical_index, {})[canonical_id] = document
+
+    for batch_index, batch in batches.items():
+        saved = {_id: dumps(document) for _id, document in batch.items()}
+        es_client.ship_batch(
+            es_client.prepare_rows(list(batch.values()), batch_index, list(batch)),
+            lambda ids, saved=saved: store.mark_shipped(
+                {_id: saved[_id] for _id in ids}
+            ),
+        )
@@ -0,0 +1,98 @@
+import io
+import os
+from multiprocessing import get_context
+
+import cloudpickle
+
+import metrics
+import dialects
+
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS") or os.cpu_count() or 1)
+PARSE_CHUNK_BYTES = int(os.environ.get("PARSE_CHUNK_BYTES") or 8 * 1024 * 1024)
+
+# Set in each worker when it starts (see `_start_worker`)
+_job = {}
+
+
+def _is_record_start(line: bytes, dialect, nb_columns: int, fast: bool) -> bool:
+    try:
+        rows = list(dialects.reader(io.StringIO(line.decode("utf-8")), dialect, fast))
+    except Exception:
+        return False
+    return len(rows) == 1 and len(rows[0]) == nb_columns
+
+
+def split_ranges(
+    fp, start: int, size: int, dialect, nb_columns: int, fast: bool = False
+) -> list:
+    """Splits a file into byte ranges starting and ending on record boundaries
+
+    A range starts after a newline, on the first line that parses as a full
+    record: it is the only guess we can make in the middle of a file.
+    """
+    boundaries = [start]
+    nb_chunks = max(1, (size - start) // PARSE_CHUNK_BYTES)
+    for i in range(1, nb_chunks):
+        fp.seek(max(start + i * (size - start) // nb_chunks, boundaries[-1]))
+        fp.readline()  # partial line
+        offset = fp.tell()
+        line = fp.readline()
+        while line and not _is_record_start(line, dialect, nb_columns, fast):
+            offset = fp.tell()
+            line = fp.readline()
+        if line and offset > boundaries[-1]:
+            boundaries.append(offset)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _start_worker(job: bytes):
+    # Pickled by cloudpickle: flows functions may not be importable here
+    _job.update(cloudpickle.loads(job))
+
+
+def _parse_range(byte_range) -> list:
+    start, end = byte_range
+    with open(_job["file_path"], "rb") as fp:
+        fp.seek(start)
+        data = fp.read(end - start).decode("utf-8")
+    reader = dialects.reader(
+        io.StringIO(data, newline=""), _job["dialect"], _job["fast"]
+    )
+    rows = [_job["format_row"](row) for row in reader if len(row)]
+    return rows, metrics.drain()  # workers metrics are merged by the parent
+
+
+def parse_file_parallel(file_path: str, dialect, make_formatter, fast: bool = False):
+    """Yields each formatted row of a file, parsed by a pool of processes
+
+    The header is read first, `make_formatter(headers)` returns the function
+    formatting the following rows (lists of cells), or None if the file can't
+    be processed. Rows are yielded in file order. `fast` rows are read by the
+    C reader (see dialects.resolve).
+
+    Workers are forked from a fresh server process rather than from this one,
+    running other threads (whose locks a fork could copy held): the formatter
+    is pickled to them with what it references. Flow modules may be imported
+    again there, locations are then found in the geocoding store.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as fp:
+        header_line = fp.readline()
+        headers = next(
+            dialects.reader(io.StringIO(header_line.decode("utf-8")), dialect, fast)
+        )
+        ranges = split_ranges(fp, fp.tell(), size, dialect, len(headers), fast)
+
+    format_row = make_formatter(headers)
+    if format_row is None:
+        return
+    job = cloudpickle.dumps(
+        dict(file_path=file_path, dialect=dialect, fast=fast, format_row=format_row)
+    )
+    with get_context("forkserver").Pool(
+        min(PARSE_WORKERS, len(ranges)), initializer=_start_worker, initargs=(job,)
+    ) as pool:
+        for rows, worker_metrics in pool.imap(_parse_range, ranges):
+            metrics.merge(worker_metrics)
+            yield from rows
@@ -1,30 +1,42 @@
 import os
-import re
-import uuid
 import prefect
-import clevercsv
+import threading
 from tqdm import tqdm
+from itertools import islice
+from functools import partial
 from datetime import datetime, timedelta
 from prefect import Flow, Task, Client
 from minio import Minio
-from elasticsearch import Elasticsearch, helpers
 from ssl import create_default_context
-from geopy.geocoders import Nominatim
-from iso3166 import countries
 from prefect.schedules import IntervalSchedule
 
 from mapping import mapping
+import batches
+import documents
+import es_client
+import index_generations
+import ingest_progress
+import bulk_load
+import columnar
+import curated
+import dates
+import parallel_parse
+import geocoding
+import minio_source
+import dialects
+import metrics
+import pipeline
+import rollups
 
 MINIO_SCHEME = os.environ.get("MINIO_SCHEME")
 MINIO_ENDPOINT = os.environ.get("MINIO_ENDPOINT")
 MINIO_ACCESS_KEY = os.environ.get("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = os.environ.get("MINIO_SECRET_KEY")
 MAX_ES_ROW_INJECT = int(os.environ.get("MAX_ES_ROW_INJECT", 1000))
-ELASTIC_SCHEME = os.environ.get("ELASTIC_SCHEME")
-ELASTIC_PORT = os.environ.get("ELASTIC_PORT")
-ELASTIC_USER = os.environ.get("ELASTIC_USER")
-ELASTIC_PWD = os.environ.get("ELASTIC_PWD")
-ELASTIC_ENDPOINT = os.environ.get("ELASTIC_ENDPOINT")
+SNIFF_SAMPLE_BYTES = 100000
+INGEST_ENGINE = pipeline.ingest_engine(
+    "parse_insert", ("row", "columnar", "parallel", "parquet")
+)
 
 columns_allowed = {
     "date": ["YearWeekISO", "dateRep", "date"],
@@ -37,181 +49,413 @@ logger = prefect.context.get("logger")
 
 extra_locations = {"EL": "GR"}
 
-locations_cache = {"World": None}
+locations_cache = geocoding.LocationCache({"World": None})
 
+date_normalizer = dates.DateNormalizer(formats=("iso_week", "dmy", "iso"))
 
-def get_es_instance():
-    es_inst = Elasticsearch(
-        [ELASTIC_ENDPOINT],
-        http_auth=(ELASTIC_USER, ELASTIC_PWD),
-        scheme=ELASTIC_SCHEME,
-        port=ELASTIC_PORT,
-        verify_certs=False,
-    )
-    return es_inst
-
-
-def format_date(date):
-    date = date.replace("/", "-")
-    p = re.compile("(\\d{4})-W(\\d{2})")
-    weekMatches = p.match(date)
-    if weekMatches is not None:
-        groups = weekMatches.groups()
-        date_start = datetime.strptime(
-            f"{groups[0]}-W{int(groups[1]) - 1}-1", "%Y-W%W-%w"
-        ).date()
-        date_end = date_start + timedelta(days=6.9)
-        return date_start.strftime("%Y-%m-%d"), date_end.strftime("%Y-%m-%d")
-    p = re.compile("(\\d{2})-(\\d{2})-(\\d{4})")
-    frDateMatches = p.match(date)
-    if frDateMatches is not None:
-        groups = frDateMatches.groups()
-        date = f"{groups[2]}-{groups[1]}-{groups[0]}"
-        return date, date
-    p = re.compile("(\\d{4})-(\\d{2})-(\\d{2})")
-    dateMatches = p.match(date)
-    if dateMatches is not None:
-        return date, date
-    return None, None
+layout = curated.Layout(
+    columns_allowed,
+    counts=["cases", "population"],
+    parse_date=lambda date, source: (
+        date_normalizer.parse_period(date, source) or (None,)
+    )[0],
+)
 
 
-def format_location(location_name):
-    if location_name in locations_cache:
-        return locations_cache[location_name]
-    geolocator = Nominatim(user_agent="pandemic-knowledge")
-    location = geolocator.geocode(
-        extra_locations[location_name]
-        if location_name in extra_locations
-        else location_name,
-        addressdetails=True,
-    )
+def format_date(date, filename):
+    period = date_normalizer.parse_period(date, filename)
+    if period is None:
+        return None, None
+    return period[0].strftime("%Y-%m-%d"), period[1].strftime("%Y-%m-%d")
 
-    if location is None or "country_code" not in location.raw["address"]:
-        logger.info(location_name)
-        locations_cache[location_name] = None
-        return None
 
-    iso2 = location.raw["address"]["country_code"].upper()
+def geocode(location_name):
+    return geocoding.nominatim_geocode(
+        extra_locations.get(location_name, location_name)
+    )
+
 
-    iso3 = countries.get(iso2).alpha3
+def prepare_locations(location_names):
+    """Geocodes at once the locations not resolved yet"""
+    locations_cache.resolve(location_names, geocode)
 
-    locations_cache[location_name] = (
-        {"lat": location.latitude, "lon": location.longitude},
-        iso2,
-    )
 
+def format_location(location_name):
+    if location_name not in locations_cache:
+        locations_cache.resolve([location_name], geocode)
     return locations_cache[location_name]
 
 
-def format_row(row, columns_indexes, filename, bucket_name):
-    date_start, date_end = format_date(row[columns_indexes["date"]])
-    location = format_location(row[columns_indexes["location"]])
-    if location is None:
-        return None
-    max_population = (
-        int(float(row[columns_indexes["population"]]))
-        if row[columns_indexes["population"]] != ""
-        else 0
-    )
-    cases = (
-        int(float(row[columns_indexes["cases"]]))
-        if row[columns_indexes["cases"]] != ""
-        else 0
-    )
-    percentage = (
-        float(cases) / float(max_population) * 100 if max_population != 0 else None
+def format_frame(frame, columns, filename, bucket_name):
+    """IngestPlan.format() of a chunk of rows parsed by pandas"""
+    locations = columnar.map_distinct(frame[columns["location"]], format_location)
+    valid = locations.notna()
+    columnar.count_rejected(bucket_name, {"location": ~valid})
+    frame, locations = frame[valid], locations[valid]
+    date_periods = columnar.map_distinct(
+        frame[columns["date"]], lambda date: format_date(date, filename)
     )
+    max_population = columnar.to_counts(frame[columns["population"]])
+    cases = columnar.to_counts(frame[columns["cases"]])
+    percentage = (cases / max_population * 100).where(max_population != 0)
 
     formatted = {
-        "date_start": date_start,
-        "date_end": date_end,
-        "location": location[0],
+        "date_start": date_periods.map(lambda period: period[0]),
+        "date_end": date_periods.map(lambda period: period[1]),
+        "location": locations.map(lambda location: location[0]),
         "filename": filename,
-        "iso_code2": location[1],
+        "iso_code2": locations.map(lambda location: location[1]),
         "max_population": max_population,
         "percentage": percentage,
     }
 
     formatted["vaccinated" if bucket_name == "vaccination" else "confirmed"] = cases
 
-    return formatted
+    return columnar.to_batch(formatted, len(frame))
 
 
-def inject_rows_to_es(rows, bucket_name):
-    es_inst = get_es_instance()
+def rows_ids(batch, document_ids):
+    keys = zip(batch.column("iso_code2"), batch.column("date_start"))
+    return [document_ids(*key) for key in keys]
 
-    logger.info("Injecting {} rows in Elasticsearch".format(len(rows)))
 
-    actions = [
-        {"_index": bucket_name, "_id": uuid.uuid4(), "_source": row} for row in rows
-    ]
+def inject_rows_to_es(batch, bucket_name, document_ids):
+    ids = rows_ids(batch, document_ids)
+    logger.info("Injecting {} rows in Elasticsearch".format(len(batch)))
+    es_client.ship_rows(batch, bucket_name, ids)
 
-    helpers.bulk(es_inst, actions)
 
+def get_columns_indexes(headers, object_name):
+    """{name: index} of the first header (in file order) allowed for each column"""
+    columns_indexes = {}
+    for name, allowed in columns_allowed.items():
+        index = next((i for i, header in enumerate(headers) if header in allowed), None)
+        if index is None:
+            logger.error(
+                "Header {} cannot be found in csv {}".format(name, object_name)
+            )
+            continue
+        columns_indexes[name] = index
+    if len(columns_indexes) < len(columns_allowed):
+        return None
+    return columns_indexes
+
+
+def to_count(value: str) -> int:
+    return int(float(value)) if value != "" else 0
+
+
+class IngestPlan:
+    """How to format the rows of a file, compiled once from its headers
+
+    Rows are formatted in two passes: the distinct locations and dates of a
+    block are resolved at once (`resolve`), into tables kept for the whole
+    file, then the rows are formatted (`format`) with lookups in the tables,
+    column by column.
+    """
+
+    def __init__(self, columns_indexes: dict, filename: str, bucket_name: str):
+        self.date = columns_indexes["date"]
+        self.location = columns_indexes["location"]
+        self.population = columns_indexes["population"]
+        self.cases = columns_indexes["cases"]
+        self.filename = filename
+        self.bucket_name = bucket_name
+        self.cases_field = "vaccinated" if bucket_name == "vaccination" else "confirmed"
+        self.lock = threading.Lock()
+        self.periods = {}  # date cell: (date_start, date_end)
+        self.populations = {}  # population cell: count, repeated by locations
+
+    def __getstate__(self):
+        # Plans are pickled to the parallel parse workers, not their lock
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def compile(cls, headers: list, filename: str, bucket_name: str):
+        """Plan of a file, None if its headers lack a column"""
+        columns_indexes = get_columns_indexes(headers, filename)
+        if columns_indexes is None:
+            return None
+        return cls(columns_indexes, filename, bucket_name)
+
+    def resolve(self, block: list):
+        """Geocodes the unknown locations of a block and parses its new dates"""
+        with metrics.timer("geocode_seconds", flow=self.bucket_name):
+            prepare_locations({row[self.location] for row in block})
+        dates = {row[self.date] for row in block}
+        with self.lock:
+            for date in dates.difference(self.periods):
+                self.periods[date] = format_date(date, self.filename)
+            for population in {row[self.population] for row in block}.difference(
+                self.populations
+            ):
+                self.populations[population] = to_count(population)
+
+    def format(self, block: list):
+        """Formats a resolved block (see `resolve`), as a batches.Batch"""
+        located = [(row, locations_cache[row[self.location]]) for row in block]
+        located = [(row, location) for row, location in located if location is not None]
+        if len(located) < len(block):
+            metrics.inc(
+                "rows_rejected_total",
+                len(block) - len(located),
+                flow=self.bucket_name,
+                reason="location",
+            )
+        periods = [self.periods[row[self.date]] for row, _ in located]
+        max_population = [self.populations[row[self.population]] for row, _ in located]
+        cases = [to_count(row[self.cases]) for row, _ in located]
+        return batches.Batch.from_columns(
+            {
+                "date_start": [period[0] for period in periods],
+                "date_end": [period[1] for period in periods],
+                "location": [location[0] for _, location in located],
+                "filename": self.filename,
+                "iso_code2": [location[1] for _, location in located],
+                "max_population": max_population,
+                "percentage": [
+                    float(count) / float(population) * 100 if population != 0 else None
+                    for count, population in zip(cases, max_population)
+                ],
+                self.cases_field: cases,
+            },
+            len(located),
+        )
 
-def parse_file(minio_client, obj):
-    csv_file_path = "/tmp/" + str(uuid.uuid4())
-    minio_client.fget_object(obj.bucket_name, obj.object_name, csv_file_path)
-    with open(csv_file_path, "r", newline="") as fp:
-        char_read = 100000 if os.path.getsize(csv_file_path) > 100000 else None
+    def format_row(self, row: list):
+        """Formats a row alone, resolving its values if needed (parallel engine)"""
+        if row[self.date] not in self.periods or row[self.population] not in (
+            self.populations
+        ):
+            self.resolve([row])
+        location = format_location(row[self.location])
+        if location is None:
+            metrics.inc("rows_rejected_total", flow=self.bucket_name, reason="location")
+            return None
+        date_start, date_end = self.periods[row[self.date]]
+        max_population = self.populations[row[self.population]]
+        cases = to_count(row[self.cases])
+        return {
+            "date_start": date_start,
+            "date_end": date_end,
+            "location": location[0],
+            "filename": self.filename,
+            "iso_code2": location[1],
+            "max_population": max_population,
+            "percentage": (
+                float(cases) / float(max_population) * 100
+                if max_population != 0
+                else None
+            ),
+            self.cases_field: cases,
+        }
+
+
+def format_block(block, plan):
+    """Formats a block of rows, resolving its locations and dates at once"""
+    plan.resolve(block)
+    with metrics.timer("format_seconds", flow=plan.bucket_name):
+        return plan.format(block)
 
+
+def parse_file(minio_client, obj):
+    """Yields blocks of rows to format (see `format_block`)"""
+    with minio_source.open_object(
+        minio_client, obj.bucket_name, obj.object_name, SNIFF_SAMPLE_BYTES
+    ) as (sample, fp):
         try:
-            dialect = clevercsv.Sniffer().sniff(fp.read(char_read), verbose=True)
+            with metrics.timer("sniff_seconds", flow=obj.bucket_name):
+                dialect, fast = dialects.resolve(
+                    f"{obj.bucket_name}/{obj.object_name}", sample
+                )
         except Exception as e:
             logger.error(e)
             return []
 
-        fp.seek(0)
-        reader = clevercsv.reader(fp, dialect)
+        reader = dialects.reader(fp, dialect, fast)
         headers = next(reader)
-        columns_indexes = {}
-        malformed_csv = False
-        for name in columns_allowed:
-            for header in headers:
-                index = (
-                    headers.index(header) if header in columns_allowed[name] else None
-                )
-                if index is None:
-                    continue
-                columns_indexes[name] = index
+        plan = IngestPlan.compile(headers, obj.object_name, obj.bucket_name)
+        if plan is None:
+            return []
+        progress = tqdm(unit="entry")
+        # Locations are geocoded a block at a time, the file is read only once
+        while True:
+            with metrics.timer("parse_seconds", flow=obj.bucket_name):
+                block = list(islice(reader, MAX_ES_ROW_INJECT))
+            if not len(block):
                 break
-            if name not in columns_indexes:
-                logger.error(
-                    "Header {} cannot be found in csv {}".format(name, obj.object_name)
+            metrics.inc("rows_read_total", len(block), flow=obj.bucket_name)
+            yield partial(format_block, block, plan)
+            progress.update(len(block))
+        progress.close()
+    return []
+
+
+def format_chunk(frame, columns, obj):
+    with metrics.timer("geocode_seconds", flow=obj.bucket_name):
+        prepare_locations(frame[columns["location"]])
+    with metrics.timer("format_seconds", flow=obj.bucket_name):
+        return format_frame(frame, columns, obj.object_name, obj.bucket_name)
+
+
+def parse_file_columnar(minio_client, obj):
+    """Yields chunks of rows to format (see `format_chunk`), parsed with pandas"""
+    with minio_source.open_object(
+        minio_client, obj.bucket_name, obj.object_name, SNIFF_SAMPLE_BYTES
+    ) as (sample, fp):
+        try:
+            with metrics.timer("sniff_seconds", flow=obj.bucket_name):
+                dialect, _ = dialects.resolve(
+                    f"{obj.bucket_name}/{obj.object_name}", sample
                 )
-                malformed_csv = True
-                continue
-        if malformed_csv is True:
+        except Exception as e:
+            logger.error(e)
             return []
-        for row in tqdm(reader, unit="entry"):
-            row = format_row(row, columns_indexes, obj.object_name, obj.bucket_name)
-            if row is not None:
+
+        columns = None
+        chunks = columnar.read_csv_chunks(fp, dialect, MAX_ES_ROW_INJECT)
+        for frame in tqdm(chunks, unit="chunk"):
+            metrics.inc("rows_read_total", len(frame), flow=obj.bucket_name)
+            if columns is None:
+                columns = {
+                    name: candidates[0]
+                    for name, candidates in columnar.resolve_columns(
+                        list(frame.columns), columns_allowed
+                    ).items()
+                    if len(candidates)
+                }
+                missing = [name for name in columns_allowed if name not in columns]
+                if len(missing):
+                    logger.error(
+                        "Headers {} cannot be found in csv {}".format(
+                            missing, obj.object_name
+                        )
+                    )
+                    return []
+            yield partial(format_chunk, frame, columns, obj)
+    return []
+
+
+def parse_file_parquet(minio_client, obj):
+    """Yields chunks of rows to format (see `format_chunk`), read from Parquet
+
+    The object is converted first if it is new or changed.
+    """
+    manifest = curated.normalize_object(minio_client, obj, layout)
+    columns = {
+        name: candidates[0]
+        for name, candidates in columnar.resolve_columns(
+            manifest["columns"], columns_allowed
+        ).items()
+        if len(candidates)
+    }
+    missing = [name for name in columns_allowed if name not in columns]
+    if len(missing):
+        logger.error(
+            "Headers {} cannot be found in csv {}".format(missing, obj.object_name)
+        )
+        return []
+    frames = curated.read_frames(
+        minio_client, manifest, sorted(set(columns.values())), MAX_ES_ROW_INJECT
+    )
+    for frame in tqdm(frames, unit="chunk"):
+        metrics.inc("rows_read_total", len(frame), flow=obj.bucket_name)
+        yield partial(format_chunk, frame, columns, obj)
+    return []
+
+
+def parse_file_parallel(minio_client, obj):
+    """Yields formatted rows, parsed by chunks of the file in a pool of processes"""
+    # Workers seek to their own chunk of the file, it has to be on disk
+    with minio_source.spill_object(
+        minio_client, obj.bucket_name, obj.object_name
+    ) as csv_file_path:
+        with open(csv_file_path, "r", newline="") as fp:
+            try:
+                with metrics.timer("sniff_seconds", flow=obj.bucket_name):
+                    dialect, fast = dialects.resolve(
+                        f"{obj.bucket_name}/{obj.object_name}",
+                        fp.read(SNIFF_SAMPLE_BYTES),
+                    )
+            except Exception as e:
+                logger.error(e)
+                return []
+        with metrics.timer("geocode_seconds", flow=obj.bucket_name):
+            prepare_locations(
+                geocoding.distinct_values(
+                    csv_file_path, dialect, columns_allowed["location"]
+                )
+            )
+
+        def make_formatter(headers):
+            plan = IngestPlan.compile(headers, obj.object_name, obj.bucket_name)
+            return plan.format_row if plan is not None else None
+
+        rows = parallel_parse.parse_file_parallel(
+            csv_file_path, dialect, make_formatter, fast
+        )
+        nb_rows = 0
+        try:
+            for row in tqdm(rows, unit="entry"):
+                nb_rows += 1
                 yield row
+        finally:
+            metrics.inc("rows_read_total", nb_rows, flow=obj.bucket_name)
     return []
 
 
 class ParseFiles(Task):
-    def run(self, bucket_name):
-        minio_client = Minio(
-            MINIO_ENDPOINT,
-            access_key=MINIO_ACCESS_KEY,
-            secret_key=MINIO_SECRET_KEY,
-            secure=MINIO_SCHEME == "https",
+    def run(self, bucket_name, index_name):
+        with bulk_load.bulk_load(index_name):
+            minio_client = Minio(
+                MINIO_ENDPOINT,
+                access_key=MINIO_ACCESS_KEY,
+                secret_key=MINIO_SECRET_KEY,
+                secure=MINIO_SCHEME == "https",
+            )
+            logger.info("Parse file for bucket {}".format(bucket_name))
+            if not minio_client.bucket_exists(bucket_name):
+                logger.error("Bucket {} does not exists".format(bucket_name))
+                return metrics.report(bucket_name)
+            objects = minio_client.list_objects(bucket_name)
+            settings = ingest_progress.ingest_settings(INGEST_ENGINE, MAX_ES_ROW_INJECT)
+            progresses = []
+            for obj in objects:
+                progress = ingest_progress.ObjectProgress(index_name, obj, settings)
+                progresses.append(progress)
+                if progress.complete:
+                    continue
+                with metrics.timer("file_seconds", flow=bucket_name):
+                    self.process_object(minio_client, obj, index_name, progress)
+            es_client.join()
+            ingest_progress.finish_load(index_name, progresses)
+        return metrics.report(bucket_name)
+
+    def process_object(self, minio_client, obj, index_name, progress=None):
+        document_ids = documents.DocumentIds(obj.object_name)
+        if INGEST_ENGINE == "columnar":
+            batches = parse_file_columnar(minio_client, obj)
+        elif INGEST_ENGINE == "parquet":
+            batches = parse_file_parquet(minio_client, obj)
+        elif INGEST_ENGINE == "parallel":
+            batches = pipeline.batched(
+                parse_file_parallel(minio_client, obj), MAX_ES_ROW_INJECT
+            )
+        else:
+            batches = parse_file(minio_client, obj)
+        pipeline.ingest(
+            obj.bucket_name,
+            batches,
+            index_name,
+            lambda rows: rows_ids(rows, document_ids),
+            progress,
         )
-        logger.info("Parse file for bucket {}".format(bucket_name))
-        if not minio_client.bucket_exists(bucket_name):
-            logger.error("Bucket {} does not exists".format(bucket_name))
-            return
-        objects = minio_client.list_objects(bucket_name)
-        for obj in objects:
-            to_inject = []
-            for row in parse_file(minio_client, obj):
-                to_inject.append(row)
-                if len(to_inject) >= MAX_ES_ROW_INJECT:
-                    inject_rows_to_es(to_inject, bucket_name)
-                    to_inject = []
-            if len(to_inject) > 0:
-                inject_rows_to_es(to_inject, bucket_name)
 
 
 class GenerateEsMapping(Task):
@@ -219,28 +463,20 @@ class GenerateEsMapping(Task):
         self.index_name = index_name
         super().__init__(**kwargs)
 
-    def run(self):
+    def run(self) -> str:
+        """
+        Returns:
+            str: name of the index to write to
+        """
         index_name = self.index_name
-        es_inst = get_es_instance()
+        es_inst = es_client.get_es_instance()
 
         logger.info("Generating mapping for index {}".format(index_name))
 
-        es_inst.indices.delete(index=index_name, ignore=[400, 404])
-
-        response = es_inst.indices.create(
-            index=index_name, body=mapping, ignore=400  # ignore 400 already exists code
+        return index_generations.prepare_index(
+            es_inst, index_name, mapping, resume=True
         )
 
-        if "acknowledged" in response:
-            if response["acknowledged"] == True:
-                logger.info(
-                    "INDEX MAPPING SUCCESS FOR INDEX: {}".format(response["index"])
-                )
-            elif "error" in response:
-                logger.error(response["error"]["root_cause"])
-                logger.error("Error type: {}".format(response["error"]["type"]))
-                raise Exception("Unable to create index mapping")
-
 
 schedule = IntervalSchedule(
     interval=timedelta(hours=24), start_date=datetime.utcnow() + timedelta(seconds=1)
@@ -248,16 +484,29 @@ schedule = IntervalSchedule(
 
 with Flow("Parse and insert csv files", schedule) as flow:
     for bucket in ["vaccination", "contamination"]:
+        es_mapping_task = GenerateEsMapping(bucket)
+        parse_files_task = ParseFiles()
+        flow.set_dependencies(
+            task=parse_files_task,
+            keyword_tasks=dict(bucket_name=bucket, index_name=es_mapping_task),
+        )
+        publish_index_task = index_generations.PublishIndex()
+        flow.set_dependencies(
+            task=publish_index_task,
+            upstream_tasks=[parse_files_task],
+            keyword_tasks=dict(alias=bucket, index_name=es_mapping_task),
+        )
         flow.set_dependencies(
-            task=ParseFiles(),
-            upstream_tasks=[GenerateEsMapping(bucket)],
-            keyword_tasks=dict(bucket_name=bucket),
+            task=rollups.UpdateRollups(),
+            upstream_tasks=[publish_index_task],
+            keyword_tasks=dict(alias=bucket),
         )
 
-try:
-    client = Client()
-    client.create_project(project_name="pandemic-knowledge")
-except prefect.utilities.exceptions.ClientError as e:
-    logger.info("Project already exists")
+if __name__ == "__main__":
+    try:
+        client = Client()
+        client.create_project(project_name="pandemic-knowledge")
+    except prefect.utilities.exceptions.ClientError as e:
+        logger.info("Project already exists")
 
-flow.register(project_name="pandemic-knowledge", labels=["development"])
\ No newline at end of file
+    flow.register(project_name="pandemic-knowledge", labels=["development"])
\ No newline at end of file
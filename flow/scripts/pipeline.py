@@ -0,0 +1,328 @@
+import os
+import time
+import queue
+import prefect
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import batches
+import es_client
+import metrics
+
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE") or 4)  # batches
+# Workers of the stages that allow several, e.g. "format=2"
+PIPELINE_WORKERS = dict(
+    (name.strip(), int(workers))
+    for name, workers in (
+        setting.split("=")
+        for setting in (os.environ.get("PIPELINE_WORKERS") or "").split(",")
+        if setting.strip()
+    )
+)
+
+logger = prefect.context.get("logger")
+
+_done = object()  # end of stream marker
+
+
+class Stopped(Exception):
+    """Another stage failed, this one gives up"""
+
+
+class Stage:
+    def __init__(self, name: str, func, workers: int):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.busy = 0.0  # s spent in func, summed over workers
+        self.starved = 0.0  # s waiting for the upstream stage
+        self.blocked = 0.0  # s waiting for room in the downstream queue
+
+
+class Pipeline:
+    """Stages of a flow running at once, connected by bounded queues
+
+    The source (e.g. a parser yielding batches of rows) is iterated by its
+    own thread, as the "parse" stage. Each following stage maps a batch to
+    the next stage's batch (None drops it). When a stage can't keep up, the
+    queue before it fills up and blocks the stages upstream: memory stays
+    bounded and the slowest stage, reported as saturated, sets the pace.
+
+    Stages keep batches in order, even with several workers. Only stages
+    added with `parallel=True` get the workers set in PIPELINE_WORKERS,
+    others (e.g. holding order dependent state) run on a single thread.
+    """
+
+    def __init__(self, flow: str, queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.flow = flow
+        self.queue_size = queue_size
+        self.stages = []
+        self.stop = threading.Event()
+        self.errors = []
+
+    def stage(self, name: str, func, parallel: bool = False):
+        workers = PIPELINE_WORKERS.get(name, 1) if parallel else 1
+        self.stages.append(Stage(name, func, max(1, workers)))
+        return self
+
+    def _get(self, stage: Stage, inbox: queue.Queue):
+        started = time.perf_counter()
+        try:
+            while True:
+                try:
+                    return inbox.get(timeout=0.1)
+                except queue.Empty:
+                    if self.stop.is_set():
+                        raise Stopped()
+        finally:
+            stage.starved += time.perf_counter() - started
+
+    def _put(self, stage: Stage, outbox: queue.Queue, item):
+        if outbox is None:
+            return
+        started = time.perf_counter()
+        try:
+            while True:
+                try:
+                    return outbox.put(item, timeout=0.1)
+                except queue.Full:
+                    if self.stop.is_set():
+                        raise Stopped()
+        finally:
+            stage.blocked += time.perf_counter() - started
+
+    def _call(self, stage: Stage, item):
+        started = time.perf_counter()
+        try:
+            return stage.func(item)
+        finally:
+            with stage.lock:
+                stage.busy += time.perf_counter() - started
+
+    def _fail(self, stage: Stage, error: Exception):
+        if not isinstance(error, Stopped):
+            self.errors.append((stage.name, error))
+        self.stop.set()
+
+    def _read(self, stage: Stage, source, outbox: queue.Queue):
+        iterator = iter(source)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stage.busy += time.perf_counter() - started
+                if item is not None:
+                    self._put(stage, outbox, item)
+            self._put(stage, outbox, _done)
+        except Exception as e:
+            self._fail(stage, e)
+        finally:
+            if hasattr(iterator, "close"):  # the parser's files
+                iterator.close()
+
+    def _run_stage(self, stage: Stage, inbox: queue.Queue, outbox: queue.Queue):
+        try:
+            if stage.workers == 1:
+                while True:
+                    item = self._get(stage, inbox)
+                    if item is _done:
+                        break
+                    result = self._call(stage, item)
+                    if result is not None:
+                        self._put(stage, outbox, result)
+            else:
+                self._run_workers(stage, inbox, outbox)
+            self._put(stage, outbox, _done)
+        except Exception as e:
+            self._fail(stage, e)
+
+    def _run_workers(self, stage: Stage, inbox: queue.Queue, outbox: queue.Queue):
+        """Calls the stage's func from a pool, passing results on in order"""
+        pending = deque()
+        with ThreadPoolExecutor(
+            max_workers=stage.workers, thread_name_prefix=f"pipeline-{stage.name}"
+        ) as executor:
+            try:
+                item = None
+                while item is not _done or len(pending):
+                    if item is not _done and len(pending) < stage.workers:
+                        item = self._get(stage, inbox)
+                        if item is not _done:
+                            pending.append(executor.submit(self._call, stage, item))
+                        continue
+                    result = pending.popleft().result()
+                    if result is not None:
+                        self._put(stage, outbox, result)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def run(self, source):
+        """Pushes the source's batches through the stages, raises if one failed"""
+        started = time.perf_counter()
+        parse = Stage("parse", None, 1)
+        queues = [queue.Queue(self.queue_size) for _ in self.stages] + [None]
+        threads = [
+            threading.Thread(
+                target=self._read,
+                args=(parse, source, queues[0]),
+                name=f"pipeline-{parse.name}",
+                daemon=True,
+            )
+        ]
+        for stage, inbox, outbox in zip(self.stages, queues, queues[1:]):
+            threads.append(
+                threading.Thread(
+                    target=self._run_stage,
+                    args=(stage, inbox, outbox),
+                    name=f"pipeline-{stage.name}",
+                    daemon=True,
+                )
+            )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._report([parse] + self.stages, time.perf_counter() - started)
+        if len(self.errors):
+            name, error = self.errors[0]
+            logger.error(f"Stage {name} of {self.flow} failed: {error}")
+            raise error
+
+    def _report(self, stages: list, seconds: float):
+        for stage in stages:
+            for state in ("busy", "starved", "blocked"):
+                metrics.inc(
+                    f"pipeline_{state}_seconds_total",
+                    getattr(stage, state),
+                    flow=self.flow,
+                    stage=stage.name,
+                )
+        if seconds <= 0:
+            return
+        utilization = {
+            stage.name: stage.busy / stage.workers / seconds for stage in stages
+        }
+        saturated = max(utilization, key=utilization.get)
+        metrics.inc("pipeline_saturated_total", flow=self.flow, stage=saturated)
+        logger.info(
+            "Pipeline of {} saturated by {} ({})".format(
+                self.flow,
+                saturated,
+                ", ".join(
+                    f"{name} {ratio:.0%} busy" for name, ratio in utilization.items()
+                ),
+            )
+        )
+
+
+def ingest_engine(flow: str, supported: tuple) -> str:
+    """Engine parsing a flow's files: INGEST_ENGINE_<FLOW>, or INGEST_ENGINE
+
+    e.g. INGEST_ENGINE_INSERT_OWID=parallel for insert_owid.py alone. An
+    engine the flow doesn't support is refused rather than replaced.
+    """
+    variable = "INGEST_ENGINE_" + flow.upper()
+    engine = os.environ.get(variable) or os.environ.get("INGEST_ENGINE") or "row"
+    if engine not in supported:
+        raise ValueError(
+            f"{flow} doesn't support the {engine} engine ({variable} or "
+            f"INGEST_ENGINE), use one of: {', '.join(supported)}"
+        )
+    return engine
+
+
+def batched(rows, size: int):
+    """Groups the rows of a parser yielding them one by one"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch):
+        yield batch
+
+
+def numbered(source):
+    """(number, item) of each item of a source, closing it once closed"""
+    iterator = iter(source)
+    try:
+        yield from enumerate(iterator)
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+def format_batch(batch):
+    """Formats a batch if deferred to the format stage, as a batches.Batch
+
+    Invalid (None) rows are dropped.
+    """
+    rows = batch() if callable(batch) else batch
+    if not isinstance(rows, batches.Batch):
+        rows = batches.Batch.from_rows([row for row in rows if row is not None])
+    return rows if len(rows) else None
+
+
+def ingest(flow: str, batches, index_name: str, ids_of, progress=None):
+    """Formats, serializes and ships a parser's batches, all stages at once
+
+    `batches` yields lists of rows (or batches.Batch) or callables formatting
+    them, and `ids_of(batch)` gives the ids of a batches.Batch: it is called
+    in batches order.
+    ES being the bottleneck, the ship stage blocks on ES_BULK_MAX_IN_FLIGHT
+    pending requests, and parsing slows down until they complete.
+
+    With a `progress` (see ingest_progress), the batches it acknowledged in a
+    previous run are skipped once their ids are known (ids depend on the rows
+    before), and the others acknowledged to it once shipped.
+    """
+    skipped = progress.acknowledged if progress is not None else 0
+
+    def format_numbered(item):
+        number, batch = item
+        return number, format_batch(batch) if batch is not None else None
+
+    def serialize(item):
+        number, rows = item
+        if number < skipped:
+            if rows is not None:
+                ids_of(rows)
+                metrics.inc("documents_skipped_total", len(rows), flow=flow)
+            return None
+        if rows is None:  # nothing valid to ship, done as well
+            if progress is not None:
+                progress.ack(number, 0)
+            return None
+        return number, es_client.prepare_rows(rows, index_name, ids_of(rows))
+
+    def ship(item):
+        number, batch = item
+        on_done = None
+        if progress is not None:
+            # Dead-lettered documents are handled too, the batch is done
+            on_done = lambda ids: progress.ack(number, len(batch))
+        es_client.ship_batch(batch, on_done)
+
+    try:
+        # Numbered as parsed, before formatting can leave a batch empty
+        Pipeline(flow).stage("format", format_numbered, parallel=True).stage(
+            "serialize", serialize
+        ).stage("ship", ship).run(numbered(batches))
+    except Exception:
+        # Requests of a failed file must not fail the next one (see join)
+        try:
+            es_client.join()
+        except Exception as e:
+            logger.error(f"Bulk request of {flow} failed: {e!r}")
+        raise
+    es_client.join()
+    if progress is not None:
+        progress.finish()
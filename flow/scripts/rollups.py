@@ -0,0 +1,263 @@
+import os
+import prefect
+import threading
+from datetime import date, datetime, timedelta, timezone
+from prefect import Task
+from elasticsearch import helpers
+
+import checkpoints
+import documents
+import es_client
+import index_generations
+import metrics
+
+ROLLUP_PREFIX = "rollup_"  # not matched by the raw indices patterns
+ROLLUP_PAGE_SIZE = int(os.environ.get("ROLLUP_PAGE_SIZE") or 1000)
+
+MEASURES = ["confirmed", "deaths", "recovered", "vaccinated", "tested"]
+# Bucket: calendar interval, and its length to compute date_end
+INTERVALS = {"day": ("1d", timedelta(days=1)), "week": ("1w", timedelta(weeks=1))}
+LEVELS = {"country": "iso_code2.keyword", "region": "iso_region2.keyword"}
+
+logger = prefect.context.get("logger")
+
+rollup_mapping = {
+    "mappings": {
+        "properties": {
+            "interval": {"type": "keyword"},
+            "level": {"type": "keyword"},
+            "code": {"type": "keyword"},
+            "date_start": {"type": "date", "format": "strict_date"},
+            "date_end": {"type": "date", "format": "strict_date"},
+            "documents": {"type": "long"},
+            **{measure: {"type": "long"} for measure in MEASURES},
+            "max_population": {"type": "long"},
+            "location": {"type": "geo_point"},
+            "content_hash": {"type": "keyword", "index": False},
+        }
+    }
+}
+
+_touched = {}  # alias: touched days this process already saved
+_touched_lock = threading.Lock()
+
+
+def rollup_index_name(alias: str) -> str:
+    return f"{ROLLUP_PREFIX}{alias}"
+
+
+def _day(value) -> date:
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    if hasattr(value, "date"):  # datetime, pandas' Timestamp
+        return value.date()
+    return value
+
+
+def _checkpoint_name(alias: str) -> str:
+    return f"rollups:{alias}"
+
+
+def track_written(index_name: str, written: list):
+    """es_client write listener: saves the days to roll up again
+
+    Days are kept in the checkpoint store until rolled up, even by a later
+    run (flow runs are separate processes).
+    """
+    if index_name.startswith(ROLLUP_PREFIX):
+        return
+    days = {_day(doc["date_start"]) for doc in written if doc.get("date_start")}
+    alias = index_generations.alias_of(index_name)
+    with _touched_lock:
+        saved = _touched.setdefault(alias, set())
+        if days.issubset(saved):
+            return
+        store, name = checkpoints.get_store(), _checkpoint_name(alias)
+        stored = {date.fromisoformat(day) for day in store.get(name, [])}
+        store.put(name, sorted(day.isoformat() for day in stored | days))
+        saved.update(days)
+
+
+es_client.on_write(track_written)
+
+
+def touched_days(alias: str) -> set:
+    """Days to roll up again, see `forget_touched` once they are"""
+    days = checkpoints.get_store().get(_checkpoint_name(alias), [])
+    return {date.fromisoformat(day) for day in days}
+
+
+def forget_touched(alias: str, days: set):
+    """Forgets rolled up days, keeping those touched since"""
+    with _touched_lock:
+        store, name = checkpoints.get_store(), _checkpoint_name(alias)
+        stored = {date.fromisoformat(day) for day in store.get(name, [])}
+        remaining = stored - days
+        if len(remaining):
+            store.put(name, sorted(day.isoformat() for day in remaining))
+        else:
+            store.delete(name)
+        _touched.get(alias, set()).difference_update(days)
+
+
+def week_ranges(days: set) -> list:
+    """Weeks of some days as [first monday, last monday] ranges"""
+    mondays = sorted({day - timedelta(days=day.weekday()) for day in days})
+    ranges = []
+    for monday in mondays:
+        if len(ranges) and monday - ranges[-1][1] == timedelta(weeks=1):
+            ranges[-1][1] = monday
+        else:
+            ranges.append([monday, monday])
+    return ranges
+
+
+def weeks_query(weeks: list) -> dict:
+    """Documents starting within week ranges (None: all documents)"""
+    if weeks is None:
+        return {"match_all": {}}
+    return {
+        "bool": {
+            "should": [
+                {
+                    "range": {
+                        "date_start": {
+                            "gte": first.isoformat(),
+                            "lt": (last + timedelta(weeks=1)).isoformat(),
+                            "format": "strict_date",
+                        }
+                    }
+                }
+                for first, last in weeks
+            ],
+            "minimum_should_match": 1,
+        }
+    }
+
+
+def aggregate(es_inst, alias: str, query: dict, interval: str, level: str):
+    """Yields the rollup documents of an interval and level, page by page"""
+    calendar_interval, length = INTERVALS[interval]
+    composite = {
+        "size": ROLLUP_PAGE_SIZE,
+        "sources": [
+            {
+                "date": {
+                    "date_histogram": {
+                        "field": "date_start",
+                        "calendar_interval": calendar_interval,
+                    }
+                }
+            },
+            {"code": {"terms": {"field": LEVELS[level]}}},
+        ],
+    }
+    aggs = {measure: {"sum": {"field": measure}} for measure in MEASURES}
+    aggs["max_population"] = {"max": {"field": "max_population"}}
+    aggs["location"] = {"geo_centroid": {"field": "location"}}
+    while True:
+        response = es_inst.search(
+            index=alias,
+            body={
+                "size": 0,
+                "query": query,
+                "aggs": {"buckets": {"composite": composite, "aggs": aggs}},
+            },
+        )
+        buckets = response["aggregations"]["buckets"]
+        for bucket in buckets["buckets"]:
+            start = datetime.fromtimestamp(
+                bucket["key"]["date"] / 1000, tz=timezone.utc
+            ).date()
+            yield {
+                "interval": interval,
+                "level": level,
+                "code": bucket["key"]["code"],
+                "date_start": start.isoformat(),
+                "date_end": (start + length - timedelta(days=1)).isoformat(),
+                "documents": bucket["doc_count"],
+                **{measure: int(bucket[measure]["value"]) for measure in MEASURES},
+                "max_population": int(bucket["max_population"]["value"] or 0),
+                "location": bucket["location"].get("location"),
+            }
+        if "after_key" not in buckets or not len(buckets["buckets"]):
+            return
+        composite["after_key"] = buckets["after_key"]
+
+
+def rollup_id(document: dict) -> str:
+    return documents.document_id(
+        document["interval"],
+        document["level"],
+        document["code"],
+        document["date_start"],
+    )
+
+
+def update_rollups(es_inst, alias: str, weeks: list = None) -> int:
+    """Recomputes the rollups of `weeks` ranges (None: all), returns their count
+
+    Rollups of these weeks that no longer aggregate any document are deleted.
+    """
+    rollup_index = rollup_index_name(alias)
+    if not es_inst.indices.exists(index=rollup_index):
+        es_inst.indices.create(index=rollup_index, body=rollup_mapping)
+    # Documents just written (upserted in place) must be searchable
+    es_inst.indices.refresh(index=alias)
+    query = weeks_query(weeks)
+    ids = set()
+    for interval in INTERVALS:
+        for level in LEVELS:
+            rows = []
+            for row in aggregate(es_inst, alias, query, interval, level):
+                rows.append(row)
+                if len(rows) >= ROLLUP_PAGE_SIZE:
+                    ids.update(ship(rows, rollup_index))
+                    rows = []
+            ids.update(ship(rows, rollup_index))
+    es_client.join()
+
+    stale = [
+        {"_op_type": "delete", "_index": rollup_index, "_id": hit["_id"]}
+        for hit in helpers.scan(
+            es_inst, index=rollup_index, query={"query": query}, _source=False
+        )
+        if hit["_id"] not in ids
+    ]
+    if len(stale):
+        helpers.bulk(es_inst, stale)
+    metrics.inc("rollups_computed_total", len(ids), index=alias)
+    metrics.inc("rollups_deleted_total", len(stale), index=alias)
+    logger.info(f"{len(ids)} rollups of {alias} updated, {len(stale)} deleted")
+    return len(ids)
+
+
+def ship(rows: list, rollup_index: str) -> list:
+    ids = [rollup_id(row) for row in rows]
+    if len(rows):
+        es_client.ship_rows(rows, rollup_index, ids)
+    return ids
+
+
+class UpdateRollups(Task):
+    """Rolls up the documents of an alias written since its last rollup
+
+    Everything is rolled up again after a rebuild (the alias then points to
+    a new index), only the weeks touched since otherwise (by this run, or by
+    earlier ones whose rollup failed).
+    """
+
+    def run(self, alias: str) -> int:
+        es_inst = es_client.get_es_instance()
+        days = touched_days(alias)
+        weeks = week_ranges(days)
+        if es_client.ES_WRITE_MODE == "rebuild":
+            weeks = None
+        elif not len(weeks):
+            logger.info(f"No document of {alias} written, rollups are up to date")
+            return 0
+        with metrics.timer("rollup_seconds", index=alias):
+            count = update_rollups(es_inst, alias, weeks)
+        # Only once rolled up: a failed update is tried again by the next run
+        forget_touched(alias, days)
+        return count
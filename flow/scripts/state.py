@@ -0,0 +1,9 @@
+import os
+
+STATE_DIR = os.environ.get("STATE_DIR") or "/var/lib/pandemic-knowledge"
+
+
+def state_path(name: str) -> str:
+    """Path of a file persisted across flow runs (caches, checkpoints...)"""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    return os.path.join(STATE_DIR, name)